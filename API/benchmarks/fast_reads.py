@@ -0,0 +1,73 @@
+# times reading whole tables page by page through the list routes, with and without crud.FAST_READS
+# run from API/ with the test environment : DATABASE_URL=... ROOT_PATH="" python benchmarks/fast_reads.py [rows]
+import sys
+import time
+
+sys.path.insert(0, 'src')
+
+import crud
+import database
+import models
+
+from main import app, get_db, get_read_db
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+ENDPOINTS = ["/users/", "/cabinets/", "/categories/", "/items/", "/order-requests/", "/storage-units/", "/unlock-attempts/"]
+
+def seed(db):
+    ids = range(1000001, 1000001 + ROWS)
+    db.execute(insert(models.User), [{"uid": f"B{n:010}", "firstname": "Bench", "lastname": f"User {n}"} for n in ids])
+    db.execute(insert(models.Cabinet), [{"id": f"CAB-BENCH-{n}", "description": "Benchmark cabinet"} for n in ids])
+    db.execute(insert(models.Category), [{"id": n, "title": f"Bench category {n}"} for n in ids])
+    db.execute(insert(models.Item), [{"id": n, "title": f"Bench item {n}", "price": n / 100, "category_id": n} for n in ids])
+    db.execute(insert(models.OrderRequest), [{"id": n, "item_id": n, "user_id": f"B{n:010}"} for n in ids])
+    db.execute(insert(models.StorageUnit), [{"id": n, "item_id": n, "cabinet_id": f"CAB-BENCH-{n}"} for n in ids])
+    db.execute(insert(models.CabinetUnlockAttempt), [{"id": n, "user_id": f"B{n:010}", "cabinet_id": f"CAB-BENCH-{n}", "granted": n % 2 == 0} for n in ids])
+
+def read_all(client, path):
+    # every page of path, the cursor is absent on the first request
+    params = {"limit": crud.MAX_PAGE_SIZE}
+    content = []
+    while True:
+        response = client.get(path, params=params)
+        content.append(response.content)
+        params["cursor"] = response.json()["next_cursor"]
+        if params["cursor"] is None:
+            return content
+
+def main():
+    # the rows live in a transaction rolled back at the end, the routes read them through a session bound to it
+    connection = database.engine.connect()
+    transaction = connection.begin()
+    db = database.ThreadedSession(bind=connection)
+    seed(db)
+
+    async def get_bench_db():
+        yield db
+
+    # the list routes read through get_read_db, a replica or a new primary session would not see the uncommitted rows
+    app.dependency_overrides[get_db] = get_bench_db
+    app.dependency_overrides[get_read_db] = get_bench_db
+    client = TestClient(app)
+    try:
+        print(f"{'endpoint':<20}{'response_model (s)':>20}{'FAST_READS (s)':>18}{'speedup':>10}")
+        for path in ENDPOINTS:
+            timings = {}
+            for fast_reads in (False, True):
+                crud.FAST_READS = fast_reads
+                read_all(client, path) # warm up
+                start = time.perf_counter()
+                timings[fast_reads] = (read_all(client, path), time.perf_counter() - start)
+            assert timings[False][0] == timings[True][0], path # byte-identical pages
+            print(f"{path:<20}{timings[False][1]:>20.3f}{timings[True][1]:>18.3f}{timings[False][1] / timings[True][1]:>9.1f}x")
+    finally:
+        app.dependency_overrides.clear()
+        db.close()
+        transaction.rollback()
+        connection.close()
+
+if __name__ == '__main__':
+    main()
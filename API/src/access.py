@@ -0,0 +1,94 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+import crud
+
+from sqlalchemy.orm import sessionmaker
+
+
+ACCESS_REFRESH_INTERVAL = float(os.environ.get('ACCESS_REFRESH_INTERVAL', '2')) # seconds between reads of the permissions changed by other workers
+ACCESS_REFRESH_OVERLAP = float(os.environ.get('ACCESS_REFRESH_OVERLAP', '10')) # seconds re-read before the last change seen, for transactions committed late
+ACCESS_FULL_RELOAD_INTERVAL = float(os.environ.get('ACCESS_FULL_RELOAD_INTERVAL', '300')) # seconds between full reloads, they drop the permissions of users and cabinets deleted by other workers
+
+# deleting their rows removes permissions through ON DELETE CASCADE, which leaves nothing for the incremental refresh to read,
+# a change of their version makes the next refresh a full reload
+CASCADING_TABLES = ['users', 'cabinets']
+
+logger = logging.getLogger(__name__)
+
+
+class AccessMap:
+    # (user_id, cabinet_id) pairs allowed to unlock, so unlock decisions are a set lookup without any query : loaded at startup,
+    # then kept up to date with the rows updated since the last refresh and the changes made through this worker
+    def __init__(self, session_factory: sessionmaker, refresh_interval: float = ACCESS_REFRESH_INTERVAL,
+                 full_reload_interval: float = ACCESS_FULL_RELOAD_INTERVAL):
+        self.session_factory = session_factory
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self.granted = set()
+        self.last_change = None # updated_at of the latest permission read, by the database clock
+        self.versions = None # of CASCADING_TABLES at the last full load
+        self.loaded_at = None
+        self._task = None
+
+    async def start(self):
+        await asyncio.to_thread(self.load)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def allows(self, user_id: str, cabinet_id: str):
+        return (user_id, cabinet_id) in self.granted
+
+    def apply(self, permissions: list):
+        # (user_id, cabinet_id, granted, updated_at) rows, or changes made here with updated_at None
+        for user_id, cabinet_id, granted, updated_at in permissions:
+            if granted:
+                self.granted.add((user_id, cabinet_id))
+            else:
+                self.granted.discard((user_id, cabinet_id))
+            if updated_at is not None and (self.last_change is None or updated_at > self.last_change):
+                self.last_change = updated_at
+
+    def forget_user(self, user_id: str):
+        self.granted = {pair for pair in self.granted if pair[0] != user_id}
+
+    def forget_cabinet(self, cabinet_id: str):
+        self.granted = {pair for pair in self.granted if pair[1] != cabinet_id}
+
+    def load(self):
+        with self.session_factory() as db:
+            versions = [version for table, version, modified_at in crud.get_table_versions(db, CASCADING_TABLES)] # read first, a deletion in between only reloads again
+            permissions = crud.get_cabinet_permissions(db)
+        self.granted = {(user_id, cabinet_id) for user_id, cabinet_id, granted, updated_at in permissions} # swapped at once, decisions never see a partial map
+        self.last_change = max((updated_at for user_id, cabinet_id, granted, updated_at in permissions), default=None)
+        self.versions = versions
+        self.loaded_at = time.monotonic()
+
+    def changes(self):
+        # permissions updated since a bit before the last change seen, applied by the event loop, None when users or cabinets were
+        # deleted or created since the last full load
+        with self.session_factory() as db:
+            if [version for table, version, modified_at in crud.get_table_versions(db, CASCADING_TABLES)] != self.versions:
+                return None
+            return crud.get_cabinet_permissions(db, self.last_change - datetime.timedelta(seconds=ACCESS_REFRESH_OVERLAP))
+
+    async def refresh(self):
+        if self.last_change is not None and time.monotonic() - self.loaded_at < self.full_reload_interval:
+            permissions = await asyncio.to_thread(self.changes)
+            if permissions is not None:
+                return self.apply(permissions)
+        await asyncio.to_thread(self.load)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Could not refresh the cabinet permissions, retrying later")
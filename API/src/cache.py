@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '60')) # seconds, bounds how long another worker's deletes go unnoticed
+CACHE_MAXSIZE = int(os.environ.get('CACHE_MAXSIZE', '10000')) # keys per table
+
+
+class KeyCache:
+    # bounded LRU set of the keys known to exist in a table, entries expire after ttl seconds
+    def __init__(self, maxsize: int = CACHE_MAXSIZE, ttl: float = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._expires = OrderedDict()
+        self._lock = threading.Lock() # also used from worker threads
+
+    def known(self, key):
+        with self._lock:
+            expires = self._expires.get(key)
+            if expires is not None and expires > time.monotonic():
+                self._expires.move_to_end(key)
+                self.hits += 1
+                return True
+            if expires is not None:
+                del self._expires[key]
+            self.misses += 1
+            return False
+
+    def add(self, *keys):
+        with self._lock:
+            expires = time.monotonic() + self.ttl
+            for key in keys:
+                self._expires[key] = expires
+                self._expires.move_to_end(key)
+            while len(self._expires) > self.maxsize:
+                self._expires.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._expires.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._expires)}
+
+users = KeyCache()
+cabinets = KeyCache()
+categories = KeyCache()
+items = KeyCache()
+
+def clear():
+    for key_cache in (users, cabinets, categories, items):
+        key_cache.clear()
+
+def stats():
+    return {'users': users.stats(), 'cabinets': cabinets.stats(), 'categories': categories.stats(), 'items': items.stats()}
@@ -0,0 +1,141 @@
+import asyncio
+import asyncpg
+import json
+import logging
+import os
+
+from collections import defaultdict
+
+
+CHANGES_BACKEND = os.environ.get('CHANGES_BACKEND', 'memory') # postgres fans the events out to every worker through LISTEN/NOTIFY
+CHANGES_CHANNEL = os.environ.get('CHANGES_CHANNEL', 'cabinet_changes')
+CHANGES_QUEUE_SIZE = int(os.environ.get('CHANGES_QUEUE_SIZE', '100')) # events kept for a slow subscriber before it is told to resync
+CHANGES_KEEPALIVE = float(os.environ.get('CHANGES_KEEPALIVE', '15')) # seconds between comments sent on an idle stream
+CHANGES_RECONNECT_MAX = float(os.environ.get('CHANGES_RECONNECT_MAX', '30')) # seconds, longest wait between attempts to listen again after losing the connection
+NOTIFY_MAX_PAYLOAD = 7900 # bytes, Postgres refuses NOTIFY payloads over 8000
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    # in-process fan-out of cabinet events to the queues of the streams subscribed to the cabinet
+    def __init__(self, queue_size: int = CHANGES_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = defaultdict(set)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, cabinet_id: str):
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers[cabinet_id].add(queue)
+        return queue
+
+    def unsubscribe(self, cabinet_id: str, queue: asyncio.Queue):
+        self.subscribers[cabinet_id].discard(queue)
+        if not self.subscribers[cabinet_id]:
+            del self.subscribers[cabinet_id]
+
+    async def publish(self, cabinet_id: str, type: str, data):
+        self._dispatch({'type': type, 'cabinet_id': cabinet_id, 'data': data})
+
+    def _dispatch(self, event: dict):
+        for queue in self.subscribers.get(event['cabinet_id'], ()):
+            if queue.full(): # the subscriber missed events, it has to read the cabinet again
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({'type': 'resync', 'cabinet_id': event['cabinet_id'], 'data': None})
+            else:
+                queue.put_nowait(event)
+
+class PostgresBroadcaster(Broadcaster):
+    # events go through NOTIFY on channel and come back to every worker listening on it, this one included,
+    # a lost connection is opened again in the background and the subscribers are told to resync
+    def __init__(self, dsn: str, channel: str = CHANGES_CHANNEL, queue_size: int = CHANGES_QUEUE_SIZE,
+                 reconnect_delay: float = 0.5, reconnect_max: float = CHANGES_RECONNECT_MAX):
+        super().__init__(queue_size)
+        self.dsn = dsn
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max = reconnect_max
+        self.connection = None
+        self._lock = asyncio.Lock()
+        self._lost = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        # an unreachable database doesn't stop the application, listening is retried in the background
+        try:
+            await self._connect()
+        except Exception:
+            logger.exception("Could not listen on %s, retrying in the background", self.channel)
+        self._task = asyncio.create_task(self._reconnect())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+    async def publish(self, cabinet_id: str, type: str, data):
+        if self.connection is None or self.connection.is_closed():
+            raise ConnectionError(f"Not connected to {self.channel}")
+        payload = json.dumps({'type': type, 'cabinet_id': cabinet_id, 'data': data})
+        if len(payload.encode()) > NOTIFY_MAX_PAYLOAD:
+            payload = json.dumps({'type': 'resync', 'cabinet_id': cabinet_id, 'data': None})
+        async with self._lock: # one query at a time on the connection
+            await self.connection.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+
+    async def _connect(self):
+        connection = await asyncpg.connect(self.dsn)
+        self._lost.clear()
+        connection.add_termination_listener(lambda connection: self._lost.set())
+        await connection.add_listener(self.channel, self._notified)
+        self.connection = connection
+
+    async def _reconnect(self):
+        delay = self.reconnect_delay
+        while True:
+            if self.connection is not None:
+                await self._lost.wait()
+                logger.warning("Lost the connection listening on %s, reconnecting", self.channel)
+                self.connection = None
+            try:
+                await self._connect()
+            except Exception:
+                logger.warning("Could not listen on %s, retrying in %ss", self.channel, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max)
+                continue
+            delay = self.reconnect_delay
+            for cabinet_id in list(self.subscribers): # events may have been missed while not listening
+                self._dispatch({'type': 'resync', 'cabinet_id': cabinet_id, 'data': None})
+
+    def _notified(self, connection, pid, channel, payload):
+        self._dispatch(json.loads(payload))
+
+def make_broadcaster(dsn: str):
+    return PostgresBroadcaster(dsn) if CHANGES_BACKEND == 'postgres' else Broadcaster()
+
+async def stream(broadcaster: Broadcaster, request, cabinet_id: str):
+    # Server-Sent Events of a cabinet until the client disconnects
+    queue = broadcaster.subscribe(cabinet_id)
+    try:
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(queue.get(), CHANGES_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+    finally:
+        broadcaster.unsubscribe(cabinet_id, queue)
@@ -1,42 +1,220 @@
-import models, schemas
-
-from sqlalchemy.orm import Session
+import datetime
+import os
+import models, schemas, search
+
+from collections import defaultdict
+from sqlalchemy import bindparam, delete, func, insert, literal, literal_column, or_, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, noload, selectinload
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+FAST_READS = os.environ.get('FAST_READS', '1') == '1' # pages of whole tables rows are read as plain column tuples and encoded by main without pydantic
+
+def paginate(query, key, cursor=None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    # keyset pagination : rows are ordered by key and the page starts right after the cursor
+    # expand names relationships of the queried objects, each one loaded for the whole page with one more query
+    description, = query.column_descriptions if len(query.column_descriptions) == 1 else (None,)
+    if expand:
+        query = query.options(*[selectinload(getattr(description['entity'], relationship)) for relationship in expand], noload('*'))
+    elif FAST_READS and description is not None and description['expr'] is description['entity']: # a query of mapped objects
+        query = query.with_entities(*description['entity'].__table__.columns) # skips hydration and the identity map
+    if cursor is not None:
+        query = query.filter(key > cursor)
+    rows = query.order_by(key).limit(limit + 1).all()
+    next_cursor = str(getattr(rows[limit - 1], key.key)) if len(rows) > limit else None
+    return {'items': rows[:limit], 'next_cursor': next_cursor}
+
+def insert_returning(db: Session, model, values: dict, conflict_target: list = None, commit: bool = True):
+    # a single INSERT ... RETURNING, a conflict on conflict_target returns None and foreign key violations raise IntegrityError
+    if db.get_bind().dialect.name != 'postgresql': # SQLite stand-ins, SQLAlchemy 1.4 has no RETURNING for them
+        db_object = model(**values)
+        db.add(db_object)
+        try:
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            if conflict_target:
+                return None
+            raise
+        if commit:
+            db.commit()
+        db.refresh(db_object)
+        return db_object
+    statement = postgresql.insert(model).values(**values)
+    if conflict_target:
+        statement = statement.on_conflict_do_nothing(index_elements=conflict_target)
+    try:
+        row = db.execute(statement.returning(*model.__table__.columns)).first()
+        if commit:
+            db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise
+    return row
+
+def insert_many_returning(db: Session, model, rows: list, conflict_target: list, key):
+    # multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING, MAX_PAGE_SIZE rows per statement to stay under the driver's parameter limits,
+    # returns the conflict_target value and key of each inserted row, the caller commits
+    target = getattr(model, conflict_target[0])
+    inserted = []
+    for start in range(0, len(rows), MAX_PAGE_SIZE):
+        chunk = rows[start:start + MAX_PAGE_SIZE]
+        if db.get_bind().dialect.name != 'postgresql': # SQLite stand-ins, SQLAlchemy 1.4 has no RETURNING for them
+            db.execute(sqlite.insert(model).values(chunk).on_conflict_do_nothing(index_elements=conflict_target))
+            inserted += db.query(target, key).filter(target.in_([row[conflict_target[0]] for row in chunk])).all()
+        else:
+            statement = postgresql.insert(model).values(chunk).on_conflict_do_nothing(index_elements=conflict_target)
+            inserted += db.execute(statement.returning(target, key)).all()
+    return inserted
+
+def upsert(db: Session, model, rows: list, index_elements: list, set_):
+    # INSERT ... ON CONFLICT DO UPDATE, set_ maps the updated columns to expressions of the inserted row (excluded)
+    dialect = postgresql if db.get_bind().dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(model).values(rows)
+    db.execute(statement.on_conflict_do_update(index_elements=index_elements, set_=set_(statement.excluded)))
+
+def get_by_keys(db: Session, key, keys: list):
+    # one query for all keys, objects come back in the order of keys and the keys matching none are reported
+    found = {getattr(db_object, key.key): db_object for db_object in db.query(key.class_).filter(key.in_(keys))}
+    keys = list(dict.fromkeys(keys))
+    return {'items': [found[key] for key in keys if key in found], 'not_found': [key for key in keys if key not in found]}
+
+def stream(db: Session, statement, batch_size: int):
+    # rows of a select as dicts, fetched batch_size at a time through a server-side cursor so memory stays flat however many there are
+    result = db.execute(statement.execution_options(stream_results=True)).mappings()
+    for rows in result.partitions(batch_size):
+        yield rows
+
+def violated_constraint(error: IntegrityError):
+    # name of the constraint behind an IntegrityError, from psycopg2 or asyncpg
+    diag = getattr(error.orig, 'diag', None)
+    if diag is not None:
+        return diag.constraint_name
+    return getattr(error.orig.__cause__, 'constraint_name', None)
+
+def delete_by_keys(db: Session, key, keys: list, commit: bool = True, columns: list = None):
+    # a single DELETE ... RETURNING, cascades are left to the ON DELETE rules of the database, returns the deleted keys
+    # or, when columns are given, the deleted rows with those columns
+    statement = delete(key.class_).where(key.in_(keys)).execution_options(synchronize_session=False)
+    if db.get_bind().dialect.name != 'postgresql': # SQLite stand-ins, SQLAlchemy 1.4 has no RETURNING for them
+        deleted = db.query(*(columns or [key])).filter(key.in_(keys)).all()
+        db.execute(statement)
+    else:
+        deleted = db.execute(statement.returning(*(columns or [key]))).all()
+    if columns is None:
+        deleted = [deleted_key for deleted_key, in deleted]
+    if commit:
+        db.commit()
+    return deleted
+
+def ping(db: Session):
+    db.execute(text("SELECT 1"))
+
+def bump_versions(db: Session, *tables: str):
+    # one more version for each table, in the caller's transaction so it is seen once the change commits,
+    # rows are locked in name order so transactions bumping several tables can't deadlock
+    now = datetime.datetime.now(datetime.timezone.utc)
+    upsert(db, models.TableVersion, [{'table_name': table, 'version': 1, 'modified_at': now} for table in sorted(tables)], ['table_name'],
+           lambda excluded: {'version': models.TableVersion.version + 1, 'modified_at': excluded.modified_at})
+
+def get_table_versions(db: Session, tables: list):
+    # (table, version, modified_at) of each table, tables never bumped are at version 0
+    found = {row.table_name: row for row in db.query(models.TableVersion.table_name, models.TableVersion.version, models.TableVersion.modified_at).filter(models.TableVersion.table_name.in_(tables))}
+    return [(table, found[table].version, found[table].modified_at) if table in found else (table, 0, None) for table in tables]
+
+def insert_bumping(db: Session, model, values: dict, conflict_target: list):
+    # insert_returning, bumping the version of the table when a row was inserted
+    db_object = insert_returning(db, model, values, conflict_target=conflict_target, commit=False)
+    if db_object is not None:
+        bump_versions(db, model.__tablename__)
+    db.commit()
+    return db_object
 
+def delete_bumping(db: Session, key, keys: list, *tables: str):
+    # delete_by_keys, bumping the version of the table and of the tables its ON DELETE rules change when rows were deleted
+    deleted = delete_by_keys(db, key, keys, commit=False)
+    if deleted:
+        bump_versions(db, key.class_.__tablename__, *tables)
+    db.commit()
+    return deleted
 
 # USERS
 
-def get_all_users(db: Session):
-    return db.query(models.User).all()
+def get_all_users(db: Session, cursor: str = None, limit: int = DEFAULT_PAGE_SIZE):
+    return paginate(db.query(models.User), models.User.uid, cursor, limit)
 
 def get_user_by_uid(db: Session, uid: str):
     return db.query(models.User).filter(models.User.uid == uid).first()
 
+def get_all_user_uids(db: Session):
+    return {uid for uid, in db.query(models.User.uid)}
+
+def get_existing_user_uids(db: Session, uids):
+    return {uid for uid, in db.query(models.User.uid).filter(models.User.uid.in_(uids))}
+
+def get_users_by_uids(db: Session, uids: list):
+    return get_by_keys(db, models.User.uid, uids)
+
 def create_user(db: Session, user: schemas.UserCreate):
-    db_user = models.User(uid=user.uid, firstname=user.firstname, lastname=user.lastname)
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
+    return insert_bumping(db, models.User, user.dict(), conflict_target=['uid'])
+
+def delete_users(db: Session, uids: list):
+    return delete_bumping(db, models.User.uid, uids)
 
 # CABINETS
 
-def get_all_cabinets(db: Session):
-    return db.query(models.Cabinet).all()
+def get_all_cabinets(db: Session, cursor: str = None, limit: int = DEFAULT_PAGE_SIZE):
+    return paginate(db.query(models.Cabinet), models.Cabinet.id, cursor, limit)
 
 def get_cabinet_by_id(db: Session, id: str):
     return db.query(models.Cabinet).filter(models.Cabinet.id == id).first()
 
+def get_all_cabinet_ids(db: Session):
+    return {id for id, in db.query(models.Cabinet.id)}
+
+def get_existing_cabinet_ids(db: Session, ids):
+    return {id for id, in db.query(models.Cabinet.id).filter(models.Cabinet.id.in_(ids))}
+
+def get_cabinets_by_ids(db: Session, ids: list):
+    return get_by_keys(db, models.Cabinet.id, ids)
+
 def create_cabinet(db: Session, cabinet: schemas.CabinetCreate):
-    db_cabinet = models.Cabinet(id=cabinet.id, description=cabinet.description)
-    db.add(db_cabinet)
-    db.commit()
-    db.refresh(db_cabinet)
-    return db_cabinet
+    return insert_bumping(db, models.Cabinet, cabinet.dict(), conflict_target=['id'])
+
+def delete_cabinets(db: Session, ids: list):
+    return delete_bumping(db, models.Cabinet.id, ids)
+
+# CABINET PERMISSIONS
+
+def get_cabinet_permissions(db: Session, since=None):
+    # (user_id, cabinet_id, granted, updated_at) of the granted permissions, or of every permission updated since since, revoked ones included
+    permission = models.CabinetPermission
+    query = db.query(permission.user_id, permission.cabinet_id, permission.granted, permission.updated_at)
+    return query.filter(permission.granted if since is None else permission.updated_at >= since).all()
+
+def get_permitted_user_uids(db: Session, cabinet_id: str):
+    permission = models.CabinetPermission
+    return [uid for uid, in db.query(permission.user_id).filter(permission.cabinet_id == cabinet_id, permission.granted).order_by(permission.user_id)]
+
+def set_cabinet_permissions(db: Session, cabinet_id: str, uids: list, granted: bool):
+    # grants or revokes the permissions of users on the cabinet in one upsert, unknown users or cabinets raise IntegrityError
+    if not uids:
+        return
+    try:
+        upsert(db, models.CabinetPermission, [{'user_id': uid, 'cabinet_id': cabinet_id, 'granted': granted, 'updated_at': func.now()} for uid in uids],
+               ['user_id', 'cabinet_id'], lambda excluded: {'granted': excluded.granted, 'updated_at': excluded.updated_at})
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise
 
 # CATEGORIES
 
-def get_all_categories(db: Session):
-    return db.query(models.Category).all()
+def get_all_categories(db: Session, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    return paginate(db.query(models.Category), models.Category.id, cursor, limit)
 
 def get_category_by_id(db: Session, id: int):
     return db.query(models.Category).filter(models.Category.id == id).first()
@@ -44,23 +222,38 @@ def get_category_by_id(db: Session, id: int):
 def get_category_by_title(db: Session, title: str):
     return db.query(models.Category).filter(models.Category.title == title).first()
 
-def get_root_categories(db: Session):
-    return db.query(models.Category).filter(models.Category.parent_id == None).all()
+def get_root_categories(db: Session, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    return paginate(db.query(models.Category).filter(models.Category.parent_id == None), models.Category.id, cursor, limit)
+
+def get_sub_categories(db: Session, parent_id: int, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    return paginate(db.query(models.Category).filter(models.Category.parent_id == parent_id), models.Category.id, cursor, limit)
+
+def category_subtree(category_id: int):
+    # recursive CTE holding the ids of a category and of all its descendants, UNION stops on cycles
+    subtree = select(models.Category.id).where(models.Category.id == category_id).cte('subtree', recursive=True)
+    return subtree.union(select(models.Category.id).where(models.Category.parent_id == subtree.c.id))
+
+def get_descendant_categories(db: Session, category_id: int, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    subtree = category_subtree(category_id)
+    query = db.query(models.Category).join(subtree, models.Category.parent_id == subtree.c.id) # children of the subtree nodes, so every node but its root
+    return paginate(query, models.Category.id, cursor, limit)
 
-def get_sub_categories(db: Session, parent_id: int):
-    return db.query(models.Category).filter(models.Category.parent_id == parent_id).all()
+def get_ancestor_categories(db: Session, category_id: int):
+    # from the root category down to the direct parent, for breadcrumbs
+    ancestors = select(models.Category.parent_id, literal(1).label('depth')).where(models.Category.id == category_id).cte('ancestors', recursive=True)
+    ancestors = ancestors.union_all(select(models.Category.parent_id, ancestors.c.depth + 1).where(models.Category.id == ancestors.c.parent_id))
+    return db.query(models.Category).join(ancestors, models.Category.id == ancestors.c.parent_id).order_by(ancestors.c.depth.desc()).all()
 
 def create_category(db: Session, category: schemas.CategoryCreate):
-    db_category = models.Category(title=category.title, description=category.description, parent_id=category.parent_id)
-    db.add(db_category)
-    db.commit()
-    db.refresh(db_category)
-    return db_category
+    return insert_bumping(db, models.Category, category.dict(), conflict_target=['title'])
+
+def delete_categories(db: Session, ids: list):
+    return delete_bumping(db, models.Category.id, ids, 'items') # the items of the deleted categories lose their category_id
 
 # ITEMS
 
-def get_all_items(db: Session):
-    return db.query(models.Item).all()
+def get_all_items(db: Session, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    return paginate(db.query(models.Item), models.Item.id, cursor, limit)
 
 def get_item_by_id(db: Session, id: int):
     return db.query(models.Item).filter(models.Item.id == id).first()
@@ -68,75 +261,364 @@ def get_item_by_id(db: Session, id: int):
 def get_item_by_title(db: Session, title: str):
     return db.query(models.Item).filter(models.Item.title == title).first()
 
-def get_items_by_category_id(db: Session, category_id: int):
-    return db.query(models.Item).filter(models.Item.category_id == category_id).all()
+# the expression of the ix_items_search index, see DB/migrations/008_items_search.sql
+ITEM_DOCUMENT = literal_column(f"to_tsvector('{search.SEARCH_CONFIG}', coalesce(items.title, '') || ' ' || coalesce(items.description, ''))")
+
+_trigrams = {} # whether pg_trgm is installed, per database url
+
+def has_trigrams(db: Session):
+    url = str(db.get_bind().engine.url)
+    if url not in _trigrams:
+        _trigrams[url] = db.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+    return _trigrams[url]
+
+def search_items(db: Session, q: str, limit: int = DEFAULT_PAGE_SIZE):
+    # items whose title or description hold every word of q, the last ones as prefixes for autocompletion, or whose title is close
+    # to q when pg_trgm is installed, best matches first, elsewhere the items are scored in memory by search.score once a LIKE
+    # per word has kept those holding the word or, for a misspelt one, one of its trigrams in their title
+    words = search.tokenize(q)
+    if not words:
+        return []
+    if db.get_bind().dialect.name != 'postgresql':
+        document = func.lower(func.coalesce(models.Item.title, '') + ' ' + func.coalesce(models.Item.description, ''))
+        title = func.lower(models.Item.title)
+        candidates = db.query(models.Item).filter(*[or_(document.contains(word, autoescape=True), *[title.contains(trigram, autoescape=True) for trigram in search.trigrams(word)])
+                                                     for word in words])
+        scored = [(search.score(words, item.title, item.description), item) for item in candidates]
+        return [item for score, item in sorted(scored, key=lambda scored: (-scored[0], scored[1].id)) if score > 0][:limit]
+    query = func.to_tsquery(literal_column(f"'{search.SEARCH_CONFIG}'"), search.prefix_query(words))
+    condition = ITEM_DOCUMENT.op('@@')(query)
+    rank = func.ts_rank(ITEM_DOCUMENT, query)
+    if has_trigrams(db):
+        condition = or_(condition, literal(q).op('<%')(models.Item.title))
+        rank = rank + func.word_similarity(q, models.Item.title)
+    return db.query(models.Item).filter(condition).order_by(rank.desc(), models.Item.id).limit(limit).all()
+
+def get_items_by_category_id(db: Session, category_id: int, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    return paginate(db.query(models.Item).filter(models.Item.category_id == category_id), models.Item.id, cursor, limit)
+
+def get_items_by_category_subtree(db: Session, category_id: int, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    subtree = category_subtree(category_id)
+    return paginate(db.query(models.Item).join(subtree, models.Item.category_id == subtree.c.id), models.Item.id, cursor, limit)
+
+def get_items_by_ids(db: Session, ids: list):
+    return get_by_keys(db, models.Item.id, ids)
+
+def import_items(db: Session, items: dict):
+    # items maps row numbers to ItemCreate, categories and titles are checked for all rows at once and the valid rows
+    # are inserted in one statement and one transaction, returns the created ids and the errors by row number
+    category_ids = {id for id, in db.query(models.Category.id).filter(models.Category.id.in_({item.category_id for item in items.values()}))}
+    titles = {title for title, in db.query(models.Item.title).filter(models.Item.title.in_([item.title for item in items.values()]))}
+    valid, errors = {}, []
+    for row, item in items.items():
+        if item.category_id is not None and item.category_id not in category_ids:
+            errors.append({'row': row, 'detail': "Category not found"})
+        elif item.title in titles:
+            errors.append({'row': row, 'detail': "Item already exists"})
+        else:
+            titles.add(item.title)
+            valid[item.title] = row
+    created = insert_many_returning(db, models.Item, [items[row].dict() for row in valid.values()], ['title'], models.Item.id) if valid else []
+    if created:
+        bump_versions(db, 'items')
+    db.commit()
+    created = [{'row': valid.pop(title), 'id': id} for title, id in created]
+    errors += [{'row': row, 'detail': "Item already exists"} for row in valid.values()] # created concurrently
+    return {'created': sorted(created, key=lambda row: row['row']), 'errors': sorted(errors, key=lambda row: row['row'])}
 
 def create_item(db: Session, item: schemas.ItemCreate):
-    db_item = models.Item(title=item.title, description=item.description, price=item.price, link=item.link, category_id=item.category_id)
-    db.add(db_item)
-    db.commit()
-    db.refresh(db_item)
-    return db_item
+    return insert_bumping(db, models.Item, item.dict(), conflict_target=['title'])
+
+def delete_items(db: Session, ids: list):
+    return delete_bumping(db, models.Item.id, ids)
 
 # ORDER REQUESTS
 
-def get_all_order_requests(db: Session):
-    return db.query(models.OrderRequest).all()
+def get_all_order_requests(db: Session, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.OrderRequest), models.OrderRequest.id, cursor, limit, expand)
 
 def get_order_request_by_id(db: Session, id: int):
     return db.query(models.OrderRequest).filter(models.OrderRequest.id == id).first()
 
-def get_order_requests_by_item_id(db: Session, item_id: int):
-    return db.query(models.OrderRequest).filter(models.OrderRequest.item_id == item_id).all()
+def get_order_requests_by_item_id(db: Session, item_id: int, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.OrderRequest).filter(models.OrderRequest.item_id == item_id), models.OrderRequest.id, cursor, limit, expand)
     
-def get_order_requests_by_user_id(db: Session, uid: str):
-    return db.query(models.OrderRequest).filter(models.OrderRequest.user_id == uid).all()
-
-def get_order_requests_by_state(db: Session, state: int):
-    return db.query(models.OrderRequest).filter(models.OrderRequest.state == state).all()
-
-def create_order_request(db: Session, order_request: schemas.OrderRequest):
-    db_order_request = models.OrderRequest(item_id=order_request.item_id, user_id=order_request.user_id)
-    db.add(db_order_request)
+def get_order_requests_by_user_id(db: Session, uid: str, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.OrderRequest).filter(models.OrderRequest.user_id == uid), models.OrderRequest.id, cursor, limit, expand)
+
+def get_order_requests_by_state(db: Session, state: int, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.OrderRequest).filter(models.OrderRequest.state == state), models.OrderRequest.id, cursor, limit, expand)
+
+def select_order_requests(state: int = None, item_id: int = None, user_id: str = None, start=None, end=None):
+    order_request = models.OrderRequest
+    statement = select(*order_request.__table__.columns).order_by(order_request.id)
+    if state is not None:
+        statement = statement.where(order_request.state == state)
+    if item_id is not None:
+        statement = statement.where(order_request.item_id == item_id)
+    if user_id is not None:
+        statement = statement.where(order_request.user_id == user_id)
+    if start is not None:
+        statement = statement.where(order_request.date >= start)
+    if end is not None:
+        statement = statement.where(order_request.date < end)
+    return statement
+
+def create_order_request(db: Session, order_request: schemas.OrderRequestCreate):
+    return insert_returning(db, models.OrderRequest, order_request.dict(), conflict_target=['item_id', 'user_id'])
+
+def transition_order_requests(db: Session, state: int, ids: list = None, item_id: int = None, user_id: str = None, from_state: int = None):
+    # moves the selected order requests to state in a single statement, the rows whose current state has no transition
+    # to it in order_request_transitions are left as they are and reported as rejected
+    order_request = models.OrderRequest
+    selected = []
+    if ids is not None:
+        selected.append(order_request.id.in_(ids))
+    if item_id is not None:
+        selected.append(order_request.item_id == item_id)
+    if user_id is not None:
+        selected.append(order_request.user_id == user_id)
+    if from_state is not None:
+        selected.append(order_request.state == from_state)
+    allowed = order_request.state.in_(select(models.OrderRequestTransition.from_state).where(models.OrderRequestTransition.to_state == state))
+    if db.get_bind().dialect.name != 'postgresql': # SQLite stand-ins, SQLAlchemy 1.4 has no RETURNING for them, writes are serialized anyway
+        rows = db.query(order_request.id, allowed.label('allowed')).filter(*selected).order_by(order_request.id).all()
+        db.execute(update(order_request).where(*selected, allowed).values(state=state).execution_options(synchronize_session=False))
+    else:
+        # one statement : the selected rows are locked with whether their state may move to state, and the allowed ones updated,
+        # no id list goes back and forth however many rows the filters select
+        locked = select(order_request.id, allowed.label('allowed')).where(*selected).with_for_update().cte('selected')
+        updated = update(order_request).where(order_request.id == locked.c.id, locked.c.allowed).values(state=state).returning(order_request.id).cte('updated')
+        rows = db.execute(select(locked.c.id, updated.c.id.isnot(None)).outerjoin(updated, updated.c.id == locked.c.id).order_by(locked.c.id)).all()
     db.commit()
-    db.refresh(db_order_request)
-    return db_order_request
+    updated = [id for id, was_updated in rows if was_updated]
+    rejected = [id for id, was_updated in rows if not was_updated]
+    not_found = [id for id in dict.fromkeys(ids) if id not in updated and id not in rejected] if ids is not None else []
+    return {'updated': updated, 'rejected': rejected, 'not_found': not_found}
+
+def delete_order_requests(db: Session, ids: list):
+    return delete_by_keys(db, models.OrderRequest.id, ids)
 
 # STORAGE UNITS
 
-def get_all_storage_units(db: Session):
-    return db.query(models.StorageUnit).all()
+def get_all_storage_units(db: Session, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.StorageUnit), models.StorageUnit.id, cursor, limit, expand)
 
 def get_storage_unit_by_id(db: Session, id: int):
     return db.query(models.StorageUnit).filter(models.StorageUnit.id == id).first()
 
-def get_storage_units_by_cabinet_id(db: Session, cabinet_id: str):
-    return db.query(models.StorageUnit).filter(models.StorageUnit.cabinet_id == cabinet_id).all()
-
-def create_storage_unit(db: Session, storage_unit: schemas.StorageUnit):
-    db_storage_unit = models.StorageUnit(id = storage_unit.id, state=storage_unit.state, verified=storage_unit.verified, item_id=storage_unit.item_id, cabinet_id=storage_unit.cabinet_id)
-    db.add(db_storage_unit)
+def get_storage_units_by_cabinet_id(db: Session, cabinet_id: str, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.StorageUnit).filter(models.StorageUnit.cabinet_id == cabinet_id), models.StorageUnit.id, cursor, limit, expand)
+
+def get_storage_units_by_ids(db: Session, ids: list):
+    return get_by_keys(db, models.StorageUnit.id, ids)
+
+def import_storage_units(db: Session, storage_units: dict):
+    # storage_units maps row numbers to StorageUnitCreate, same as import_items
+    item_ids = {id for id, in db.query(models.Item.id).filter(models.Item.id.in_({storage_unit.item_id for storage_unit in storage_units.values()}))}
+    cabinet_ids = {id for id, in db.query(models.Cabinet.id).filter(models.Cabinet.id.in_({storage_unit.cabinet_id for storage_unit in storage_units.values()}))}
+    ids = {id for id, in db.query(models.StorageUnit.id).filter(models.StorageUnit.id.in_([storage_unit.id for storage_unit in storage_units.values()]))}
+    valid, errors = {}, []
+    for row, storage_unit in storage_units.items():
+        if storage_unit.item_id not in item_ids:
+            errors.append({'row': row, 'detail': "Item not found"})
+        elif storage_unit.cabinet_id is not None and storage_unit.cabinet_id not in cabinet_ids:
+            errors.append({'row': row, 'detail': "Cabinet not found"})
+        elif storage_unit.id in ids:
+            errors.append({'row': row, 'detail': "Storage unit ID already assigned"})
+        else:
+            ids.add(storage_unit.id)
+            valid[storage_unit.id] = row
+    created = insert_many_returning(db, models.StorageUnit, [storage_units[row].dict() for row in valid.values()], ['id'], models.StorageUnit.id) if valid else []
     db.commit()
-    db.refresh(db_storage_unit)
-    return db_storage_unit
+    created = [{'row': valid[id], 'id': id, 'cabinet_id': storage_units[valid.pop(id)].cabinet_id} for id, _ in created]
+    errors += [{'row': row, 'detail': "Storage unit ID already assigned"} for row in valid.values()] # created concurrently
+    return {'created': sorted(created, key=lambda row: row['row']), 'errors': sorted(errors, key=lambda row: row['row'])}
+
+def create_storage_unit(db: Session, storage_unit: schemas.StorageUnitCreate):
+    return insert_returning(db, models.StorageUnit, storage_unit.dict(), conflict_target=['id'])
+
+def sync_cabinet_storage_units(db: Session, cabinet_id: str, storage_units: list):
+    # storage_units is the full content of the cabinet as StorageUnitSnapshot, the rows are diffed against it under a row lock and
+    # the differences applied with one insert, one update and one delete, units already known elsewhere are moved to the cabinet
+    table = models.StorageUnit.__table__
+    snapshot = {storage_unit.id: {**storage_unit.dict(), 'cabinet_id': cabinet_id} for storage_unit in storage_units}
+    current = {row['id']: dict(row) for row in db.execute(select(table).where(or_(table.c.cabinet_id == cabinet_id, table.c.id.in_(list(snapshot)))).with_for_update()).mappings()}
+    created = [row for id, row in snapshot.items() if id not in current]
+    updated = [row for id, row in snapshot.items() if id in current and current[id] != row]
+    deleted = [id for id in current if id not in snapshot]
+    if created:
+        db.execute(insert(table), created)
+    if updated:
+        statement = update(table).where(table.c.id == bindparam('b_id')).values({column: bindparam(f'b_{column}') for column in ('state', 'verified', 'item_id', 'cabinet_id')})
+        db.execute(statement, [{f'b_{column}': value for column, value in row.items()} for row in updated])
+    if deleted:
+        db.execute(delete(table).where(table.c.id.in_(deleted)))
+    db.commit()
+    return {'created': sorted(row['id'] for row in created), 'updated': sorted(row['id'] for row in updated), 'deleted': sorted(deleted),
+            'unchanged': len(snapshot) - len(created) - len(updated)}
+
+def delete_storage_units(db: Session, ids: list):
+    # returns the (id, cabinet_id) of the deleted storage units
+    return delete_by_keys(db, models.StorageUnit.id, ids, columns=[models.StorageUnit.id, models.StorageUnit.cabinet_id])
+
+# STOCK
+
+def storage_unit_stock(db: Session):
+    # the table counted by a trigger on PostgreSQL, the same grouped query over storage_units elsewhere
+    if db.get_bind().dialect.name == 'postgresql':
+        return models.storage_unit_stock
+    storage_unit = models.StorageUnit
+    return select(storage_unit.item_id, storage_unit.cabinet_id, func.count().label('units'),
+                  func.count().filter(storage_unit.state == 0).label('available'), func.count().filter(storage_unit.verified).label('verified')
+                  ).group_by(storage_unit.item_id, storage_unit.cabinet_id).subquery('storage_unit_stock')
+
+def stock_totals(stock):
+    return [func.coalesce(func.sum(getattr(stock.c, column)), 0).label(column) for column in ('units', 'available', 'verified')]
+
+def get_stock_by_items(db: Session, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    stock = storage_unit_stock(db)
+    query = db.query(stock.c.item_id, *stock_totals(stock)).filter(stock.c.item_id.isnot(None)).group_by(stock.c.item_id)
+    return paginate(query, stock.c.item_id, cursor, limit)
+
+def get_stock_by_item_id(db: Session, item_id: int):
+    # totals of the item and their split across cabinets
+    stock = storage_unit_stock(db)
+    cabinets = db.query(stock.c.cabinet_id, stock.c.units, stock.c.available, stock.c.verified).filter(stock.c.item_id == item_id).order_by(stock.c.cabinet_id.nullslast()).all()
+    return {'item_id': item_id, 'cabinets': cabinets, **{column: sum(getattr(row, column) for row in cabinets) for column in ('units', 'available', 'verified')}}
+
+def get_stock_by_cabinet_id(db: Session, cabinet_id: str, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    stock = storage_unit_stock(db)
+    query = db.query(stock.c.item_id, stock.c.units, stock.c.available, stock.c.verified).filter(stock.c.cabinet_id == cabinet_id).filter(stock.c.item_id.isnot(None))
+    return paginate(query, stock.c.item_id, cursor, limit)
+
+def get_stock_by_categories(db: Session, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE):
+    # stock of the items directly in each category, walked from categories so a page only reads the stock of its categories
+    stock = storage_unit_stock(db)
+    query = (db.query(models.Item.category_id, *stock_totals(stock)).select_from(models.Category).join(models.Item, models.Item.category_id == models.Category.id)
+             .join(stock, stock.c.item_id == models.Item.id).group_by(models.Item.category_id))
+    return paginate(query, models.Item.category_id, cursor, limit)
+
+def get_stock_by_category_subtree(db: Session, category_id: int):
+    # stock of the items in a category and its descendants
+    stock = storage_unit_stock(db)
+    subtree = category_subtree(category_id)
+    row = db.query(*stock_totals(stock)).join(models.Item, models.Item.id == stock.c.item_id).join(subtree, models.Item.category_id == subtree.c.id).one()
+    return {'category_id': category_id, 'units': row.units, 'available': row.available, 'verified': row.verified}
 
 # CABINETS UNLOCK ATTEMPTS
 
-def get_all_unlock_attempts(db: Session):
-    return db.query(models.CabinetUnlockAttempt).all()
+def get_all_unlock_attempts(db: Session, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.CabinetUnlockAttempt), models.CabinetUnlockAttempt.id, cursor, limit, expand)
+
+def get_unlock_attempts_by_cabinet_id(db: Session, cabinet_id : str, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.CabinetUnlockAttempt).filter(models.CabinetUnlockAttempt.cabinet_id == cabinet_id), models.CabinetUnlockAttempt.id, cursor, limit, expand)
+
+def get_unlock_attempts_by_user_id(db: Session, user_id : str, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.CabinetUnlockAttempt).filter(models.CabinetUnlockAttempt.user_id == user_id), models.CabinetUnlockAttempt.id, cursor, limit, expand)
+
+def get_unlock_attempts_by_cabinet_and_user_id(db: Session, cabinet_id: str, user_id : str, cursor: int = None, limit: int = DEFAULT_PAGE_SIZE, expand: list = ()):
+    return paginate(db.query(models.CabinetUnlockAttempt).filter(models.CabinetUnlockAttempt.cabinet_id == cabinet_id).filter(models.CabinetUnlockAttempt.user_id == user_id), models.CabinetUnlockAttempt.id, cursor, limit, expand)
+
+def select_unlock_attempts(cabinet_id: str = None, user_id: str = None, start=None, end=None):
+    unlock_attempt = models.CabinetUnlockAttempt
+    statement = select(*unlock_attempt.__table__.columns).order_by(unlock_attempt.id)
+    if cabinet_id is not None:
+        statement = statement.where(unlock_attempt.cabinet_id == cabinet_id)
+    if user_id is not None:
+        statement = statement.where(unlock_attempt.user_id == user_id)
+    if start is not None:
+        statement = statement.where(unlock_attempt.date >= start)
+    if end is not None:
+        statement = statement.where(unlock_attempt.date < end)
+    return statement
+
+def create_unlock_attempt(db: Session, unlock_attempt: schemas.CabinetUnlockAttemptCreate):
+    db_unlock_attempt = insert_returning(db, models.CabinetUnlockAttempt, unlock_attempt.dict(), commit=False)
+    add_to_unlock_attempt_rollups(db, [(db_unlock_attempt.cabinet_id, db_unlock_attempt.user_id, db_unlock_attempt.date, db_unlock_attempt.granted)])
+    db.commit()
+    return db_unlock_attempt
 
-def get_unlock_attempts_by_cabinet_id(db: Session, cabinet_id : str):
-    return db.query(models.CabinetUnlockAttempt).filter(models.CabinetUnlockAttempt.cabinet_id == cabinet_id).all()
+def create_unlock_attempts(db: Session, unlock_attempts: list):
+    # unlock_attempts are dicts with the same keys, the driver sends them as multi-row inserts
+    db.execute(insert(models.CabinetUnlockAttempt), unlock_attempts)
+    add_to_unlock_attempt_rollups(db, [(unlock_attempt['cabinet_id'], unlock_attempt['user_id'], unlock_attempt['date'], unlock_attempt['granted']) for unlock_attempt in unlock_attempts])
+    db.commit()
 
-def get_unlock_attempts_by_user_id(db: Session, user_id : str):
-    return db.query(models.CabinetUnlockAttempt).filter(models.CabinetUnlockAttempt.user_id == user_id).all()
+def add_to_unlock_attempt_rollups(db: Session, unlock_attempts: list):
+    # counts (cabinet_id, user_id, date, granted) attempts into the hourly and daily rollups, within the transaction that inserts them,
+    # periods are UTC hours and days whatever the offset of the dates, naive dates are taken as UTC like the database does
+    hourly, daily = defaultdict(lambda: [0, 0]), defaultdict(lambda: [0, 0])
+    for cabinet_id, user_id, date, granted in unlock_attempts:
+        date = date.astimezone(datetime.timezone.utc) if date.tzinfo is not None else date.replace(tzinfo=datetime.timezone.utc)
+        hour = date.replace(minute=0, second=0, microsecond=0)
+        for counts, period in ((hourly, hour), (daily, hour.date())):
+            counts[cabinet_id, user_id, period][0] += 1
+            counts[cabinet_id, user_id, period][1] += bool(granted)
+    for model, counts, period in ((models.UnlockAttemptHourly, hourly, 'hour'), (models.UnlockAttemptDaily, daily, 'day')):
+        rows = [{'cabinet_id': cabinet_id, 'user_id': user_id, period: date, 'attempts': attempts, 'granted': granted}
+                for (cabinet_id, user_id, date), (attempts, granted) in sorted(counts.items())] # in key order so concurrent batches can't deadlock
+        if rows:
+            upsert(db, model, rows, ['cabinet_id', 'user_id', period],
+                   lambda excluded: {'attempts': model.attempts + excluded.attempts, 'granted': model.granted + excluded.granted})
+
+def get_unlock_attempt_stats(db: Session, granularity: str, cabinet_id: str = None, user_id: str = None, start=None, end=None):
+    # attempts and grants per hour or per day, read from the rollups instead of cabinets_unlock_attempts
+    model = models.UnlockAttemptHourly if granularity == 'hour' else models.UnlockAttemptDaily
+    period = getattr(model, granularity)
+    query = db.query(period.label('period'), func.sum(model.attempts).label('attempts'), func.sum(model.granted).label('granted'))
+    if cabinet_id is not None:
+        query = query.filter(model.cabinet_id == cabinet_id)
+    if user_id is not None:
+        query = query.filter(model.user_id == user_id)
+    if start is not None:
+        query = query.filter(period >= start)
+    if end is not None:
+        query = query.filter(period < end)
+    periods = [{'period': row.period, 'attempts': row.attempts, 'granted': row.granted} for row in query.group_by(period).order_by(period)]
+    return {**attempt_counts(sum(row['attempts'] for row in periods), sum(row['granted'] for row in periods)),
+            'periods': [{**row, **attempt_counts(row['attempts'], row['granted'])} for row in periods]}
+
+def attempt_counts(attempts: int, granted: int):
+    return {'attempts': attempts, 'granted': granted, 'denied': attempts - granted, 'denial_rate': (attempts - granted) / attempts if attempts else 0.0}
+
+def get_unlock_attempt_busiest_hours(db: Session, cabinet_id: str):
+    # attempts per hour of the day, busiest first
+    hour = models.UnlockAttemptHourly.hour
+    if db.get_bind().dialect.name == 'postgresql':
+        hour = func.timezone('UTC', hour) # hours of the day in UTC, not in the session time zone
+    hour = func.extract('hour', hour)
+    query = db.query(hour.label('hour'), func.sum(models.UnlockAttemptHourly.attempts).label('attempts')).filter(models.UnlockAttemptHourly.cabinet_id == cabinet_id)
+    return query.group_by(hour).order_by(func.sum(models.UnlockAttemptHourly.attempts).desc(), hour).all()
+
+def delete_unlock_attempts_before(db: Session, cutoff, limit: int):
+    # deletes the oldest limit attempts made before cutoff and returns them, the caller commits
+    oldest = select(models.CabinetUnlockAttempt.id).where(models.CabinetUnlockAttempt.date < cutoff).order_by(models.CabinetUnlockAttempt.id).limit(limit)
+    columns = models.CabinetUnlockAttempt.__table__.columns
+    if db.get_bind().dialect.name != 'postgresql': # SQLite stand-ins, SQLAlchemy 1.4 has no RETURNING for them
+        rows = [dict(row) for row in db.execute(select(*columns).where(models.CabinetUnlockAttempt.id.in_(oldest))).mappings()]
+        db.execute(delete(models.CabinetUnlockAttempt).where(models.CabinetUnlockAttempt.id.in_([row['id'] for row in rows])))
+        return rows
+    statement = delete(models.CabinetUnlockAttempt).where(models.CabinetUnlockAttempt.id.in_(oldest.scalar_subquery())).returning(*columns)
+    return [dict(row) for row in db.execute(statement.execution_options(synchronize_session=False)).mappings()]
+
+def archive_unlock_attempts(db: Session, unlock_attempts: list):
+    # the caller commits, together with the deletion of the same attempts
+    if unlock_attempts:
+        db.execute(insert(models.CabinetUnlockAttemptArchive), unlock_attempts)
+
+def create_unlock_attempt_purge(db: Session, cutoff, archive: str, keep: int):
+    # returns the id of the new purge job, the jobs before the last keep ones are forgotten
+    purge = models.UnlockAttemptPurge(cutoff=cutoff, archive=archive, status='pending', deleted=0, batches=0)
+    db.add(purge)
+    db.flush()
+    db.execute(delete(models.UnlockAttemptPurge).where(models.UnlockAttemptPurge.id <= purge.id - keep).execution_options(synchronize_session=False))
+    db.commit()
+    return purge.id
 
-def get_unlock_attempts_by_cabinet_and_user_id(db: Session, cabinet_id: str, user_id : str):
-    return db.query(models.CabinetUnlockAttempt).filter(models.CabinetUnlockAttempt.cabinet_id == cabinet_id).filter(models.CabinetUnlockAttempt.user_id == user_id).all()
+def update_unlock_attempt_purge(db: Session, id: int, values: dict):
+    # the caller commits, the progress of a batch together with the batch
+    db.execute(update(models.UnlockAttemptPurge).where(models.UnlockAttemptPurge.id == id).values(values).execution_options(synchronize_session=False))
 
-def create_unlock_attempt(db: Session, unlock_attempt: schemas.CabinetUnlockAttempt):
-    db_unlock_attempt = models.CabinetUnlockAttempt(granted=unlock_attempt.granted, user_id=unlock_attempt.user_id, cabinet_id=unlock_attempt.cabinet_id)
-    db.add(db_unlock_attempt)
-    db.commit()
-    db.refresh(db_unlock_attempt)
-    return db_unlock_attempt
\ No newline at end of file
+def get_unlock_attempt_purge(db: Session, id: int):
+    return db.query(models.UnlockAttemptPurge).filter(models.UnlockAttemptPurge.id == id).first()
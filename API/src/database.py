@@ -1,13 +1,117 @@
+import asyncio
+import itertools
+import logging
+import metrics
 import os
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 
+def async_url(url: str):
+    return url.replace('postgresql://', 'postgresql+asyncpg://', 1)
+
 DATABASE_URL = os.environ['DATABASE_URL']
+DATABASE_ASYNC = os.environ.get('DATABASE_ASYNC', '0') == '1' # serve requests from an async engine instead of the threadpool
+ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL', async_url(DATABASE_URL))
+# each engine opens up to pool_size + max_overflow connections per worker process, keep workers * that under max_connections
+POOL_OPTIONS = {
+    'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', '5')),
+    'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', '10')),
+    'pool_timeout': float(os.environ.get('DATABASE_POOL_TIMEOUT', '30')), # seconds a checkout waits before failing
+    'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', '1800')), # seconds before a connection is replaced, -1 never
+    'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1', # replaces connections dropped by a database restart before using them
+}
+
+REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()] # read-only standbys serving the GET routes
+REPLICA_RETRY_INTERVAL = float(os.environ.get('DATABASE_REPLICA_RETRY_INTERVAL', '30')) # seconds an unreachable replica is left out
+REPLICA_STICKY_SECONDS = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', '5')) # seconds a client that wrote keeps reading from the primary, longer than the replication lag
+
+logger = logging.getLogger(__name__)
+
+def thread_executor():
+    # worker threads of the sync sessions, one per connection the pool can open : fewer leave free connections unused
+    # under load, more only wait for a connection, the default executor of asyncio has min(32, cpus + 4)
+    return ThreadPoolExecutor(max_workers=POOL_OPTIONS['pool_size'] + POOL_OPTIONS['max_overflow'], thread_name_prefix='database')
+
+class ThreadedSession(Session):
+    # sync session exposing the same run_sync() as AsyncSession, the call is offloaded to a worker thread of the loop's
+    # default executor, set to thread_executor() at startup
+    async def run_sync(self, fn, *args, **kwargs):
+        return await asyncio.to_thread(fn, self, *args, **kwargs)
+
+engine = create_engine(DATABASE_URL, poolclass=metrics.timed_pool(QueuePool), **POOL_OPTIONS)
+metrics.instrument(engine)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=ThreadedSession)
+
+def make_async_sessionmaker(url: str):
+    async_engine = create_async_engine(url, poolclass=metrics.timed_pool(AsyncAdaptedQueuePool), **POOL_OPTIONS)
+    metrics.instrument(async_engine.sync_engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+def make_sessionmaker(url: str):
+    replica_engine = create_engine(url, poolclass=metrics.timed_pool(QueuePool), **POOL_OPTIONS)
+    metrics.instrument(replica_engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=replica_engine, class_=ThreadedSession)
+
+AsyncSessionLocal = make_async_sessionmaker(ASYNC_DATABASE_URL) if DATABASE_ASYNC else None
+
+class ReplicaSet:
+    # round-robin over the session factories of the replicas, one found unreachable is left out for retry_interval seconds
+    def __init__(self, session_factories: list, retry_interval: float = REPLICA_RETRY_INTERVAL):
+        self.session_factories = list(session_factories)
+        self.retry_interval = retry_interval
+        self.down_until = {}
+        self._turns = itertools.count()
+
+    def __len__(self):
+        return len(self.session_factories)
+
+    def candidates(self):
+        # the replicas to try in order, starting one further than the previous call
+        if not self.session_factories:
+            return []
+        start, now = next(self._turns), time.monotonic()
+        ordered = self.session_factories[start % len(self):] + self.session_factories[:start % len(self)]
+        return [session_factory for session_factory in ordered if self.down_until.get(session_factory, 0) <= now]
+
+    def mark_down(self, session_factory):
+        logger.warning("Replica %s is unreachable, reading from the others for %ss", session_factory.kw['bind'].url, self.retry_interval)
+        self.down_until[session_factory] = time.monotonic() + self.retry_interval
+
+replicas = ReplicaSet([make_sessionmaker(url) for url in REPLICA_URLS]) # sync sessions, for the exports too in async mode
+async_replicas = ReplicaSet([make_async_sessionmaker(async_url(url)) for url in REPLICA_URLS]) if DATABASE_ASYNC else None
+
+def warm_up(engine):
+    # opens pool_size connections at startup so the first requests don't pay for them, a database that is down only logs
+    try:
+        connections = [engine.connect() for _ in range(engine.pool.size())]
+    except Exception:
+        logger.exception("Could not warm up the connection pool")
+        return 0
+    for connection in connections:
+        connection.close()
+    return len(connections)
+
+async def warm_up_async(async_engine):
+    try:
+        connections = [await async_engine.connect() for _ in range(async_engine.pool.size())]
+    except Exception:
+        logger.exception("Could not warm up the connection pool")
+        return 0
+    for connection in connections:
+        await connection.close()
+    return len(connections)
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def pool_status(pool):
+    # utilization is the share of the connections the pool may open that are in use, None with an unbounded overflow
+    capacity = pool.size() + POOL_OPTIONS['max_overflow'] if POOL_OPTIONS['max_overflow'] >= 0 else None
+    return {'size': pool.size(), 'max_overflow': POOL_OPTIONS['max_overflow'], 'checked_in': pool.checkedin(), 'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0), 'utilization': pool.checkedout() / capacity if capacity else None}
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
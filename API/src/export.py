@@ -0,0 +1,36 @@
+import csv
+import datetime
+import io
+import json
+import os
+import crud
+
+from sqlalchemy.orm import sessionmaker
+
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000')) # rows fetched from the server-side cursor, and sent, at a time
+
+MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def serialize(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+def export(session_factory: sessionmaker, statement, format: str, batch_size: int = EXPORT_BATCH_SIZE):
+    # yields the rows of statement as NDJSON or CSV text, one chunk per batch, for a StreamingResponse
+    # the session is its own since the export outlives the request's, starlette iterates it in a worker thread
+    with session_factory() as db:
+        columns = [column.name for column in statement.selected_columns]
+        if format == 'csv':
+            yield ','.join(columns) + '\r\n'
+        for rows in crud.stream(db, statement, batch_size):
+            chunk = io.StringIO()
+            if format == 'csv':
+                writer = csv.writer(chunk)
+                writer.writerows([[serialize(row[column]) for column in columns] for row in rows])
+            else:
+                for row in rows:
+                    chunk.write(json.dumps({column: serialize(row[column]) for column in columns}) + '\n')
+            yield chunk.getvalue()
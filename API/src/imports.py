@@ -0,0 +1,35 @@
+import csv
+import io
+import os
+
+from pydantic import ValidationError
+
+
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', '10000')) # rows accepted by one import request
+
+
+def read_csv(body: bytes):
+    # rows of a CSV with a header line as dicts, empty cells are missing values, a body that isn't UTF-8 or CSV raises ValueError
+    # with the byte or the row numbered like validate() at fault
+    try:
+        text = body.decode('utf-8-sig')
+    except UnicodeDecodeError as error:
+        raise ValueError(f"Not UTF-8 at byte {error.start}")
+    reader = csv.DictReader(io.StringIO(text))
+    rows = []
+    try:
+        for row in reader:
+            rows.append({column: value for column, value in row.items() if value != ''})
+    except csv.Error as error:
+        raise ValueError(f"Row {len(rows) + 1}: {error}")
+    return rows
+
+def validate(schema, rows: list):
+    # rows numbered from 1 and validated against schema, returns the valid ones by row number and the errors of the others
+    valid, errors = {}, []
+    for row, values in enumerate(rows, 1):
+        try:
+            valid[row] = schema.parse_obj(values)
+        except ValidationError as error:
+            errors.append({'row': row, 'detail': '; '.join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())})
+    return valid, errors
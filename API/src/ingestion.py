@@ -0,0 +1,155 @@
+import asyncio
+import datetime
+import glob
+import json
+import logging
+import os
+import uuid
+import cache, crud
+
+from sqlalchemy.orm import sessionmaker
+
+
+UNLOCK_ATTEMPTS_WRITE_BEHIND = os.environ.get('UNLOCK_ATTEMPTS_WRITE_BEHIND', '0') == '1' # queue POST /unlock-attempt/ instead of inserting it right away
+UNLOCK_ATTEMPTS_BATCH_SIZE = int(os.environ.get('UNLOCK_ATTEMPTS_BATCH_SIZE', '500'))
+UNLOCK_ATTEMPTS_FLUSH_INTERVAL = float(os.environ.get('UNLOCK_ATTEMPTS_FLUSH_INTERVAL', '1.0')) # seconds
+UNLOCK_ATTEMPTS_MAX_QUEUED = int(os.environ.get('UNLOCK_ATTEMPTS_MAX_QUEUED', '50000')) # events waiting for a flush before new ones are refused
+UNLOCK_ATTEMPTS_SPOOL = os.environ.get('UNLOCK_ATTEMPTS_SPOOL', 'unlock_attempts.spool') # prefix of the files unflushed events are kept in across restarts
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def insert_unlock_attempts(session_factory: sessionmaker, events: list):
+    # returns the events inserted
+    with session_factory() as db:
+        # users or cabinets deleted since their events were queued would fail the whole batch, their attempts are dropped
+        # like the database cascade would have done
+        user_uids = crud.get_existing_user_uids(db, {event['user_id'] for event in events})
+        cabinet_ids = crud.get_existing_cabinet_ids(db, {event['cabinet_id'] for event in events})
+        events = [event for event in events if event['user_id'] in user_uids and event['cabinet_id'] in cabinet_ids]
+        if events:
+            crud.create_unlock_attempts(db, events)
+    return events
+
+class UnlockAttemptWriter:
+    # write-behind buffer for unlock attempts : events are checked against the user and cabinet key caches, queued in memory
+    # and flushed as multi-row inserts once batch_size events are waiting or every flush_interval seconds, add() refuses events
+    # with QueueFull while max_queued are waiting, the database being down or too slow must not grow the queue without bound,
+    # on_flush is awaited with the events of each committed flush
+    def __init__(self, session_factory: sessionmaker, batch_size: int = UNLOCK_ATTEMPTS_BATCH_SIZE,
+                 flush_interval: float = UNLOCK_ATTEMPTS_FLUSH_INTERVAL, spool_path: str = UNLOCK_ATTEMPTS_SPOOL,
+                 max_queued: int = UNLOCK_ATTEMPTS_MAX_QUEUED, on_flush=None):
+        self.session_factory = session_factory
+        self.on_flush = on_flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = str(spool_path)
+        self.max_queued = max_queued
+        self.queue = []
+        self._batch_ready = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    async def start(self):
+        await asyncio.to_thread(self._load_keys)
+        self._read_spool()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # last flush on shutdown, whatever can't reach the database is spooled to disk and replayed by start(), the flushing task
+        # finishes its current flush first instead of being cancelled with its events taken off the queue
+        if self._task is not None:
+            self._stopping = True
+            self._batch_ready.set()
+            await self._task
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Could not flush %d unlock attempts, spooling them to %s", len(self.queue), self.spool_path)
+            self._write_spool()
+
+    async def is_known(self, user_id: str, cabinet_id: str):
+        if cache.users.known(user_id) and cache.cabinets.known(cabinet_id):
+            return True
+        return await asyncio.to_thread(self._load_missing_keys, user_id, cabinet_id)
+
+    def add(self, user_id: str, cabinet_id: str, granted: bool, date: datetime.datetime = None):
+        if len(self.queue) >= self.max_queued:
+            raise QueueFull()
+        self.queue.append({'user_id': user_id, 'cabinet_id': cabinet_id, 'granted': granted, 'date': date or now()})
+        if len(self.queue) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self):
+        events, self.queue = self.queue, []
+        if not events:
+            return 0
+        try:
+            inserted = await asyncio.to_thread(self._insert, events)
+        except Exception:
+            self.queue[:0] = events # put them back in front of the newer events for the next flush
+            raise
+        if inserted and self.on_flush is not None:
+            await self.on_flush(inserted)
+        return len(inserted)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Could not flush %d unlock attempts, retrying later", len(self.queue))
+
+    def _load_keys(self):
+        with self.session_factory() as db:
+            cache.users.add(*crud.get_all_user_uids(db))
+            cache.cabinets.add(*crud.get_all_cabinet_ids(db))
+
+    def _load_missing_keys(self, user_id: str, cabinet_id: str):
+        with self.session_factory() as db:
+            user_uids = crud.get_existing_user_uids(db, [user_id])
+            cabinet_ids = crud.get_existing_cabinet_ids(db, [cabinet_id])
+        cache.users.add(*user_uids)
+        cache.cabinets.add(*cabinet_ids)
+        return bool(user_uids and cabinet_ids)
+
+    def _insert(self, events: list):
+        return insert_unlock_attempts(self.session_factory, events)
+
+    def _read_spool(self):
+        # every worker starts by replaying the spool files, each one is claimed with a rename first so only one worker replays it
+        for path in sorted(glob.glob(glob.escape(self.spool_path) + '*')):
+            if path.endswith(('.tmp', '.claimed')):
+                continue # being written, or replayed by another worker
+            claimed = f'{path}.claimed'
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            with open(claimed) as spool:
+                events = [json.loads(line) for line in spool if line.strip()]
+            for event in events:
+                event['date'] = datetime.datetime.fromisoformat(event['date'])
+            self.queue[:0] = events
+            os.remove(claimed)
+
+    def _write_spool(self):
+        # a file of its own per shutdown, renamed into place once complete so a starting worker never claims it half written
+        path = f'{self.spool_path}.{uuid.uuid4().hex}'
+        with open(f'{path}.tmp', 'w') as spool:
+            for event in self.queue:
+                spool.write(json.dumps({**event, 'date': event['date'].isoformat()}) + '\n')
+        os.rename(f'{path}.tmp', path)
+        self.queue = []
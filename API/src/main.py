@@ -1,16 +1,28 @@
+import asyncio
+import contextlib
+import datetime
+import email.utils
+import logging
+import math
 import os
-import crud, models, schemas
+import time
+import access, cache, changes, crud, database, export, imports, ingestion, metrics, models, retention, schemas
 
-from database import SessionLocal
-from fastapi import FastAPI, Depends, HTTPException, Request, Form
+from database import AsyncSessionLocal, SessionLocal
+from fastapi import BackgroundTasks, Body, FastAPI, Depends, HTTPException, Path, Query, Request, Response, Form
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+from typing import List, Optional
 
 
 app = FastAPI(root_path=os.environ['ROOT_PATH'])
 
+logger = logging.getLogger(__name__)
+
 origins = ['*']
 
 app.add_middleware(
@@ -21,287 +33,786 @@ app.add_middleware(
     allow_headers=['*']
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    # latency, SQL statements and SQL time of each request, labelled by the path template of the route that handled it,
+    # function names aren't unique across routes
+    stats = metrics.RequestStats()
+    metrics.current_request.set(stats)
+    start = time.perf_counter()
+    response = await call_next(request)
+    matched = request.scope.get('route')
+    route = matched.path if matched is not None else 'unmatched'
+    metrics.request_duration.observe(time.perf_counter() - start, route, request.method, str(response.status_code))
+    metrics.request_statements.observe(stats.statements, route)
+    metrics.request_sql_duration.observe(stats.sql_duration, route)
+    return response
+
+@app.middleware("http")
+async def conditional_headers(request: Request, call_next):
+    # ETag and Last-Modified worked out by the versioned dependency of the route, for its successful responses
+    response = await call_next(request)
+    headers = getattr(request.state, 'conditional_headers', None)
+    if headers is not None and response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
+class NotModified(Exception):
+    def __init__(self, headers: dict):
+        self.headers = headers
+
+@app.exception_handler(NotModified)
+async def not_modified(request: Request, exc: NotModified):
+    return Response(status_code=304, headers=exc.headers)
+
+PRIMARY_COOKIE = 'read_primary' # set on the clients that just wrote, their reads skip the replicas until it expires
+
+@app.middleware("http")
+async def read_your_writes(request: Request, call_next):
+    response = await call_next(request)
+    if database.replicas and getattr(request.state, 'wrote', False) and response.status_code < 400:
+        response.set_cookie(PRIMARY_COOKIE, '1', max_age=database.REPLICA_STICKY_SECONDS)
+    return response
+
+@contextlib.asynccontextmanager
+async def session_scope(session_factory: sessionmaker):
+    if issubclass(session_factory.class_, AsyncSession):
+        async with session_factory() as db:
+            yield db
+    else:
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            await asyncio.to_thread(db.close)
+
+async def get_db(request: Request):
+    # crud calls are awaited with db.run_sync(crud.function, ...) so routes never block the event loop,
+    # in async mode they run on the async driver, otherwise they are offloaded to a worker thread
+    if request.method not in ('GET', 'HEAD'):
+        request.state.wrote = True
+    async with session_scope(AsyncSessionLocal or SessionLocal) as db:
+        yield db
+
+def connect(db: Session):
+    db.connection()
+
+async def get_read_db(request: Request):
+    # session of the read-only routes, on the next reachable replica, on the primary without any or for a client that just wrote,
+    # a replica is checked when the connection is taken so an unreachable one fails over before the route runs
+    replicas = database.async_replicas if AsyncSessionLocal is not None else database.replicas
+    if PRIMARY_COOKIE not in request.cookies:
+        for session_factory in replicas.candidates():
+            async with session_scope(session_factory) as db:
+                try:
+                    await db.run_sync(connect)
+                except Exception: # asyncpg raises its own errors and OSError when connecting
+                    replicas.mark_down(session_factory)
+                    continue
+                yield db
+                return
+    async with session_scope(AsyncSessionLocal or SessionLocal) as db:
         yield db
-    finally:
-        db.close()
+
+async def read_session_factory(request: Request):
+    # sync session factory for the streaming exports, chosen like get_read_db does
+    if PRIMARY_COOKIE not in request.cookies:
+        for session_factory in database.replicas.candidates():
+            async with session_scope(session_factory) as db:
+                try:
+                    await db.run_sync(connect)
+                except Exception:
+                    database.replicas.mark_down(session_factory)
+                    continue
+            return session_factory
+    return SessionLocal
+
+async def exists(db: Session, key_cache: cache.KeyCache, get, key):
+    # read-through existence check, only keys found in the database are cached
+    if key_cache.known(key):
+        return True
+    if await db.run_sync(get, key) is None:
+        return False
+    key_cache.add(key)
+    return True
+
+def etag_matches(if_none_match: Optional[str], etag: str):
+    # weak comparison of If-None-Match against etag, as for GET and HEAD
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+def versioned(*tables: str):
+    # dependency answering 304 Not Modified when If-None-Match holds the ETag of the current versions of tables, before the route
+    # reads or serializes anything, otherwise the ETag is added to the response by the conditional_headers middleware
+    async def check(request: Request, db: Session = Depends(get_read_db)):
+        versions = await db.run_sync(crud.get_table_versions, tables)
+        headers = {'ETag': '"' + '.'.join(f"{table}-{version}" for table, version, modified_at in versions) + '"', 'Cache-Control': 'no-cache'}
+        modified = [modified_at if modified_at.tzinfo else modified_at.replace(tzinfo=datetime.timezone.utc) for table, version, modified_at in versions if modified_at is not None]
+        if modified:
+            headers['Last-Modified'] = email.utils.format_datetime(max(modified).astimezone(datetime.timezone.utc), usegmt=True)
+        if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+            raise NotModified(headers)
+        request.state.conditional_headers = headers
+    return check
+
+def expansions(expanded_schema, schema):
+    # dependency reading ?expand= as a comma separated list of the relationships expanded_schema adds to schema
+    def parse(expand: Optional[str] = Query(None, description=f"any of {', '.join(expanded_schema.__fields__.keys() - schema.__fields__.keys())}, comma separated")):
+        relationships = expand.split(',') if expand else []
+        unknown = [relationship for relationship in relationships if relationship not in expanded_schema.__fields__.keys() - schema.__fields__.keys()]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Cannot expand {', '.join(unknown)}")
+        return list(dict.fromkeys(relationships))
+    return parse
+
+async def import_rows(db: Session, schema, crud_import, key_cache: Optional[cache.KeyCache], rows: list):
+    # rows are validated one by one, then checked against the database and inserted set-wise by crud_import
+    if len(rows) > imports.IMPORT_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"At most {imports.IMPORT_MAX_ROWS} rows per import")
+    valid, errors = imports.validate(schema, rows)
+    try:
+        report = await db.run_sync(crud_import, valid) if valid else {'created': [], 'errors': []}
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Referenced rows were deleted during the import, nothing was imported")
+    if key_cache is not None:
+        key_cache.add(*[row['id'] for row in report['created']])
+    return {'created': report['created'], 'errors': sorted(errors + report['errors'], key=lambda error: error['row'])}
+
+async def csv_rows(request: Request):
+    try:
+        return imports.read_csv(await request.body())
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+def page_response(schema, page: dict, expand: list = (), expanded_schema=None):
+    # with crud.FAST_READS the page holds plain rows, encoded without pydantic by the JSONResponse the response_model path
+    # ends in, so the bytes are the same, only the values that aren't JSON types already go through jsonable_encoder
+    if expand:
+        # objects with their expanded relationships loaded, the ones not asked for are left out
+        excluded = expanded_schema.__fields__.keys() - schema.__fields__.keys() - set(expand)
+        return JSONResponse(jsonable_encoder(schemas.Page[expanded_schema](**page), exclude={'items': {'__all__': excluded}}))
+    if not crud.FAST_READS:
+        return page
+    items = [{field: json_value(getattr(row, field)) for field in schema.__fields__} for row in page['items']]
+    return JSONResponse({'items': items, 'next_cursor': page['next_cursor']})
+
+def json_value(value):
+    return value if value is None or type(value) in (str, int, float, bool) else jsonable_encoder(value)
+
+broadcaster = changes.make_broadcaster(database.DATABASE_URL)
+
+async def publish(cabinet_id: Optional[str], type: str, data):
+    # change feed of the cabinet, called once the change is committed so a failure is only logged, a 500 would tell the client it wasn't
+    if cabinet_id is not None:
+        try:
+            await broadcaster.publish(cabinet_id, type, jsonable_encoder(data))
+        except Exception:
+            logger.exception("Could not publish %s of cabinet %s", type, cabinet_id)
+
+async def publish_unlock_attempts(unlock_attempts: list):
+    # the attempts committed by record_unlock_attempt or by a flush of the write-behind buffer, never the queued ones
+    for unlock_attempt in unlock_attempts:
+        await publish(unlock_attempt['cabinet_id'], 'unlock_attempt.created', unlock_attempt)
+
+unlock_attempt_writer = ingestion.UnlockAttemptWriter(SessionLocal, on_flush=publish_unlock_attempts) if ingestion.UNLOCK_ATTEMPTS_WRITE_BEHIND else None
+access_map = access.AccessMap(SessionLocal)
+
+async def record_unlock_attempt(unlock_attempt: dict):
+    # attempts of unknown users or cabinets are dropped, like the write-behind buffer does
+    await publish_unlock_attempts(await asyncio.to_thread(ingestion.insert_unlock_attempts, SessionLocal, [unlock_attempt]))
+
+def queue_unlock_attempt(user_id: str, cabinet_id: str, granted: bool, date: datetime.datetime):
+    # the write-behind queue is full when the database can't keep up, clients are asked to retry after the next flush
+    try:
+        unlock_attempt_writer.add(user_id, cabinet_id, granted, date)
+    except ingestion.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many unlock attempts waiting to be written",
+                            headers={'Retry-After': str(math.ceil(unlock_attempt_writer.flush_interval))})
+
+@app.on_event("startup")
+async def startup():
+    asyncio.get_running_loop().set_default_executor(database.thread_executor()) # used by every asyncio.to_thread, run_sync of the sync sessions included
+    await broadcaster.start()
+    if AsyncSessionLocal is not None:
+        await database.warm_up_async(AsyncSessionLocal.kw['bind'])
+    else:
+        await asyncio.to_thread(database.warm_up, database.engine)
+    for session_factory in database.replicas.session_factories:
+        await asyncio.to_thread(database.warm_up, session_factory.kw['bind'])
+    for session_factory in (database.async_replicas.session_factories if database.async_replicas is not None else ()):
+        await database.warm_up_async(session_factory.kw['bind'])
+    await access_map.start()
+    if unlock_attempt_writer is not None:
+        await unlock_attempt_writer.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await broadcaster.stop()
+    await access_map.stop()
+    if unlock_attempt_writer is not None:
+        await unlock_attempt_writer.stop()
 
 
 # MAIN
 
 @app.get("/")
-def root():
+async def root():
     return {"message": "Welcome to Smart Inventory"}
 
+@app.get("/health/") # database reachability and connection pool usage, 503 when the database can't be reached
+async def read_health(db: Session = Depends(get_db)):
+    try:
+        await db.run_sync(crud.ping)
+        status, status_code = 'ok', 200
+    except Exception:
+        status, status_code = 'unavailable', 503
+    pools = {'sync': database.pool_status(database.engine.pool)} # this request's connection included
+    if AsyncSessionLocal is not None:
+        pools['async'] = database.pool_status(AsyncSessionLocal.kw['bind'].pool)
+    for index, session_factory in enumerate(database.replicas.session_factories):
+        pools[f'replica_{index}'] = database.pool_status(session_factory.kw['bind'].pool)
+    return JSONResponse({'database': status, 'pools': pools}, status_code=status_code)
+
+@app.get("/metrics", response_class=PlainTextResponse) # Prometheus text format
+async def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats/") # hits and misses of the existence check caches
+async def read_cache_stats():
+    return cache.stats()
+
 # USERS
 
-@app.get("/users/", response_model=List[schemas.User])
-def read_all_users(db: Session = Depends(get_db)):
-    return crud.get_all_users(db)
+@app.get("/users/", response_model=schemas.Page[schemas.User], dependencies=[Depends(versioned("users"))])
+async def read_all_users(cursor: Optional[str] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return page_response(schemas.User, await db.run_sync(crud.get_all_users, cursor, limit))
 
-@app.get("/user/{uid}/", response_model=schemas.User)
-def read_user_by_uid(uid: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_uid(db, uid)
+@app.get("/users/lookup/", response_model=schemas.Lookup[schemas.User, str], dependencies=[Depends(versioned("users"))]) # reads all users listed in ?uids=
+async def lookup_users(uids: List[str] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_users_by_uids, uids)
+
+@app.post("/users/lookup/", response_model=schemas.Lookup[schemas.User, str]) # same with the uids as a JSON list, for lists too long for a URL
+async def lookup_users_by_body(uids: List[str] = Body(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_users_by_uids, uids)
+
+@app.get("/user/{uid}/", response_model=schemas.User, dependencies=[Depends(versioned("users"))])
+async def read_user_by_uid(uid: str, db: Session = Depends(get_read_db)):
+    db_user = await db.run_sync(crud.get_user_by_uid, uid)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 @app.post("/user/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_uid(db, user.uid)
-    if db_user:
+async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    db_user = await db.run_sync(crud.create_user, user)
+    if db_user is None:
         raise HTTPException(status_code=400, detail="User already exists")
-    return crud.create_user(db=db, user=user)
+    cache.users.add(user.uid)
+    return db_user
 
 @app.delete("/user/{uid}/")
-def delete_user_by_uid(uid: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_uid(db, uid)
-    if db_user is None:
+async def delete_user_by_uid(uid: str, db: Session = Depends(get_db)):
+    if not await db.run_sync(crud.delete_users, [uid]):
         raise HTTPException(status_code=404, detail="User not found")
-    db.delete(db_user)
-    db.commit()
+    cache.users.discard(uid)
+    access_map.forget_user(uid)
     return {'Deleted user with uid': uid}
 
+@app.delete("/users/") # deletes all users listed in ?uids=
+async def delete_users(uids: List[str] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    deleted = await db.run_sync(crud.delete_users, uids)
+    for uid in deleted:
+        cache.users.discard(uid)
+        access_map.forget_user(uid)
+    return {'Deleted users with uids': deleted, 'Users not found': [uid for uid in uids if uid not in deleted]}
+
 # CABINETS
 
-@app.get("/cabinets/", response_model=List[schemas.Cabinet])
-def read_all_cabinets(db: Session = Depends(get_db)):
-    return crud.get_all_cabinets(db)
+@app.get("/cabinets/", response_model=schemas.Page[schemas.Cabinet], dependencies=[Depends(versioned("cabinets"))])
+async def read_all_cabinets(cursor: Optional[str] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return page_response(schemas.Cabinet, await db.run_sync(crud.get_all_cabinets, cursor, limit))
 
-@app.get("/cabinet/{id}/", response_model=schemas.Cabinet)
-def read_cabinet_by_id(id: str, db: Session = Depends(get_db)):
-    db_cabinet = crud.get_cabinet_by_id(db, id)
+@app.get("/cabinets/lookup/", response_model=schemas.Lookup[schemas.Cabinet, str], dependencies=[Depends(versioned("cabinets"))]) # reads all cabinets listed in ?ids=
+async def lookup_cabinets(ids: List[str] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_cabinets_by_ids, ids)
+
+@app.post("/cabinets/lookup/", response_model=schemas.Lookup[schemas.Cabinet, str]) # same with the ids as a JSON list, for lists too long for a URL
+async def lookup_cabinets_by_body(ids: List[str] = Body(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_cabinets_by_ids, ids)
+
+@app.get("/cabinet/{id}/", response_model=schemas.Cabinet, dependencies=[Depends(versioned("cabinets"))])
+async def read_cabinet_by_id(id: str, db: Session = Depends(get_read_db)):
+    db_cabinet = await db.run_sync(crud.get_cabinet_by_id, id)
     if db_cabinet is None:
         raise HTTPException(status_code=404, detail="Cabinet not found")
     return db_cabinet
 
 @app.post("/cabinet/", response_model=schemas.Cabinet)
-def create_cabinet(cabinet: schemas.CabinetCreate, db: Session = Depends(get_db)):
-    db_cabinet = crud.get_cabinet_by_id(db, cabinet.id)
-    if db_cabinet:
+async def create_cabinet(cabinet: schemas.CabinetCreate, db: Session = Depends(get_db)):
+    db_cabinet = await db.run_sync(crud.create_cabinet, cabinet)
+    if db_cabinet is None:
         raise HTTPException(status_code=400, detail="Cabinet already exists")
-    return crud.create_cabinet(db, cabinet)
+    cache.cabinets.add(cabinet.id)
+    return db_cabinet
+
+@app.get("/cabinet/{id}/events/") # Server-Sent Events of the storage units and unlock attempts of the cabinet, instead of polling their lists
+async def read_cabinet_events(id: str, request: Request):
+    # no session dependency, it would hold its connection until the stream ends
+    async with session_scope(AsyncSessionLocal or SessionLocal) as db:
+        found = await exists(db, cache.cabinets, crud.get_cabinet_by_id, id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Cabinet not found")
+    return StreamingResponse(changes.stream(broadcaster, request, id), media_type="text/event-stream", headers={'Cache-Control': 'no-cache'})
+
+@app.get("/cabinet/{id}/permissions/", response_model=List[str]) # uids of the users allowed to open the cabinet
+async def read_cabinet_permissions(id: str, db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.cabinets, crud.get_cabinet_by_id, id):
+        raise HTTPException(status_code=404, detail="Cabinet not found")
+    return await db.run_sync(crud.get_permitted_user_uids, id)
+
+@app.put("/cabinet/{id}/permissions/") # allows the users of the JSON list of uids to open the cabinet
+async def grant_cabinet_permissions(id: str, uids: List[str] = Body(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    if not uids:
+        raise HTTPException(status_code=400, detail="No uids given")
+    try:
+        await db.run_sync(crud.set_cabinet_permissions, id, uids, True)
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="User or cabinet not found")
+    access_map.apply([(uid, id, True, None) for uid in uids]) # the other workers see it at their next refresh
+    return {'Granted users with uids': uids}
+
+@app.delete("/cabinet/{id}/permissions/") # revokes the permissions of the users listed in ?uids=
+async def revoke_cabinet_permissions(id: str, uids: List[str] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    try:
+        await db.run_sync(crud.set_cabinet_permissions, id, uids, False)
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="User or cabinet not found")
+    access_map.apply([(uid, id, False, None) for uid in uids])
+    return {'Revoked users with uids': uids}
+
+@app.post("/cabinet/{id}/authorize/", response_model=schemas.UnlockDecision) # whether the user may open the cabinet, from memory, the attempt is recorded once answered
+async def authorize_unlock(id: str, unlock: schemas.UnlockRequest, background_tasks: BackgroundTasks):
+    granted = access_map.allows(unlock.user_id, id)
+    unlock_attempt = {'user_id': unlock.user_id, 'cabinet_id': id, 'granted': granted, 'date': ingestion.now()}
+    if unlock_attempt_writer is not None: # published by the flush that commits it
+        queue_unlock_attempt(**unlock_attempt)
+    else:
+        background_tasks.add_task(record_unlock_attempt, unlock_attempt)
+    return {'granted': granted}
 
 @app.delete("/cabinet/{id}/")
-def delete_cabinet_by_id(id: str, db: Session = Depends(get_db)):
-    db_cabinet = crud.get_cabinet_by_id(db, id)
-    if db_cabinet is None:
+async def delete_cabinet_by_id(id: str, db: Session = Depends(get_db)):
+    if not await db.run_sync(crud.delete_cabinets, [id]):
         raise HTTPException(status_code=404, detail="Cabinet not found")
-    db.delete(db_cabinet)
-    db.commit()
+    cache.cabinets.discard(id)
+    access_map.forget_cabinet(id)
     return {'Deleted cabinet with id': id}
 
+@app.delete("/cabinets/") # deletes all cabinets listed in ?ids=
+async def delete_cabinets(ids: List[str] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    deleted = await db.run_sync(crud.delete_cabinets, ids)
+    for id in deleted:
+        cache.cabinets.discard(id)
+        access_map.forget_cabinet(id)
+    return {'Deleted cabinets with ids': deleted, 'Cabinets not found': [id for id in ids if id not in deleted]}
+
 # CATEGORIES
 
-@app.get("/categories/", response_model=List[schemas.Category]) # reads all categories
-def read_all_categories(db: Session = Depends(get_db)):
-    return crud.get_all_categories(db)
+@app.get("/categories/", response_model=schemas.Page[schemas.Category], dependencies=[Depends(versioned("categories"))]) # reads all categories
+async def read_all_categories(cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return page_response(schemas.Category, await db.run_sync(crud.get_all_categories, cursor, limit))
 
-@app.get("/categories/root/", response_model=List[schemas.Category]) # reads all root categories
-def read_root_categories(db: Session = Depends(get_db)):
-    return crud.get_root_categories(db)
+@app.get("/categories/root/", response_model=schemas.Page[schemas.Category], dependencies=[Depends(versioned("categories"))]) # reads all root categories
+async def read_root_categories(cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return page_response(schemas.Category, await db.run_sync(crud.get_root_categories, cursor, limit))
 
-@app.get("/category/{id}/", response_model=schemas.Category)
-def read_category_by_id(id: str, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_id(db, id)
+@app.get("/category/{id}/", response_model=schemas.Category, dependencies=[Depends(versioned("categories"))])
+async def read_category_by_id(id: str, db: Session = Depends(get_read_db)):
+    db_category = await db.run_sync(crud.get_category_by_id, id)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
     return db_category
 
-@app.get("/categories/subcategories/{parent_id}/", response_model=List[schemas.Category]) # reads all sub-categories of a category
-def read_sub_categories(parent_id: int, db: Session = Depends(get_db)):
-    parent_category = crud.get_category_by_id(db, parent_id)
-    if not parent_category:
+@app.get("/categories/subcategories/{parent_id}/", response_model=schemas.Page[schemas.Category], dependencies=[Depends(versioned("categories"))]) # reads all sub-categories of a category
+async def read_sub_categories(parent_id: int, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.categories, crud.get_category_by_id, parent_id):
         raise HTTPException(status_code=404, detail="Parent category not found")
-    return crud.get_sub_categories(db, parent_id)
+    return page_response(schemas.Category, await db.run_sync(crud.get_sub_categories, parent_id, cursor, limit))
+
+@app.get("/categories/{category_id}/descendants/", response_model=schemas.Page[schemas.Category], dependencies=[Depends(versioned("categories"))]) # reads all categories under a category, at any depth
+async def read_descendant_categories(category_id: int, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.categories, crud.get_category_by_id, category_id):
+        raise HTTPException(status_code=404, detail="Category not found")
+    return page_response(schemas.Category, await db.run_sync(crud.get_descendant_categories, category_id, cursor, limit))
+
+@app.get("/categories/{category_id}/ancestors/", response_model=List[schemas.Category], dependencies=[Depends(versioned("categories"))]) # reads the parents of a category, root first
+async def read_ancestor_categories(category_id: int, db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.categories, crud.get_category_by_id, category_id):
+        raise HTTPException(status_code=404, detail="Category not found")
+    return await db.run_sync(crud.get_ancestor_categories, category_id)
 
 @app.post("/category/", response_model=schemas.Category)
-def create_category(category: schemas.CategoryCreate, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_title(db, category.title)
-    if db_category:
+async def create_category(category: schemas.CategoryCreate, db: Session = Depends(get_db)):
+    try:
+        db_category = await db.run_sync(crud.create_category, category)
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="Parent category not found")
+    if db_category is None:
         raise HTTPException(status_code=400, detail="Category already exists")
-    if category.parent_id is not None:
-        db_parent_category = crud.get_category_by_id(db, category.parent_id)
-        if db_parent_category is None:
-            raise HTTPException(status_code=404, detail="Parent category not found")
-    return crud.create_category(db, category)
+    cache.categories.add(db_category.id)
+    return db_category
 
 @app.delete("/category/{id}/")
-def delete_category_by_id(id: int, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_id(db, id)
-    if db_category is None:
+async def delete_category_by_id(id: int, db: Session = Depends(get_db)):
+    if not await db.run_sync(crud.delete_categories, [id]):
         raise HTTPException(status_code=404, detail="Category not found")
-    db.delete(db_category)
-    db.commit()
+    cache.categories.discard(id)
     return {'Deleted category with id': id}
 
+@app.delete("/categories/") # deletes all categories listed in ?ids=
+async def delete_categories(ids: List[int] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    deleted = await db.run_sync(crud.delete_categories, ids)
+    for id in deleted:
+        cache.categories.discard(id)
+    return {'Deleted categories with ids': deleted, 'Categories not found': [id for id in ids if id not in deleted]}
+
 # ITEMS
 
-@app.get("/items/", response_model=List[schemas.Item])
-def read_all_items(db: Session = Depends(get_db)):
-    return crud.get_all_items(db)
+@app.get("/items/", response_model=schemas.Page[schemas.Item], dependencies=[Depends(versioned("items"))])
+async def read_all_items(cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return page_response(schemas.Item, await db.run_sync(crud.get_all_items, cursor, limit))
+
+@app.get("/items/lookup/", response_model=schemas.Lookup[schemas.Item, int], dependencies=[Depends(versioned("items"))]) # reads all items listed in ?ids=
+async def lookup_items(ids: List[int] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_items_by_ids, ids)
+
+@app.get("/items/search/", response_model=List[schemas.Item], dependencies=[Depends(versioned("items"))]) # items matching ?q= best first, words may be partly typed or misspelt
+async def search_items(q: str = Query(..., min_length=1, max_length=200), limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.search_items, q, limit)
 
-@app.get("/item/{id}/", response_model=schemas.Item)
-def read_item_by_id(id: int, db: Session = Depends(get_db)):
-    db_item = crud.get_item_by_id(db, id)
+@app.post("/items/lookup/", response_model=schemas.Lookup[schemas.Item, int]) # same with the ids as a JSON list, for lists too long for a URL
+async def lookup_items_by_body(ids: List[int] = Body(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_items_by_ids, ids)
+
+@app.get("/item/{id}/", response_model=schemas.Item, dependencies=[Depends(versioned("items"))])
+async def read_item_by_id(id: int, db: Session = Depends(get_read_db)):
+    db_item = await db.run_sync(crud.get_item_by_id, id)
     if db_item is None:
         raise HTTPException(status_code=404, detail="Item not found")
     return db_item
 
-@app.get("/categories/{category_id}/items/", response_model=List[schemas.Item]) # reads all items under a category
-def read_all_items(category_id: int, db: Session = Depends(get_db)):
-    category = crud.get_category_by_id(db, category_id)
-    if not category:
+@app.get("/categories/{category_id}/items/", response_model=schemas.Page[schemas.Item], dependencies=[Depends(versioned("categories", "items"))]) # reads all items under a category
+async def read_all_items(category_id: int, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.categories, crud.get_category_by_id, category_id):
+        raise HTTPException(status_code=404, detail="Category not found")
+    return page_response(schemas.Item, await db.run_sync(crud.get_items_by_category_id, category_id, cursor, limit))
+
+@app.get("/categories/{category_id}/subtree/items/", response_model=schemas.Page[schemas.Item], dependencies=[Depends(versioned("categories", "items"))]) # reads all items under a category and its descendants
+async def read_items_by_category_subtree(category_id: int, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.categories, crud.get_category_by_id, category_id):
         raise HTTPException(status_code=404, detail="Category not found")
-    return crud.get_items_by_category_id(db, category_id)
+    return page_response(schemas.Item, await db.run_sync(crud.get_items_by_category_subtree, category_id, cursor, limit))
 
 @app.post("/item/", response_model=schemas.Item)
-def create_item(item: schemas.ItemCreate, db: Session = Depends(get_db)):
-    if item.category_id is not None:
-        db_category = crud.get_category_by_id(db, item.category_id)
-        if not db_category:
-            raise HTTPException(status_code=404, detail="Category not found")
-    db_item = crud.get_item_by_title(db, item.title)
-    if db_item:
+async def create_item(item: schemas.ItemCreate, db: Session = Depends(get_db)):
+    try:
+        db_item = await db.run_sync(crud.create_item, item)
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="Category not found")
+    if db_item is None:
         raise HTTPException(status_code=400, detail="Item already exists")
-    return crud.create_item(db, item)
+    cache.items.add(db_item.id)
+    return db_item
+
+@app.post("/items/import/", response_model=schemas.ImportReport) # creates the items of a JSON array, rows that can't be created are reported
+async def import_items(items: List[dict] = Body(..., max_items=imports.IMPORT_MAX_ROWS), db: Session = Depends(get_db)):
+    return await import_rows(db, schemas.ItemCreate, crud.import_items, cache.items, items)
+
+@app.post("/items/import/csv/", response_model=schemas.ImportReport) # same with a text/csv body whose header names the item fields
+async def import_items_csv(request: Request, db: Session = Depends(get_db)):
+    return await import_rows(db, schemas.ItemCreate, crud.import_items, cache.items, await csv_rows(request))
 
 @app.delete("/item/{id}/")
-def delete_item_by_id(id: int, db: Session = Depends(get_db)):
-    db_item = crud.get_item_by_id(db, id)
-    if db_item is None:
+async def delete_item_by_id(id: int, db: Session = Depends(get_db)):
+    if not await db.run_sync(crud.delete_items, [id]):
         raise HTTPException(status_code=404, detail="Item not found")
-    db.delete(db_item)
-    db.commit()
+    cache.items.discard(id)
     return {'Deleted item with id': id}
 
+@app.delete("/items/") # deletes all items listed in ?ids=
+async def delete_items(ids: List[int] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    deleted = await db.run_sync(crud.delete_items, ids)
+    for id in deleted:
+        cache.items.discard(id)
+    return {'Deleted items with ids': deleted, 'Items not found': [id for id in ids if id not in deleted]}
+
 # ORDER REQUESTS
 
-@app.get("/order-requests/", response_model=List[schemas.OrderRequest])
-def read_all_order_requests(db: Session = Depends(get_db)):
-    return crud.get_all_order_requests(db)
+@app.get("/order-requests/", response_model=schemas.Page[schemas.OrderRequest])
+async def read_all_order_requests(cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.OrderRequestExpanded, schemas.OrderRequest)), db: Session = Depends(get_read_db)):
+    return page_response(schemas.OrderRequest, await db.run_sync(crud.get_all_order_requests, cursor, limit, expand), expand, schemas.OrderRequestExpanded)
 
-@app.get("/order-requests/item/{id}/", response_model=List[schemas.OrderRequest])
-def read_order_requests_by_item_id(id: int, db: Session = Depends(get_db)):
-    db_item = crud.get_item_by_id(db, id)
-    if db_item is None:
+@app.get("/order-requests/item/{id}/", response_model=schemas.Page[schemas.OrderRequest])
+async def read_order_requests_by_item_id(id: int, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.OrderRequestExpanded, schemas.OrderRequest)), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.items, crud.get_item_by_id, id):
         raise HTTPException(status_code=404, detail="Item not found")
-    return crud.get_order_requests_by_item_id(db, id)
+    return page_response(schemas.OrderRequest, await db.run_sync(crud.get_order_requests_by_item_id, id, cursor, limit, expand), expand, schemas.OrderRequestExpanded)
 
-@app.get("/order-requests/user/{uid}/", response_model=List[schemas.OrderRequest])
-def read_order_requests_by_user_id(uid: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_uid(db, uid)
-    if db_user is None:
+@app.get("/order-requests/user/{uid}/", response_model=schemas.Page[schemas.OrderRequest])
+async def read_order_requests_by_user_id(uid: str, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.OrderRequestExpanded, schemas.OrderRequest)), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.users, crud.get_user_by_uid, uid):
         raise HTTPException(status_code=404, detail="User not found")
-    return crud.get_order_requests_by_user_id(db, uid)
+    return page_response(schemas.OrderRequest, await db.run_sync(crud.get_order_requests_by_user_id, uid, cursor, limit, expand), expand, schemas.OrderRequestExpanded)
 
-@app.get("/order-requests/state/{state}/", response_model=List[schemas.OrderRequest])
-def read_order_requests_by_state(state: int, db: Session = Depends(get_db)):
-    return crud.get_order_requests_by_state(db, state)
+@app.get("/order-requests/state/{state}/", response_model=schemas.Page[schemas.OrderRequest])
+async def read_order_requests_by_state(state: int, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.OrderRequestExpanded, schemas.OrderRequest)), db: Session = Depends(get_read_db)):
+    return page_response(schemas.OrderRequest, await db.run_sync(crud.get_order_requests_by_state, state, cursor, limit, expand), expand, schemas.OrderRequestExpanded)
+
+@app.get("/order-requests/export/") # streams the order requests matching the filters as NDJSON or CSV
+async def export_order_requests(request: Request, format: str = Query("ndjson", regex="^(ndjson|csv)$"), state: Optional[int] = None, item_id: Optional[int] = None, user_id: Optional[str] = None,
+                                start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None):
+    statement = crud.select_order_requests(state, item_id, user_id, start, end)
+    return StreamingResponse(export.export(await read_session_factory(request), statement, format), media_type=export.MEDIA_TYPES[format],
+                             headers={'Content-Disposition': f'attachment; filename="order_requests.{format}"'})
 
 @app.post("/order-request/", response_model=schemas.OrderRequest)
-def create_order_request(order_request: schemas.OrderRequestCreate, db: Session = Depends(get_db)):
-    db_item = crud.get_item_by_id(db, order_request.item_id)
-    db_user = crud.get_user_by_uid(db, order_request.user_id)
-    if db_item is None or db_user is None:
+async def create_order_request(order_request: schemas.OrderRequestCreate, db: Session = Depends(get_db)):
+    try:
+        db_order_request = await db.run_sync(crud.create_order_request, order_request)
+    except IntegrityError:
         raise HTTPException(status_code=404, detail="Item or user not found")
-    db_order_request = crud.get_order_requests_by_item_and_user_id(db, order_request.item_id, order_request.user_id)
-    if db_order_request:
+    if db_order_request is None:
         raise HTTPException(status_code=400, detail="Order already requested by this user")
-    return crud.create_order_request(db, order_request)
+    return db_order_request
+
+@app.patch("/order-requests/state/", response_model=schemas.OrderRequestStateChangeResult) # moves the order requests selected by ids or filters to a new state
+async def transition_order_requests(change: schemas.OrderRequestStateChange, db: Session = Depends(get_db)):
+    if change.ids is None and change.item_id is None and change.user_id is None and change.from_state is None:
+        raise HTTPException(status_code=400, detail="Select order requests by ids, item_id, user_id or from_state")
+    if change.ids is not None and len(change.ids) > crud.MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {crud.MAX_PAGE_SIZE} ids per request")
+    return await db.run_sync(crud.transition_order_requests, change.state, change.ids, change.item_id, change.user_id, change.from_state)
 
 @app.delete("/order-request/{id}/")
-def delete_order_request_by_id(id: int, db: Session = Depends(get_db)):
-    db_order_request = crud.get_order_request_by_id(db, id)
-    if db_order_request is None:
+async def delete_order_request_by_id(id: int, db: Session = Depends(get_db)):
+    if not await db.run_sync(crud.delete_order_requests, [id]):
         raise HTTPException(status_code=404, detail="Order request not found")
-    db.delete(db_order_request)
-    db.commit()
     return {'Deleted order request with id': id}
 
+@app.delete("/order-requests/") # deletes all order requests listed in ?ids=
+async def delete_order_requests(ids: List[int] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    deleted = await db.run_sync(crud.delete_order_requests, ids)
+    return {'Deleted order requests with ids': deleted, 'Order requests not found': [id for id in ids if id not in deleted]}
+
 # STORAGE UNITS
 
-@app.get("/storage-units/", response_model=List[schemas.StorageUnit])
-def read_all_storage_units(db: Session = Depends(get_db)):
-    return crud.get_all_storage_units(db)
+@app.get("/storage-units/", response_model=schemas.Page[schemas.StorageUnit])
+async def read_all_storage_units(cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.StorageUnitExpanded, schemas.StorageUnit)), db: Session = Depends(get_read_db)):
+    return page_response(schemas.StorageUnit, await db.run_sync(crud.get_all_storage_units, cursor, limit, expand), expand, schemas.StorageUnitExpanded)
+
+@app.get("/storage-units/lookup/", response_model=schemas.Lookup[schemas.StorageUnit, int]) # reads all storage units listed in ?ids=
+async def lookup_storage_units(ids: List[int] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_storage_units_by_ids, ids)
+
+@app.post("/storage-units/lookup/", response_model=schemas.Lookup[schemas.StorageUnit, int]) # same with the ids as a JSON list, for lists too long for a URL
+async def lookup_storage_units_by_body(ids: List[int] = Body(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_storage_units_by_ids, ids)
 
 @app.get("/storage-unit/{id}/", response_model=schemas.StorageUnit)
-def read_storage_unit_by_id(id: int, db: Session = Depends(get_db)):
-    db_storage_unit = crud.get_storage_unit_by_id(db, id)
+async def read_storage_unit_by_id(id: int, db: Session = Depends(get_read_db)):
+    db_storage_unit = await db.run_sync(crud.get_storage_unit_by_id, id)
     if db_storage_unit is None:
         raise HTTPException(status_code=404, detail="Storage unit not found")
     return db_storage_unit
 
-@app.get("/storage-units/cabinet/{cabinet_id}/", response_model=List[schemas.StorageUnit])
-def read_storage_units_by_cabinet_id(cabinet_id: str, db: Session = Depends(get_db)):
-    db_cabinet = crud.get_cabinet_by_id(db, cabinet_id)
-    if db_cabinet is None:
+@app.get("/storage-units/cabinet/{cabinet_id}/", response_model=schemas.Page[schemas.StorageUnit])
+async def read_storage_units_by_cabinet_id(cabinet_id: str, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.StorageUnitExpanded, schemas.StorageUnit)), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.cabinets, crud.get_cabinet_by_id, cabinet_id):
         raise HTTPException(status_code=404, detail="Cabinet not found")
-    return crud.get_storage_units_by_cabinet_id(db, cabinet_id)    
+    return page_response(schemas.StorageUnit, await db.run_sync(crud.get_storage_units_by_cabinet_id, cabinet_id, cursor, limit, expand), expand, schemas.StorageUnitExpanded)
+
+@app.put("/storage-units/cabinet/{cabinet_id}/", response_model=schemas.CabinetSync) # replaces the storage units of a cabinet by the full list it reports
+async def sync_cabinet_storage_units(cabinet_id: str, storage_units: List[schemas.StorageUnitSnapshot] = Body(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    if not await exists(db, cache.cabinets, crud.get_cabinet_by_id, cabinet_id):
+        raise HTTPException(status_code=404, detail="Cabinet not found")
+    if len({storage_unit.id for storage_unit in storage_units}) < len(storage_units):
+        raise HTTPException(status_code=400, detail="Storage unit IDs must be unique")
+    missing_items = (await db.run_sync(crud.get_items_by_ids, [storage_unit.item_id for storage_unit in storage_units]))['not_found']
+    if missing_items:
+        raise HTTPException(status_code=404, detail=f"Items not found : {', '.join(map(str, missing_items))}")
+    try:
+        diff = await db.run_sync(crud.sync_cabinet_storage_units, cabinet_id, storage_units)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Referenced rows were deleted during the sync, nothing was changed")
+    if diff['created'] or diff['updated'] or diff['deleted']:
+        await publish(cabinet_id, 'storage_units.synced', diff)
+    return diff
 
 @app.post("/storage-unit/", response_model=schemas.StorageUnit)
-def create_storage_unit(storage_unit: schemas.StorageUnitCreate, db: Session = Depends(get_db)):
-    db_item = crud.get_item_by_id(db, storage_unit.item_id)
-    if db_item is None:
-        raise HTTPException(status_code=404, detail="Item not found")
-    if storage_unit.cabinet_id is not None:
-        db_cabinet = crud.get_cabinet_by_id(db, storage_unit.cabinet_id)
-        if db_cabinet is None:
+async def create_storage_unit(storage_unit: schemas.StorageUnitCreate, db: Session = Depends(get_db)):
+    try:
+        db_storage_unit = await db.run_sync(crud.create_storage_unit, storage_unit)
+    except IntegrityError as error:
+        if crud.violated_constraint(error) == 'storage_units_cabinet_id_fkey':
             raise HTTPException(status_code=404, detail="Cabinet not found")
-    db_storage_unit = crud.get_storage_unit_by_id(db, storage_unit.id)
-    if db_storage_unit:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if db_storage_unit is None:
         raise HTTPException(status_code=400, detail="Storage unit ID already assigned")
-    return crud.create_storage_unit(db, storage_unit)
+    await publish(db_storage_unit.cabinet_id, 'storage_unit.created', schemas.StorageUnit.from_orm(db_storage_unit))
+    return db_storage_unit
+
+@app.post("/storage-units/import/", response_model=schemas.ImportReport) # creates the storage units of a JSON array, rows that can't be created are reported
+async def import_storage_units(storage_units: List[dict] = Body(..., max_items=imports.IMPORT_MAX_ROWS), db: Session = Depends(get_db)):
+    return await publish_imported(await import_rows(db, schemas.StorageUnitCreate, crud.import_storage_units, None, storage_units))
+
+@app.post("/storage-units/import/csv/", response_model=schemas.ImportReport) # same with a text/csv body whose header names the storage unit fields
+async def import_storage_units_csv(request: Request, db: Session = Depends(get_db)):
+    return await publish_imported(await import_rows(db, schemas.StorageUnitCreate, crud.import_storage_units, None, await csv_rows(request)))
+
+async def publish_imported(report: dict):
+    imported = {}
+    for row in report['created']:
+        imported.setdefault(row['cabinet_id'], []).append(row['id'])
+    for cabinet_id, ids in imported.items():
+        await publish(cabinet_id, 'storage_units.imported', {'ids': ids})
+    return report
 
 @app.delete("/storage-unit/{id}/")
-def delete_storage_unit_by_id(id: int, db: Session = Depends(get_db)):
-    db_storage_unit = crud.get_storage_unit_by_id(db, id)
-    if db_storage_unit is None:
+async def delete_storage_unit_by_id(id: int, db: Session = Depends(get_db)):
+    deleted = await db.run_sync(crud.delete_storage_units, [id])
+    if not deleted:
         raise HTTPException(status_code=404, detail="Storage unit not found")
-    db.delete(db_storage_unit)
-    db.commit()
+    await publish(deleted[0].cabinet_id, 'storage_unit.deleted', {'id': id})
     return {'Deleted storage unit with id': id}
 
+@app.delete("/storage-units/") # deletes all storage units listed in ?ids=
+async def delete_storage_units(ids: List[int] = Query(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    deleted = await db.run_sync(crud.delete_storage_units, ids)
+    for storage_unit in deleted:
+        await publish(storage_unit.cabinet_id, 'storage_unit.deleted', {'id': storage_unit.id})
+    deleted = [storage_unit.id for storage_unit in deleted]
+    return {'Deleted storage units with ids': deleted, 'Storage units not found': [id for id in ids if id not in deleted]}
+
+# STOCK
+
+@app.get("/stock/items/", response_model=schemas.Page[schemas.ItemStock]) # storage units per item
+async def read_stock_by_items(cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_stock_by_items, cursor, limit)
+
+@app.get("/stock/item/{id}/", response_model=schemas.ItemStockDetail) # storage units of an item, per cabinet
+async def read_stock_by_item_id(id: int, db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.items, crud.get_item_by_id, id):
+        raise HTTPException(status_code=404, detail="Item not found")
+    return await db.run_sync(crud.get_stock_by_item_id, id)
+
+@app.get("/stock/cabinet/{cabinet_id}/", response_model=schemas.Page[schemas.ItemStock]) # storage units of a cabinet, per item
+async def read_stock_by_cabinet_id(cabinet_id: str, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.cabinets, crud.get_cabinet_by_id, cabinet_id):
+        raise HTTPException(status_code=404, detail="Cabinet not found")
+    return await db.run_sync(crud.get_stock_by_cabinet_id, cabinet_id, cursor, limit)
+
+@app.get("/stock/categories/", response_model=schemas.Page[schemas.CategoryStock]) # storage units of the items directly in each category
+async def read_stock_by_categories(cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), db: Session = Depends(get_read_db)):
+    return await db.run_sync(crud.get_stock_by_categories, cursor, limit)
+
+@app.get("/stock/category/{category_id}/", response_model=schemas.CategoryStock) # storage units of the items in a category and its descendants
+async def read_stock_by_category_subtree(category_id: int, db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.categories, crud.get_category_by_id, category_id):
+        raise HTTPException(status_code=404, detail="Category not found")
+    return await db.run_sync(crud.get_stock_by_category_subtree, category_id)
+
 # CABINETS UNLOCK ATTEMPTS
 
-@app.get("/unlock-attempts/", response_model=List[schemas.CabinetUnlockAttempt])
-def read_all_unlock_attempts(db: Session = Depends(get_db)):
-    return crud.get_all_unlock_attempts(db)
+@app.get("/unlock-attempts/", response_model=schemas.Page[schemas.CabinetUnlockAttempt])
+async def read_all_unlock_attempts(cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.CabinetUnlockAttemptExpanded, schemas.CabinetUnlockAttempt)), db: Session = Depends(get_read_db)):
+    return page_response(schemas.CabinetUnlockAttempt, await db.run_sync(crud.get_all_unlock_attempts, cursor, limit, expand), expand, schemas.CabinetUnlockAttemptExpanded)
 
-@app.get("/unlock-attempts/cabinet/{cabinet_id}/", response_model=List[schemas.CabinetUnlockAttempt])
-def read_unlock_attempts_by_cabinet_id(cabinet_id: str, db: Session = Depends(get_db)):
-    db_cabinet = crud.get_cabinet_by_id(db, cabinet_id)
-    if db_cabinet is None:
+@app.get("/unlock-attempts/cabinet/{cabinet_id}/", response_model=schemas.Page[schemas.CabinetUnlockAttempt])
+async def read_unlock_attempts_by_cabinet_id(cabinet_id: str, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.CabinetUnlockAttemptExpanded, schemas.CabinetUnlockAttempt)), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.cabinets, crud.get_cabinet_by_id, cabinet_id):
         raise HTTPException(status_code=404, detail="Cabinet not found")
-    return crud.get_unlock_attempts_by_cabinet_id(db, cabinet_id)
+    return page_response(schemas.CabinetUnlockAttempt, await db.run_sync(crud.get_unlock_attempts_by_cabinet_id, cabinet_id, cursor, limit, expand), expand, schemas.CabinetUnlockAttemptExpanded)
 
-@app.get("/unlock-attempts/user/{uid}/", response_model=List[schemas.CabinetUnlockAttempt])
-def read_unlock_attempts_by_user_id(uid: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_uid(db, uid)
-    if db_user is None:
+@app.get("/unlock-attempts/user/{uid}/", response_model=schemas.Page[schemas.CabinetUnlockAttempt])
+async def read_unlock_attempts_by_user_id(uid: str, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.CabinetUnlockAttemptExpanded, schemas.CabinetUnlockAttempt)), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.users, crud.get_user_by_uid, uid):
         raise HTTPException(status_code=404, detail="User not found")
-    return crud.get_unlock_attempts_by_user_id(db, uid)
+    return page_response(schemas.CabinetUnlockAttempt, await db.run_sync(crud.get_unlock_attempts_by_user_id, uid, cursor, limit, expand), expand, schemas.CabinetUnlockAttemptExpanded)
 
-@app.get("/unlock-attempts/cabinet/{cabinet_id}/user/{uid}/", response_model=List[schemas.CabinetUnlockAttempt])
-def read_unlock_attempts_by_cabinet_and_user_id(cabinet_id, uid: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_uid(db, uid)
-    db_cabinet = crud.get_cabinet_by_id(db, cabinet_id)
-    if db_user is None or db_cabinet is None:
+@app.get("/unlock-attempts/cabinet/{cabinet_id}/user/{uid}/", response_model=schemas.Page[schemas.CabinetUnlockAttempt])
+async def read_unlock_attempts_by_cabinet_and_user_id(cabinet_id, uid: str, cursor: Optional[int] = None, limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE), expand: List[str] = Depends(expansions(schemas.CabinetUnlockAttemptExpanded, schemas.CabinetUnlockAttempt)), db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.users, crud.get_user_by_uid, uid) or not await exists(db, cache.cabinets, crud.get_cabinet_by_id, cabinet_id):
         raise HTTPException(status_code=404, detail="User or cabinet not found")
-    return crud.get_unlock_attempts_by_cabinet_and_user_id(db, cabinet_id, uid)
+    return page_response(schemas.CabinetUnlockAttempt, await db.run_sync(crud.get_unlock_attempts_by_cabinet_and_user_id, cabinet_id, uid, cursor, limit, expand), expand, schemas.CabinetUnlockAttemptExpanded)
+
+@app.get("/unlock-attempts/export/") # streams the unlock attempts matching the filters as NDJSON or CSV
+async def export_unlock_attempts(request: Request, format: str = Query("ndjson", regex="^(ndjson|csv)$"), cabinet_id: Optional[str] = None, user_id: Optional[str] = None,
+                                 start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None):
+    statement = crud.select_unlock_attempts(cabinet_id, user_id, start, end)
+    return StreamingResponse(export.export(await read_session_factory(request), statement, format), media_type=export.MEDIA_TYPES[format],
+                             headers={'Content-Disposition': f'attachment; filename="cabinets_unlock_attempts.{format}"'})
+
+@app.get("/unlock-attempts/stats/cabinet/{cabinet_id}/", response_model=schemas.UnlockAttemptStats) # attempts and denial rate per hour or day, from the rollups
+async def read_unlock_attempt_stats_by_cabinet_id(cabinet_id: str, granularity: str = Query("day", regex="^(hour|day)$"), start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None, db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.cabinets, crud.get_cabinet_by_id, cabinet_id):
+        raise HTTPException(status_code=404, detail="Cabinet not found")
+    return await db.run_sync(crud.get_unlock_attempt_stats, granularity, cabinet_id=cabinet_id, start=start, end=end)
+
+@app.get("/unlock-attempts/stats/user/{uid}/", response_model=schemas.UnlockAttemptStats) # attempts and denial rate per hour or day, from the rollups
+async def read_unlock_attempt_stats_by_user_id(uid: str, granularity: str = Query("day", regex="^(hour|day)$"), start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None, db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.users, crud.get_user_by_uid, uid):
+        raise HTTPException(status_code=404, detail="User not found")
+    return await db.run_sync(crud.get_unlock_attempt_stats, granularity, user_id=uid, start=start, end=end)
+
+@app.get("/unlock-attempts/stats/cabinet/{cabinet_id}/busiest-hours/", response_model=List[schemas.UnlockAttemptHourStats])
+async def read_unlock_attempt_busiest_hours(cabinet_id: str, db: Session = Depends(get_read_db)):
+    if not await exists(db, cache.cabinets, crud.get_cabinet_by_id, cabinet_id):
+        raise HTTPException(status_code=404, detail="Cabinet not found")
+    return await db.run_sync(crud.get_unlock_attempt_busiest_hours, cabinet_id)
 
 @app.post("/unlock-attempt/", response_model=schemas.CabinetUnlockAttempt)
-def create_unlock_attempt(unlock_attempt: schemas.CabinetUnlockAttemptCreate , db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_uid(db, unlock_attempt.user_id)
-    db_cabinet = crud.get_cabinet_by_id(db, unlock_attempt.cabinet_id)
-    if db_user is None or db_cabinet is None:
+async def create_unlock_attempt(unlock_attempt: schemas.CabinetUnlockAttemptCreate , db: Session = Depends(get_db)):
+    if unlock_attempt_writer is not None: # write-behind : answer 202 now, the attempt is inserted with the next batch
+        if not await unlock_attempt_writer.is_known(unlock_attempt.user_id, unlock_attempt.cabinet_id):
+            raise HTTPException(status_code=404, detail="User or cabinet not found")
+        queue_unlock_attempt(unlock_attempt.user_id, unlock_attempt.cabinet_id, unlock_attempt.granted, ingestion.now()) # published by the flush that commits it
+        return JSONResponse(status_code=202, content={'Queued unlock attempt for cabinet': unlock_attempt.cabinet_id})
+    try:
+        db_unlock_attempt = await db.run_sync(crud.create_unlock_attempt, unlock_attempt)
+    except IntegrityError:
         raise HTTPException(status_code=404, detail="User or cabinet not found")
-    return crud.create_unlock_attempt(db, unlock_attempt)
-
-@app.delete("/unlock-attempts/days/{n}/")
-def delete_unlock_attempts_older_than(n: int, db: Session = Depends(get_db)):
-    db.execute(f"delete from cabinets_unlock_attempts where date < now() - interval '{n} days';")
-    db.commit()
-    return {'Deleted all cabinets unlock attempts older than number of days': n}
\ No newline at end of file
+    await publish(db_unlock_attempt.cabinet_id, 'unlock_attempt.created', schemas.CabinetUnlockAttempt.from_orm(db_unlock_attempt))
+    return db_unlock_attempt
+
+@app.post("/unlock-attempts/batch/") # for gateways that already aggregate unlock attempts
+async def create_unlock_attempts(unlock_attempts: List[schemas.CabinetUnlockAttemptEvent] = Body(..., max_items=crud.MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    user_uids = await db.run_sync(crud.get_existing_user_uids, {unlock_attempt.user_id for unlock_attempt in unlock_attempts})
+    cabinet_ids = await db.run_sync(crud.get_existing_cabinet_ids, {unlock_attempt.cabinet_id for unlock_attempt in unlock_attempts})
+    if any(unlock_attempt.user_id not in user_uids or unlock_attempt.cabinet_id not in cabinet_ids for unlock_attempt in unlock_attempts):
+        raise HTTPException(status_code=404, detail="User or cabinet not found")
+    received = ingestion.now()
+    unlock_attempts = [{**unlock_attempt.dict(), 'date': unlock_attempt.date or received} for unlock_attempt in unlock_attempts]
+    if unlock_attempts:
+        await db.run_sync(crud.create_unlock_attempts, unlock_attempts)
+    for unlock_attempt in unlock_attempts:
+        await publish(unlock_attempt['cabinet_id'], 'unlock_attempt.created', unlock_attempt)
+    return {'Created unlock attempts': len(unlock_attempts)}
+
+@app.delete("/unlock-attempts/days/{n}/") # purges in batches, ?background=true answers right away with a job to follow, ?archive= keeps the rows in a table or a .csv.gz file
+async def delete_unlock_attempts_older_than(request: Request, background_tasks: BackgroundTasks, n: int = Path(..., ge=0), background: bool = False, archive: Optional[str] = Query(None, regex="^(table|file)$")):
+    request.state.wrote = True # the purge runs on its own sessions rather than get_db, the client still reads from the primary after it
+    job = await asyncio.to_thread(retention.new_job, SessionLocal, n, archive)
+    if background:
+        background_tasks.add_task(retention.purge_unlock_attempts, SessionLocal, job)
+        return JSONResponse(status_code=202, content=job.dict())
+    await asyncio.to_thread(retention.purge_unlock_attempts, SessionLocal, job)
+    return {'Deleted all cabinets unlock attempts older than number of days': n}
+
+@app.get("/unlock-attempts/purges/{job_id}/", response_model=schemas.UnlockAttemptPurge)
+async def read_unlock_attempts_purge(job_id: int, db: Session = Depends(get_db)):
+    job = await db.run_sync(crud.get_unlock_attempt_purge, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Purge job not found")
+    return job
\ No newline at end of file
@@ -0,0 +1,96 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+
+from collections import defaultdict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', '0')) # seconds, statements at least this slow are logged, 0 logs none
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    # cumulative histogram per label values, rendered in the Prometheus text format
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = defaultdict(lambda: [[0] * len(buckets), 0.0, 0]) # label values : bucket counts, sum, count
+        self._lock = threading.Lock() # observed from worker threads too
+
+    def observe(self, value: float, *labelvalues):
+        with self._lock:
+            series = self._series[labelvalues]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labelvalues, (counts, total, count) in sorted(self._series.items()):
+                labels = [f'{name}="{value}"' for name, value in zip(self.labelnames, labelvalues)]
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts + [count]):
+                    lines.append(self.name + '_bucket{' + ','.join(labels + [f'le="{bound}"']) + '} ' + str(bucket_count))
+                suffix = '{' + ','.join(labels) + '}' if labels else ''
+                lines.append(f"{self.name}_sum{suffix} {total}")
+                lines.append(f"{self.name}_count{suffix} {count}")
+        return '\n'.join(lines)
+
+request_duration = Histogram('http_request_duration_seconds', "Time spent handling requests", ('route', 'method', 'status'))
+request_statements = Histogram('http_request_sql_statements', "SQL statements executed per request", ('route',), COUNT_BUCKETS)
+request_sql_duration = Histogram('http_request_sql_duration_seconds', "Time spent in SQL statements per request", ('route',))
+statement_duration = Histogram('sql_statement_duration_seconds', "Time spent in each SQL statement")
+pool_wait = Histogram('db_pool_checkout_wait_seconds', "Time spent waiting for a pooled connection")
+HISTOGRAMS = (request_duration, request_statements, request_sql_duration, statement_duration, pool_wait)
+
+class RequestStats:
+    def __init__(self):
+        self.statements = 0
+        self.sql_duration = 0.0
+
+# the stats of the request being handled, worker threads started with asyncio.to_thread see the same object
+current_request = contextvars.ContextVar('current_request', default=None)
+
+def render():
+    return '\n'.join(histogram.render() for histogram in HISTOGRAMS) + '\n'
+
+def timed_pool(pool_class):
+    # pool_class reporting how long each checkout waited for a connection
+    class TimedPool(pool_class):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                pool_wait.observe(time.perf_counter() - start)
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+def instrument(engine: Engine):
+    # times every statement run by engine, and counts it for the current request if any
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info['query_start'].pop()
+        statement_duration.observe(duration)
+        stats = current_request.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_duration += duration
+        if SLOW_QUERY_THRESHOLD and duration >= SLOW_QUERY_THRESHOLD:
+            logger.warning("Slow query (%.3fs) : %s", duration, statement)
@@ -1,5 +1,5 @@
 from database import Base
-from sqlalchemy import ForeignKey, Integer, String, Float, Column, Boolean, DateTime
+from sqlalchemy import ForeignKey, Integer, String, Float, Column, Boolean, Date, DateTime, Index, MetaData, Table
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -26,7 +26,7 @@ class Category(Base):
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False, unique=True)
     description = Column(String)
-    parent_id = Column(Integer, ForeignKey('categories.id', ondelete='SET NULL'), nullable=True)
+    parent_id = Column(Integer, ForeignKey('categories.id', ondelete='SET NULL'), nullable=True, index=True)
 
     category = relationship("Category", remote_side=[id]) # exampleCategory.category returns the category's parent
     items = relationship("Item", backref="category") # we can call exampleItem.category and exampleCategory.items
@@ -38,32 +38,105 @@ class Item(Base):
     description = Column(String)
     price = Column(Float)
     link = Column(String)
-    category_id = Column(Integer, ForeignKey('categories.id', ondelete='SET NULL'))
+    category_id = Column(Integer, ForeignKey('categories.id', ondelete='SET NULL'), index=True)
 
 class OrderRequest(Base):
     __tablename__ = 'order_requests'
+    __table_args__ = (Index('uq_order_requests_item_id_user_id', 'item_id', 'user_id', unique=True),)
     id = Column(Integer, primary_key=True)
     date = Column(DateTime(timezone=True), server_default=func.current_timestamp())
-    state = Column(Integer, default=0)
+    state = Column(Integer, default=0, index=True)
     item_id = Column(Integer, ForeignKey('items.id', ondelete='CASCADE'))
-    user_id = Column(String, ForeignKey('users.uid', ondelete='CASCADE'))
+    user_id = Column(String, ForeignKey('users.uid', ondelete='CASCADE'), index=True)
 
     item = relationship("Item", backref="orders") # we can call exampleItem.orders and exampleOrder.item
 
+class OrderRequestTransition(Base):
+    __tablename__ = 'order_request_transitions' # allowed order request state changes, see DB/migrations/006_order_request_transitions.sql
+    to_state = Column(Integer, primary_key=True)
+    from_state = Column(Integer, primary_key=True)
+
 class StorageUnit(Base):
     __tablename__ = 'storage_units'
     id = Column(Integer, primary_key=True)
     state = Column(Integer, default=0)
     verified = Column(Boolean, default=False)
-    item_id = Column(Integer, ForeignKey('items.id', ondelete='SET NULL'))
-    cabinet_id = Column(String, ForeignKey('cabinets.id', ondelete='SET NULL'))
+    item_id = Column(Integer, ForeignKey('items.id', ondelete='SET NULL'), index=True)
+    cabinet_id = Column(String, ForeignKey('cabinets.id', ondelete='SET NULL'), index=True)
 
     item = relationship("Item", backref="storage_units") # we can call exampleItem.storage_units and exampleStorageUnit.item
 
+# storage_units counted per item and cabinet by a trigger (DB/migrations/005_storage_unit_stock.sql), kept out of Base.metadata
+# so create_all doesn't create it without the trigger, crud reads storage_units directly where the table doesn't exist
+storage_unit_stock = Table('storage_unit_stock', MetaData(),
+    Column('item_id', Integer),
+    Column('cabinet_id', String),
+    Column('units', Integer),
+    Column('available', Integer), # storage units in state 0
+    Column('verified', Integer),
+)
+
 class CabinetUnlockAttempt(Base):
     __tablename__ = 'cabinets_unlock_attempts'
+    __table_args__ = (
+        Index('ix_cabinets_unlock_attempts_cabinet_id_user_id_date', 'cabinet_id', 'user_id', 'date'),
+        Index('ix_cabinets_unlock_attempts_user_id_date', 'user_id', 'date'),
+    )
     id = Column(Integer, primary_key=True)
-    date = Column(DateTime(timezone=True), server_default=func.current_timestamp())
+    date = Column(DateTime(timezone=True), server_default=func.current_timestamp(), index=True)
     granted = Column(Boolean, default=False)
     user_id = Column(String, ForeignKey('users.uid', ondelete='CASCADE'))
-    cabinet_id = Column(String, ForeignKey('cabinets.id', ondelete='CASCADE'))
\ No newline at end of file
+    cabinet_id = Column(String, ForeignKey('cabinets.id', ondelete='CASCADE'))
+
+class CabinetUnlockAttemptArchive(Base):
+    __tablename__ = 'cabinets_unlock_attempts_archive' # purged unlock attempts, kept without foreign keys so they outlive their users and cabinets
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime(timezone=True))
+    granted = Column(Boolean)
+    user_id = Column(String)
+    cabinet_id = Column(String)
+
+class UnlockAttemptPurge(Base):
+    __tablename__ = 'unlock_attempt_purges' # progress of the retention jobs, any worker can report on a job another one runs
+    id = Column(Integer, primary_key=True)
+    cutoff = Column(DateTime(timezone=True), nullable=False)
+    archive = Column(String)
+    archive_path = Column(String)
+    status = Column(String, nullable=False, default='pending')
+    deleted = Column(Integer, nullable=False, default=0)
+    batches = Column(Integer, nullable=False, default=0)
+    error = Column(String)
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+class UnlockAttemptHourly(Base):
+    __tablename__ = 'unlock_attempts_hourly' # rollup of cabinets_unlock_attempts per cabinet, user and hour, kept up to date by crud
+    __table_args__ = (Index('ix_unlock_attempts_hourly_user_id_hour', 'user_id', 'hour'),)
+    cabinet_id = Column(String, ForeignKey('cabinets.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(String, ForeignKey('users.uid', ondelete='CASCADE'), primary_key=True)
+    hour = Column(DateTime(timezone=True), primary_key=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    granted = Column(Integer, nullable=False, default=0)
+
+class UnlockAttemptDaily(Base):
+    __tablename__ = 'unlock_attempts_daily' # rollup of cabinets_unlock_attempts per cabinet, user and day, kept up to date by crud
+    __table_args__ = (Index('ix_unlock_attempts_daily_user_id_day', 'user_id', 'day'),)
+    cabinet_id = Column(String, ForeignKey('cabinets.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(String, ForeignKey('users.uid', ondelete='CASCADE'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    granted = Column(Integer, nullable=False, default=0)
+
+class TableVersion(Base):
+    __tablename__ = 'table_versions' # bumped by crud whenever rows of table_name change, for the ETags of the reads of that table
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    modified_at = Column(DateTime(timezone=True), nullable=False, server_default=func.current_timestamp())
+
+class CabinetPermission(Base):
+    __tablename__ = 'cabinet_permissions' # users allowed to open a cabinet, revoked rows are kept with granted false so workers can catch up on them
+    __table_args__ = (Index('ix_cabinet_permissions_cabinet_id_user_id', 'cabinet_id', 'user_id'),)
+    user_id = Column(String, ForeignKey('users.uid', ondelete='CASCADE'), primary_key=True)
+    cabinet_id = Column(String, ForeignKey('cabinets.id', ondelete='CASCADE'), primary_key=True)
+    granted = Column(Boolean, nullable=False, default=True)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.current_timestamp(), index=True)
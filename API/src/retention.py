@@ -0,0 +1,113 @@
+import csv
+import datetime
+import gzip
+import logging
+import os
+import time
+import crud
+
+from sqlalchemy.orm import sessionmaker
+
+
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '5000')) # rows deleted per transaction
+RETENTION_BATCH_PAUSE = float(os.environ.get('RETENTION_BATCH_PAUSE', '0')) # seconds between batches, lets autovacuum and replicas keep up
+RETENTION_ARCHIVE_DIR = os.environ.get('RETENTION_ARCHIVE_DIR', 'archives') # where archive='file' writes its .csv.gz
+RETENTION_MAX_JOBS = 100 # jobs kept in unlock_attempt_purges for progress reporting
+
+logger = logging.getLogger(__name__)
+
+
+class PurgeJob:
+    # the running state of a job, saved to its unlock_attempt_purges row as it progresses
+    def __init__(self, id: int, cutoff: datetime.datetime, archive: str = None):
+        self.id = id
+        self.cutoff = cutoff
+        self.archive = archive
+        self.archive_path = None
+        self.status = 'pending'
+        self.deleted = 0
+        self.batches = 0
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    def progress(self):
+        return {
+            'archive_path': self.archive_path,
+            'status': self.status,
+            'deleted': self.deleted,
+            'batches': self.batches,
+            'error': self.error,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    def dict(self):
+        return {
+            'id': self.id,
+            'cutoff': self.cutoff.isoformat(),
+            'archive': self.archive,
+            'archive_path': self.archive_path,
+            'status': self.status,
+            'deleted': self.deleted,
+            'batches': self.batches,
+            'error': self.error,
+            'started_at': self.started_at and self.started_at.isoformat(),
+            'finished_at': self.finished_at and self.finished_at.isoformat(),
+        }
+
+def new_job(session_factory: sessionmaker, days: int, archive: str = None):
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    with session_factory() as db:
+        return PurgeJob(crud.create_unlock_attempt_purge(db, cutoff, archive, RETENTION_MAX_JOBS), cutoff, archive)
+
+def save_job(session_factory: sessionmaker, job: PurgeJob):
+    with session_factory() as db:
+        crud.update_unlock_attempt_purge(db, job.id, job.progress())
+        db.commit()
+
+def purge_unlock_attempts(session_factory: sessionmaker, job: PurgeJob, batch_size: int = RETENTION_BATCH_SIZE):
+    # deletes the unlock attempts older than the job cutoff batch_size rows at a time, committing after each batch
+    # so locks are short and WAL is written progressively, archived rows are committed or written before their deletion commits,
+    # the job row is updated in the transaction of each batch
+    job.status = 'running'
+    job.started_at = datetime.datetime.now(datetime.timezone.utc)
+    archive_file = None
+    try:
+        if job.archive == 'file':
+            os.makedirs(RETENTION_ARCHIVE_DIR, exist_ok=True)
+            job.archive_path = os.path.join(RETENTION_ARCHIVE_DIR, f"cabinets_unlock_attempts_{job.cutoff:%Y%m%d}_{job.id}.csv.gz")
+            archive_file = gzip.open(job.archive_path, 'wt', newline='')
+            archive_writer = csv.DictWriter(archive_file, ['id', 'date', 'granted', 'user_id', 'cabinet_id'])
+            archive_writer.writeheader()
+        save_job(session_factory, job)
+        while True:
+            with session_factory() as db:
+                unlock_attempts = crud.delete_unlock_attempts_before(db, job.cutoff, batch_size)
+                if job.archive == 'table':
+                    crud.archive_unlock_attempts(db, unlock_attempts)
+                elif archive_file is not None:
+                    archive_writer.writerows(unlock_attempts)
+                    archive_file.flush()
+                deleted, batches = job.deleted + len(unlock_attempts), job.batches + 1
+                crud.update_unlock_attempt_purge(db, job.id, {'deleted': deleted, 'batches': batches})
+                db.commit()
+            job.deleted, job.batches = deleted, batches
+            if len(unlock_attempts) < batch_size:
+                break
+            time.sleep(RETENTION_BATCH_PAUSE)
+        job.status = 'done'
+    except Exception as error:
+        logger.exception("Unlock attempts purge %d failed after %d rows", job.id, job.deleted)
+        job.status = 'failed'
+        job.error = str(error)
+        raise
+    finally:
+        if archive_file is not None:
+            archive_file.close()
+        job.finished_at = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            save_job(session_factory, job)
+        except Exception:
+            logger.exception("Could not save the outcome of unlock attempts purge %d", job.id)
+    return job
@@ -2,9 +2,33 @@ import datetime
 
 from fastapi import Body, Form
 from pydantic import BaseModel
-from typing import Optional
+from pydantic.generics import GenericModel
+from typing import Generic, List, Optional, TypeVar, Union
 
 
+T = TypeVar('T')
+K = TypeVar('K')
+
+class Page(GenericModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str] = None # pass it back as ?cursor= to get the next page, None on the last page
+
+class Lookup(GenericModel, Generic[T, K]):
+    items: List[T] # in the order they were asked for
+    not_found: List[K]
+
+class ImportedRow(BaseModel):
+    row: int # 1 for the first row of the import
+    id: int
+
+class RowError(BaseModel):
+    row: int
+    detail: str
+
+class ImportReport(BaseModel):
+    created: List[ImportedRow]
+    errors: List[RowError] # the rows not imported, the others are
+
 class UserBase(BaseModel):
     uid: str
     firstname: Optional[str] = None
@@ -73,6 +97,22 @@ class OrderRequest(OrderRequestBase):
     class Config:
         orm_mode = True
 
+class OrderRequestStateChange(BaseModel):
+    state: int # 0 requested, 1 accepted, 2 ordered, 3 received, 4 refused
+    ids: Optional[List[int]] = None # the order requests to change, all the ones matching the other filters if None
+    item_id: Optional[int] = None
+    user_id: Optional[str] = None
+    from_state: Optional[int] = None
+
+class OrderRequestStateChangeResult(BaseModel):
+    updated: List[int]
+    rejected: List[int] # selected but with no transition from their state to the new one
+    not_found: List[int] # ids matching no order request
+
+class OrderRequestExpanded(OrderRequest): # ?expand=item,user
+    item: Optional[Item] = None
+    user: Optional[User] = None
+
 class StorageUnitBase(BaseModel):
     id: int
     state: Optional[int] = 0
@@ -88,6 +128,22 @@ class StorageUnit(StorageUnitBase):
     class Config:
         orm_mode = True
 
+class StorageUnitSnapshot(BaseModel): # a storage unit as reported by its cabinet
+    id: int
+    state: Optional[int] = 0
+    verified: Optional[bool] = False
+    item_id: int
+
+class CabinetSync(BaseModel): # storage unit ids by change applied
+    created: List[int]
+    updated: List[int] # changed or moved from another cabinet
+    deleted: List[int]
+    unchanged: int
+
+class StorageUnitExpanded(StorageUnit): # ?expand=item,cabinet
+    item: Optional[Item] = None
+    cabinet: Optional[Cabinet] = None
+
 class CabinetUnlockAttemptBase(BaseModel):
     user_id: str
     cabinet_id: str
@@ -96,9 +152,70 @@ class CabinetUnlockAttemptBase(BaseModel):
 class CabinetUnlockAttemptCreate(CabinetUnlockAttemptBase):
     pass
 
+class CabinetUnlockAttemptEvent(CabinetUnlockAttemptBase):
+    date: Optional[datetime.datetime] = None # when the gateway saw the attempt, defaults to reception time
+
+class UnlockRequest(BaseModel):
+    user_id: str
+
+class UnlockDecision(BaseModel):
+    granted: bool
+
 class CabinetUnlockAttempt(CabinetUnlockAttemptBase):
     id: int
     date: datetime.datetime
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class CabinetUnlockAttemptExpanded(CabinetUnlockAttempt): # ?expand=user,cabinet
+    user: Optional[User] = None
+    cabinet: Optional[Cabinet] = None
+
+class UnlockAttemptPurge(BaseModel): # a DELETE /unlock-attempts/days/{n}/ job
+    id: int
+    cutoff: datetime.datetime
+    archive: Optional[str] = None
+    archive_path: Optional[str] = None
+    status: str # pending, running, done or failed
+    deleted: int
+    batches: int
+    error: Optional[str] = None
+    started_at: Optional[datetime.datetime] = None
+    finished_at: Optional[datetime.datetime] = None
+
+    class Config:
+        orm_mode = True
+
+class UnlockAttemptCounts(BaseModel):
+    attempts: int
+    granted: int
+    denied: int
+    denial_rate: float
+
+class UnlockAttemptPeriodStats(UnlockAttemptCounts):
+    period: Union[datetime.datetime, datetime.date] # start of the hour or day
+
+class UnlockAttemptStats(UnlockAttemptCounts):
+    periods: List[UnlockAttemptPeriodStats]
+
+class UnlockAttemptHourStats(BaseModel):
+    hour: int # hour of the day, 0 to 23
+    attempts: int
+
+class Stock(BaseModel):
+    units: int
+    available: int # storage units in state 0
+    verified: int
+
+class ItemStock(Stock):
+    item_id: int
+
+class CabinetStock(Stock):
+    cabinet_id: Optional[str] = None # None for the storage units assigned to no cabinet
+
+class ItemStockDetail(ItemStock):
+    cabinets: List[CabinetStock]
+
+class CategoryStock(Stock):
+    category_id: int
@@ -0,0 +1,36 @@
+import difflib
+import re
+
+
+SEARCH_CONFIG = 'simple' # text search configuration, no stemming or stop words so product names and references match as typed
+TYPO_SIMILARITY = 0.6 # like pg_trgm.word_similarity_threshold, how close a misspelt word must be to a title word
+
+WORD = re.compile(r'[^\W_]+')
+
+
+def tokenize(text: str):
+    return [word.lower() for word in WORD.findall(text or '')]
+
+def prefix_query(words: list):
+    # to_tsquery text matching documents holding every word, the last ones possibly still being typed
+    return ' & '.join(f"{word}:*" for word in words)
+
+def trigrams(word: str):
+    # the three letter pieces of word, a misspelt word still shares some with the word it was meant to be, like pg_trgm
+    return [word[start:start + 3] for start in range(len(word) - 2)] or [word]
+
+def score(words: list, title: str, description: str = None):
+    # in-memory stand-in for the ranking of crud.search_items when there is no PostgreSQL : every word has to prefix a word of
+    # the title or description, or be a near miss of a title word, 0 means no match
+    document = tokenize(title) + tokenize(description)
+    title_words = tokenize(title)
+    total = 0.0
+    for word in words:
+        if any(document_word.startswith(word) for document_word in document):
+            total += 1
+            continue
+        similarity = max((difflib.SequenceMatcher(None, word, title_word).ratio() for title_word in title_words), default=0)
+        if similarity < TYPO_SIMILARITY:
+            return 0.0
+        total += similarity
+    return total
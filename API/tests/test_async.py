@@ -0,0 +1,89 @@
+import cache
+import database
+import pytest
+
+from app.main import app, get_db, get_read_db
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    # async SQLite stand-in for the async Postgres engine
+    path = tmp_path_factory.mktemp("async") / "smartinventory.db"
+    database.Base.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    AsyncSessionLocal = database.make_async_sessionmaker(f"sqlite+aiosqlite:///{path}")
+
+    async def get_async_db():
+        async with AsyncSessionLocal() as db:
+            assert isinstance(db, AsyncSession)
+            yield db
+
+    app.dependency_overrides[get_db] = get_async_db
+    app.dependency_overrides[get_read_db] = get_async_db
+    cache.clear()
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+    cache.clear() # the stand-in database shares ids with the other tests
+
+def test_async_create_and_read_item(client):
+    response = client.post("/category/", json={"title": "Electronics"})
+    assert response.status_code == 200
+    response = client.post("/item/", json={"title": "Arduino Uno", "price": 24.5, "category_id": response.json()["id"]})
+    assert response.status_code == 200
+    assert response.json() == {
+        "id": 1,
+        "title": "Arduino Uno",
+        "description": None,
+        "price": 24.5,
+        "link": None,
+        "category_id": 1
+    }
+    response = client.get("/items/")
+    assert response.status_code == 200
+    assert response.json() == {"items": [client.get("/item/1/").json()], "next_cursor": None}
+
+def test_async_unlock_attempt(client):
+    assert client.post("/user/", json={"uid": "ASYNC000001"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-ASYNC"}).status_code == 200
+    response = client.post("/unlock-attempt/", json={"user_id": "ASYNC000001", "cabinet_id": "CAB-ASYNC", "granted": True})
+    assert response.status_code == 200
+    assert response.json()["granted"] is True
+    response = client.get("/unlock-attempts/cabinet/CAB-ASYNC/")
+    assert response.status_code == 200
+    assert [attempt["user_id"] for attempt in response.json()["items"]] == ["ASYNC000001"]
+
+def test_async_stock(client):
+    # SQLite has no trigger maintained storage_unit_stock table, the counts come from storage_units directly
+    assert client.post("/storage-unit/", json={"id": 1, "item_id": 1, "cabinet_id": "CAB-ASYNC", "verified": True}).status_code == 200
+    assert client.post("/storage-unit/", json={"id": 2, "item_id": 1, "cabinet_id": "CAB-ASYNC", "state": 1}).status_code == 200
+    response = client.get("/stock/item/1/")
+    assert response.status_code == 200
+    assert response.json() == {"item_id": 1, "units": 2, "available": 1, "verified": 1, "cabinets": [{"cabinet_id": "CAB-ASYNC", "units": 2, "available": 1, "verified": 1}]}
+    response = client.get("/stock/category/1/")
+    assert response.json() == {"category_id": 1, "units": 2, "available": 1, "verified": 1}
+
+def test_async_import_items(client):
+    response = client.post("/items/import/", json=[{"title": "Raspberry Pi 4", "category_id": 1}, {"title": "Arduino Uno"}])
+    assert response.status_code == 200
+    assert response.json() == {"created": [{"row": 1, "id": 2}], "errors": [{"row": 2, "detail": "Item already exists"}]}
+
+def test_async_search_items(client):
+    # SQLite has no text search index, the items kept by a LIKE per word are scored by search.score
+    assert [item["title"] for item in client.get("/items/search/", params={"q": "rasp"}).json()] == ["Raspberry Pi 4"]
+    assert [item["title"] for item in client.get("/items/search/", params={"q": "arduno"}).json()] == ["Arduino Uno"]
+    assert client.get("/items/search/", params={"q": "keyboard"}).json() == []
+
+def test_async_delete_item(client):
+    response = client.delete("/item/1/")
+    assert response.status_code == 200
+    assert response.json() == {'Deleted item with id': 1}
+    response = client.get("/item/1/")
+    assert response.status_code == 404
+
+def test_thread_executor_matches_pool():
+    # one worker thread per connection the sync pool can open
+    executor = database.thread_executor()
+    assert executor._max_workers == database.POOL_OPTIONS['pool_size'] + database.POOL_OPTIONS['max_overflow']
+    executor.shutdown()
@@ -0,0 +1,19 @@
+import cache
+import time
+
+
+def test_key_cache_evicts_least_recently_used():
+    key_cache = cache.KeyCache(maxsize=2, ttl=60)
+    key_cache.add("a", "b")
+    assert key_cache.known("a")
+    key_cache.add("c")
+    assert not key_cache.known("b")
+    assert key_cache.known("a") and key_cache.known("c")
+    assert key_cache.stats() == {'hits': 3, 'misses': 1, 'size': 2}
+
+def test_key_cache_expires_keys():
+    key_cache = cache.KeyCache(maxsize=2, ttl=0.01)
+    key_cache.add("a")
+    time.sleep(0.02)
+    assert not key_cache.known("a")
+    assert key_cache.stats() == {'hits': 0, 'misses': 1, 'size': 0}
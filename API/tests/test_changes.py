@@ -0,0 +1,86 @@
+import asyncio
+import asyncpg
+import changes
+import database
+import pytest
+
+
+class FakeRequest:
+    def __init__(self, polls: int):
+        self.polls = polls
+
+    async def is_disconnected(self):
+        self.polls -= 1
+        return self.polls < 0
+
+def test_broadcaster_fans_out_per_cabinet():
+    async def run():
+        broadcaster = changes.Broadcaster(queue_size=2)
+        first, second, other = broadcaster.subscribe("CAB-1"), broadcaster.subscribe("CAB-1"), broadcaster.subscribe("CAB-2")
+        await broadcaster.publish("CAB-1", "storage_unit.deleted", {"id": 1})
+        assert first.get_nowait() == second.get_nowait() == {"type": "storage_unit.deleted", "cabinet_id": "CAB-1", "data": {"id": 1}}
+        assert other.empty()
+        for id in range(3): # one more than the queue holds
+            await broadcaster.publish("CAB-1", "storage_unit.deleted", {"id": id})
+        assert first.get_nowait()["type"] == "resync"
+        broadcaster.unsubscribe("CAB-1", first)
+        broadcaster.unsubscribe("CAB-1", second)
+        assert "CAB-1" not in broadcaster.subscribers
+    asyncio.run(run())
+
+def test_stream_formats_server_sent_events():
+    async def run():
+        broadcaster = changes.Broadcaster()
+        events = changes.stream(broadcaster, FakeRequest(polls=1), "CAB-1")
+        next_event = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0)
+        await broadcaster.publish("CAB-1", "storage_unit.created", {"id": 1})
+        assert await next_event == 'event: storage_unit.created\ndata: {"id": 1}\n\n'
+        with pytest.raises(StopAsyncIteration):
+            await events.__anext__()
+        assert not broadcaster.subscribers
+    asyncio.run(run())
+
+@pytest.mark.skipif(database.engine.dialect.name != 'postgresql', reason="LISTEN/NOTIFY needs PostgreSQL")
+def test_postgres_broadcaster_round_trip():
+    async def run():
+        broadcaster = changes.PostgresBroadcaster(database.DATABASE_URL, channel="test_cabinet_changes")
+        await broadcaster.start()
+        try:
+            queue = broadcaster.subscribe("CAB-1")
+            await broadcaster.publish("CAB-1", "storage_unit.deleted", {"id": 1})
+            assert await asyncio.wait_for(queue.get(), 5) == {"type": "storage_unit.deleted", "cabinet_id": "CAB-1", "data": {"id": 1}}
+            await broadcaster.publish("CAB-1", "storage_units.synced", {"deleted": list(range(5000))})
+            assert (await asyncio.wait_for(queue.get(), 5))["type"] == "resync" # over the NOTIFY payload limit
+        finally:
+            await broadcaster.stop()
+    asyncio.run(run())
+
+@pytest.mark.skipif(database.engine.dialect.name != 'postgresql', reason="LISTEN/NOTIFY needs PostgreSQL")
+def test_postgres_broadcaster_reconnects():
+    async def run():
+        broadcaster = changes.PostgresBroadcaster(database.DATABASE_URL, channel="test_cabinet_changes", reconnect_delay=0.05)
+        await broadcaster.start()
+        try:
+            queue = broadcaster.subscribe("CAB-1")
+            killer = await asyncpg.connect(database.DATABASE_URL)
+            await killer.execute("SELECT pg_terminate_backend($1)", broadcaster.connection.get_server_pid())
+            await killer.close()
+            assert (await asyncio.wait_for(queue.get(), 5))["type"] == "resync" # events may have been missed
+            await broadcaster.publish("CAB-1", "storage_unit.deleted", {"id": 1})
+            assert (await asyncio.wait_for(queue.get(), 5))["type"] == "storage_unit.deleted"
+        finally:
+            await broadcaster.stop()
+    asyncio.run(run())
+
+@pytest.mark.skipif(database.engine.dialect.name != 'postgresql', reason="LISTEN/NOTIFY needs PostgreSQL")
+def test_postgres_broadcaster_starts_without_database():
+    async def run():
+        broadcaster = changes.PostgresBroadcaster(database.DATABASE_URL.replace("smartinventory", "missing_smartinventory"), reconnect_delay=0.05)
+        await broadcaster.start()
+        try:
+            with pytest.raises(ConnectionError):
+                await broadcaster.publish("CAB-1", "storage_unit.deleted", {"id": 1})
+        finally:
+            await broadcaster.stop()
+    asyncio.run(run())
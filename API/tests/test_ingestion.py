@@ -0,0 +1,116 @@
+import asyncio
+import database
+import ingestion
+import models
+import pytest
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+@pytest.fixture
+def SessionLocal(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'smartinventory.db'}")
+    database.Base.metadata.create_all(engine)
+    SessionLocal = sessionmaker(bind=engine)
+    with SessionLocal() as db:
+        db.add_all([models.User(uid="WRITER00001"), models.Cabinet(id="CAB-WRITER")])
+        db.commit()
+    return SessionLocal
+
+def count_unlock_attempts(SessionLocal):
+    with SessionLocal() as db:
+        return db.query(models.CabinetUnlockAttempt).count()
+
+def test_flush_on_batch_size(SessionLocal, tmp_path):
+    async def scenario():
+        writer = ingestion.UnlockAttemptWriter(SessionLocal, batch_size=3, flush_interval=60, spool_path=tmp_path / "spool")
+        await writer.start()
+        assert await writer.is_known("WRITER00001", "CAB-WRITER")
+        assert not await writer.is_known("UNKNOWN0001", "CAB-WRITER")
+        for granted in [True, False, True]:
+            writer.add("WRITER00001", "CAB-WRITER", granted)
+        await asyncio.sleep(0.2)
+        assert writer.queue == []
+        await writer.stop()
+    asyncio.run(scenario())
+    assert count_unlock_attempts(SessionLocal) == 3
+
+def test_spool_on_shutdown_failure(SessionLocal, tmp_path):
+    broken = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path / 'missing' / 'smartinventory.db'}"))
+    spool_path = tmp_path / "spool"
+    async def fail_then_replay():
+        writer = ingestion.UnlockAttemptWriter(broken, spool_path=spool_path)
+        writer.add("WRITER00001", "CAB-WRITER", True)
+        writer.add("WRITER00001", "CAB-WRITER", False)
+        await writer.stop()
+        assert len(list(tmp_path.glob("spool.*"))) == 1
+        writer = ingestion.UnlockAttemptWriter(SessionLocal, spool_path=spool_path)
+        await writer.start()
+        assert len(writer.queue) == 2
+        await writer.stop()
+    asyncio.run(fail_then_replay())
+    assert list(tmp_path.glob("spool*")) == []
+    assert count_unlock_attempts(SessionLocal) == 2
+
+def test_spool_replayed_once(SessionLocal, tmp_path):
+    # workers sharing the spool path each write their own file and claim a file before replaying it
+    broken = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path / 'missing' / 'smartinventory.db'}"))
+    spool_path = tmp_path / "spool"
+    async def scenario():
+        for granted in [True, False]:
+            writer = ingestion.UnlockAttemptWriter(broken, spool_path=spool_path)
+            writer.add("WRITER00001", "CAB-WRITER", granted)
+            await writer.stop()
+        assert len(list(tmp_path.glob("spool.*"))) == 2
+        writers = [ingestion.UnlockAttemptWriter(SessionLocal, spool_path=spool_path) for _ in range(2)]
+        await asyncio.gather(*(writer.start() for writer in writers))
+        assert sum(len(writer.queue) for writer in writers) == 2
+        await asyncio.gather(*(writer.stop() for writer in writers))
+    asyncio.run(scenario())
+    assert count_unlock_attempts(SessionLocal) == 2
+
+def test_queue_full(SessionLocal, tmp_path):
+    writer = ingestion.UnlockAttemptWriter(SessionLocal, spool_path=tmp_path / "spool", max_queued=2)
+    writer.add("WRITER00001", "CAB-WRITER", True)
+    writer.add("WRITER00001", "CAB-WRITER", True)
+    with pytest.raises(ingestion.QueueFull):
+        writer.add("WRITER00001", "CAB-WRITER", True)
+    asyncio.run(writer.stop())
+    assert count_unlock_attempts(SessionLocal) == 2
+
+def test_stop_waits_for_running_flush(SessionLocal, tmp_path):
+    # events taken off the queue by a flush still running when stop() is called are written, not lost with a cancelled task
+    class SlowWriter(ingestion.UnlockAttemptWriter):
+        def _insert(self, events):
+            if events[0]['granted']: # only the first flush is slow
+                time.sleep(0.2)
+            return super()._insert(events)
+    async def scenario():
+        writer = SlowWriter(SessionLocal, batch_size=1, flush_interval=60, spool_path=tmp_path / "spool")
+        await writer.start()
+        writer.add("WRITER00001", "CAB-WRITER", True)
+        await asyncio.sleep(0.05)
+        assert writer.queue == [] # being flushed
+        writer.add("WRITER00001", "CAB-WRITER", False)
+        await writer.stop()
+        assert count_unlock_attempts(SessionLocal) == 2
+    asyncio.run(scenario())
+
+def test_on_flush_gets_committed_events(SessionLocal, tmp_path):
+    flushed = []
+    async def on_flush(events):
+        flushed.append([event['granted'] for event in events])
+    broken = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path / 'missing' / 'smartinventory.db'}"))
+    async def scenario():
+        writer = ingestion.UnlockAttemptWriter(broken, spool_path=tmp_path / "spool", on_flush=on_flush)
+        writer.add("WRITER00001", "CAB-WRITER", True)
+        with pytest.raises(Exception):
+            await writer.flush()
+        assert flushed == [] # nothing committed, nothing published
+        writer.session_factory = SessionLocal
+        writer.add("UNKNOWN0001", "CAB-WRITER", False) # dropped at insert time
+        assert await writer.flush() == 1
+    asyncio.run(scenario())
+    assert flushed == [[True]]
@@ -1,5 +1,22 @@
+import access
+import asyncio
+import cache
+import changes
+import crud
+import csv
+import database
+import ingestion
+import io
+import json
+import metrics
+import models
+import pytest
+
+from app import main
 from app.main import app
 from fastapi.testclient import TestClient
+from sqlalchemy import event, func, select, update
+from sqlalchemy.exc import IntegrityError
 
 
 client = TestClient(app)
@@ -109,4 +126,667 @@ def test_delete_item():
 def test_delete_inexistent_item():
     response = client.delete("/item/999/")
     assert response.status_code == 404
-    assert response.json() == {"detail": "Item not found"}
\ No newline at end of file
+    assert response.json() == {"detail": "Item not found"}
+
+def test_paginate_users():
+    for uid in ["PAGE0000001", "PAGE0000002", "PAGE0000003"]:
+        response = client.post("/user/", json={"uid": uid})
+        assert response.status_code == 200
+    response = client.get("/users/", params={"cursor": "PAGE0000000", "limit": 2})
+    assert response.status_code == 200
+    assert [user["uid"] for user in response.json()["items"]] == ["PAGE0000001", "PAGE0000002"]
+    assert response.json()["next_cursor"] == "PAGE0000002"
+    response = client.get("/users/", params={"cursor": "PAGE0000002", "limit": 2})
+    assert response.status_code == 200
+    assert [user["uid"] for user in response.json()["items"]] == ["PAGE0000003"]
+    assert response.json()["next_cursor"] is None
+
+def test_paginate_limit_out_of_bounds():
+    response = client.get("/items/", params={"limit": 0})
+    assert response.status_code == 422
+    response = client.get("/items/", params={"limit": 100000})
+    assert response.status_code == 422
+
+def test_create_unlock_attempts_batch():
+    assert client.post("/user/", json={"uid": "BATCH000001"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-BATCH"}).status_code == 200
+    response = client.post("/unlock-attempts/batch/", json=[
+        {"user_id": "BATCH000001", "cabinet_id": "CAB-BATCH", "granted": True},
+        {"user_id": "BATCH000001", "cabinet_id": "CAB-BATCH", "granted": False, "date": "2022-03-01T10:00:00+00:00"},
+    ])
+    assert response.status_code == 200
+    assert response.json() == {'Created unlock attempts': 2}
+    response = client.get("/unlock-attempts/cabinet/CAB-BATCH/")
+    assert response.status_code == 200
+    assert [attempt["granted"] for attempt in response.json()["items"]] == [True, False]
+
+def test_create_unlock_attempts_batch_unknown_user():
+    response = client.post("/unlock-attempts/batch/", json=[
+        {"user_id": "BATCH000001", "cabinet_id": "CAB-BATCH"},
+        {"user_id": "UNKNOWN0001", "cabinet_id": "CAB-BATCH"},
+    ])
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User or cabinet not found"}
+
+def test_create_unlock_attempts_batch_too_large():
+    response = client.post("/unlock-attempts/batch/", json=[{"user_id": "BATCH000001", "cabinet_id": "CAB-BATCH"}] * (crud.MAX_PAGE_SIZE + 1))
+    assert response.status_code == 422
+
+def test_create_unlock_attempt_queue_full(monkeypatch):
+    writer = ingestion.UnlockAttemptWriter(database.SessionLocal, max_queued=0)
+    monkeypatch.setattr(main, "unlock_attempt_writer", writer)
+    response = client.post("/unlock-attempt/", json={"user_id": "BATCH000001", "cabinet_id": "CAB-BATCH", "granted": True})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert writer.queue == []
+
+def test_category_subtree():
+    root = client.post("/category/", json={"title": "Tree Root"}).json()
+    child = client.post("/category/", json={"title": "Tree Child", "parent_id": root["id"]}).json()
+    grandchild = client.post("/category/", json={"title": "Tree Grandchild", "parent_id": child["id"]}).json()
+    client.post("/item/", json={"title": "Tree Child Item", "category_id": child["id"]})
+    client.post("/item/", json={"title": "Tree Grandchild Item", "category_id": grandchild["id"]})
+    response = client.get(f"/categories/{root['id']}/descendants/")
+    assert response.status_code == 200
+    assert response.json() == {"items": [child, grandchild], "next_cursor": None}
+    response = client.get(f"/categories/{grandchild['id']}/ancestors/")
+    assert response.status_code == 200
+    assert response.json() == [root, child]
+    response = client.get(f"/categories/{root['id']}/subtree/items/")
+    assert response.status_code == 200
+    assert [item["title"] for item in response.json()["items"]] == ["Tree Child Item", "Tree Grandchild Item"]
+
+def test_category_subtree_inexistent_category():
+    response = client.get("/categories/999/descendants/")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Category not found"}
+
+def test_existence_cache():
+    assert client.post("/user/", json={"uid": "CACHE000001"}).status_code == 200
+    hits = client.get("/cache/stats/").json()["users"]["hits"]
+    assert client.get("/order-requests/user/CACHE000001/").status_code == 200
+    assert client.get("/unlock-attempts/user/CACHE000001/").status_code == 200
+    assert client.get("/cache/stats/").json()["users"]["hits"] == hits + 2
+    assert client.delete("/user/CACHE000001/").status_code == 200
+    response = client.get("/order-requests/user/CACHE000001/")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User not found"}
+
+def test_create_order_request():
+    assert client.post("/user/", json={"uid": "ORDER000001"}).status_code == 200
+    item = client.post("/item/", json={"title": "Order Item"}).json()
+    response = client.post("/order-request/", json={"item_id": item["id"], "user_id": "ORDER000001"})
+    assert response.status_code == 200
+    assert response.json()["state"] == 0
+    response = client.post("/order-request/", json={"item_id": item["id"], "user_id": "ORDER000001"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Order already requested by this user"}
+    response = client.post("/order-request/", json={"item_id": 999999, "user_id": "ORDER000001"})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Item or user not found"}
+
+def test_create_storage_unit_constraint_errors():
+    item = client.post("/item/", json={"title": "Storage Unit Item"}).json()
+    response = client.post("/storage-unit/", json={"id": 7001, "item_id": item["id"], "cabinet_id": "CAB-MISSING"})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Cabinet not found"}
+    response = client.post("/storage-unit/", json={"id": 7001, "item_id": 999999})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Item not found"}
+    assert client.post("/storage-unit/", json={"id": 7001, "item_id": item["id"]}).status_code == 200
+    response = client.post("/storage-unit/", json={"id": 7001, "item_id": item["id"]})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Storage unit ID already assigned"}
+
+def test_create_category_missing_parent():
+    response = client.post("/category/", json={"title": "Orphan", "parent_id": 999999})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Parent category not found"}
+
+def test_delete_items_by_ids():
+    ids = [client.post("/item/", json={"title": f"Bulk Delete Item {n}"}).json()["id"] for n in range(3)]
+    response = client.delete("/items/", params={"ids": ids[:2] + [999999]})
+    assert response.status_code == 200
+    assert sorted(response.json()["Deleted items with ids"]) == ids[:2]
+    assert response.json()["Items not found"] == [999999]
+    assert client.get(f"/item/{ids[0]}/").status_code == 404
+    assert client.get(f"/item/{ids[2]}/").status_code == 200
+
+def test_delete_cabinet_cascades():
+    assert client.post("/user/", json={"uid": "CASCADE0001"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-CASCADE"}).status_code == 200
+    item = client.post("/item/", json={"title": "Cascade Item"}).json()
+    assert client.post("/storage-unit/", json={"id": 7101, "item_id": item["id"], "cabinet_id": "CAB-CASCADE"}).status_code == 200
+    assert client.post("/unlock-attempt/", json={"user_id": "CASCADE0001", "cabinet_id": "CAB-CASCADE"}).status_code == 200
+    response = client.delete("/cabinet/CAB-CASCADE/")
+    assert response.status_code == 200
+    assert response.json() == {'Deleted cabinet with id': "CAB-CASCADE"}
+    assert client.get("/storage-unit/7101/").json()["cabinet_id"] is None
+    assert client.get("/unlock-attempts/user/CASCADE0001/").json()["items"] == []
+    response = client.delete("/cabinet/CAB-CASCADE/")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Cabinet not found"}
+
+def test_purge_unlock_attempts_in_background():
+    assert client.post("/user/", json={"uid": "PURGE000001"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-PURGE"}).status_code == 200
+    client.post("/unlock-attempts/batch/", json=[
+        {"user_id": "PURGE000001", "cabinet_id": "CAB-PURGE", "date": "2020-01-01T00:00:00+00:00"},
+        {"user_id": "PURGE000001", "cabinet_id": "CAB-PURGE", "date": "2020-01-02T00:00:00+00:00"},
+        {"user_id": "PURGE000001", "cabinet_id": "CAB-PURGE"},
+    ])
+    response = client.delete("/unlock-attempts/days/365/", params={"background": True, "archive": "table"})
+    assert response.status_code == 202
+    response = client.get(f"/unlock-attempts/purges/{response.json()['id']}/")
+    assert response.status_code == 200
+    assert response.json()["status"] == "done"
+    assert response.json()["deleted"] >= 2
+    assert len(client.get("/unlock-attempts/cabinet/CAB-PURGE/").json()["items"]) == 1
+
+def test_purge_reads_from_primary_after(monkeypatch):
+    monkeypatch.setattr(database, "replicas", database.ReplicaSet([database.SessionLocal]))
+    response = TestClient(app).delete("/unlock-attempts/days/365/")
+    assert response.status_code == 200
+    assert response.cookies[main.PRIMARY_COOKIE] == "1"
+
+def test_purge_negative_days():
+    # a negative n would put the cutoff in the future and delete every unlock attempt
+    response = client.delete("/unlock-attempts/days/-1/")
+    assert response.status_code == 422
+    assert len(client.get("/unlock-attempts/cabinet/CAB-PURGE/").json()["items"]) == 1
+
+def test_read_inexistent_purge():
+    response = client.get("/unlock-attempts/purges/999999/")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Purge job not found"}
+
+def test_unlock_attempt_stats():
+    assert client.post("/user/", json={"uid": "STATS000001"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-STATS"}).status_code == 200
+    client.post("/unlock-attempts/batch/", json=[
+        {"user_id": "STATS000001", "cabinet_id": "CAB-STATS", "granted": True, "date": "2022-05-01T08:10:00"},
+        {"user_id": "STATS000001", "cabinet_id": "CAB-STATS", "granted": False, "date": "2022-05-01T08:40:00"},
+        {"user_id": "STATS000001", "cabinet_id": "CAB-STATS", "granted": True, "date": "2022-05-02T17:00:00"},
+    ])
+    response = client.get("/unlock-attempts/stats/cabinet/CAB-STATS/", params={"end": "2022-06-01T00:00:00"})
+    assert response.status_code == 200
+    assert response.json() == {
+        "attempts": 3, "granted": 2, "denied": 1, "denial_rate": 1 / 3,
+        "periods": [
+            {"period": "2022-05-01", "attempts": 2, "granted": 1, "denied": 1, "denial_rate": 0.5},
+            {"period": "2022-05-02", "attempts": 1, "granted": 1, "denied": 0, "denial_rate": 0.0},
+        ]
+    }
+    response = client.get("/unlock-attempts/stats/user/STATS000001/", params={"granularity": "hour", "start": "2022-05-02T00:00:00"})
+    assert response.status_code == 200
+    assert [period["attempts"] for period in response.json()["periods"]] == [1]
+    response = client.get("/unlock-attempts/stats/cabinet/CAB-STATS/busiest-hours/")
+    assert response.status_code == 200
+    assert response.json() == [{"hour": 8, "attempts": 2}, {"hour": 17, "attempts": 1}]
+
+def test_unlock_attempt_stats_utc_periods():
+    assert client.post("/user/", json={"uid": "STATS000002"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-STATS-UTC"}).status_code == 200
+    client.post("/unlock-attempts/batch/", json=[
+        {"user_id": "STATS000002", "cabinet_id": "CAB-STATS-UTC", "granted": True, "date": "2022-05-01T08:10:00+05:30"}, # 02:40 UTC
+        {"user_id": "STATS000002", "cabinet_id": "CAB-STATS-UTC", "granted": True, "date": "2022-05-01T23:10:00-05:00"}, # 04:10 UTC the next day
+    ])
+    response = client.get("/unlock-attempts/stats/cabinet/CAB-STATS-UTC/", params={"granularity": "hour"})
+    assert [period["period"] for period in response.json()["periods"]] == ["2022-05-01T02:00:00+00:00", "2022-05-02T04:00:00+00:00"]
+    response = client.get("/unlock-attempts/stats/cabinet/CAB-STATS-UTC/")
+    assert [period["period"] for period in response.json()["periods"]] == ["2022-05-01", "2022-05-02"]
+    response = client.get("/unlock-attempts/stats/cabinet/CAB-STATS-UTC/busiest-hours/")
+    assert response.json() == [{"hour": 2, "attempts": 1}, {"hour": 4, "attempts": 1}]
+
+def test_stock():
+    category = client.post("/category/", json={"title": "Stock Category"}).json()
+    item = client.post("/item/", json={"title": "Stock Item", "category_id": category["id"]}).json()
+    assert client.post("/cabinet/", json={"id": "CAB-STOCK-1"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-STOCK-2"}).status_code == 200
+    assert client.post("/storage-unit/", json={"id": 7201, "item_id": item["id"], "cabinet_id": "CAB-STOCK-1"}).status_code == 200
+    assert client.post("/storage-unit/", json={"id": 7202, "item_id": item["id"], "cabinet_id": "CAB-STOCK-1", "state": 1, "verified": True}).status_code == 200
+    assert client.post("/storage-unit/", json={"id": 7203, "item_id": item["id"], "cabinet_id": "CAB-STOCK-2"}).status_code == 200
+    response = client.get(f"/stock/item/{item['id']}/")
+    assert response.status_code == 200
+    assert response.json() == {
+        "item_id": item["id"], "units": 3, "available": 2, "verified": 1,
+        "cabinets": [
+            {"cabinet_id": "CAB-STOCK-1", "units": 2, "available": 1, "verified": 1},
+            {"cabinet_id": "CAB-STOCK-2", "units": 1, "available": 1, "verified": 0},
+        ]
+    }
+    response = client.get("/stock/cabinet/CAB-STOCK-1/")
+    assert response.json()["items"] == [{"item_id": item["id"], "units": 2, "available": 1, "verified": 1}]
+    response = client.get(f"/stock/category/{category['id']}/")
+    assert response.json() == {"category_id": category["id"], "units": 3, "available": 2, "verified": 1}
+    assert {"category_id": category["id"], "units": 3, "available": 2, "verified": 1} in client.get("/stock/categories/", params={"limit": 1000}).json()["items"]
+    assert client.delete("/storage-unit/7202/").status_code == 200
+    assert client.delete("/cabinet/CAB-STOCK-2/").status_code == 200
+    response = client.get(f"/stock/item/{item['id']}/")
+    assert response.json()["cabinets"] == [
+        {"cabinet_id": "CAB-STOCK-1", "units": 1, "available": 1, "verified": 0},
+        {"cabinet_id": None, "units": 1, "available": 1, "verified": 0},
+    ]
+    assert client.get("/stock/cabinet/CAB-STOCK-2/").status_code == 404
+
+def stock_counts():
+    # the counts kept by the trigger and the same counts grouped from storage_units
+    with database.SessionLocal() as db:
+        stock, storage_unit = crud.storage_unit_stock(db), models.StorageUnit
+        counted = db.execute(select(stock.c.item_id, stock.c.cabinet_id, stock.c.units, stock.c.available, stock.c.verified)).all()
+        grouped = db.execute(select(storage_unit.item_id, storage_unit.cabinet_id, func.count(), func.count().filter(storage_unit.state == 0),
+                                    func.count().filter(storage_unit.verified)).group_by(storage_unit.item_id, storage_unit.cabinet_id)).all()
+    return sorted(counted, key=str), sorted(grouped, key=str)
+
+def test_stock_counts_follow_writes():
+    item = client.post("/item/", json={"title": "Stock Count Item"}).json()
+    assert client.post("/cabinet/", json={"id": "CAB-COUNT"}).status_code == 200
+    assert client.post("/storage-unit/", json={"id": 7301, "item_id": item["id"]}).status_code == 200
+    snapshot = [{"id": 7301, "item_id": item["id"], "state": 1}, {"id": 7302, "item_id": item["id"], "verified": True}]
+    assert client.put("/storage-units/cabinet/CAB-COUNT/", json=snapshot).status_code == 200
+    counted, grouped = stock_counts()
+    assert counted == grouped
+    assert (item["id"], "CAB-COUNT", 2, 1, 1) in counted
+    assert client.put("/storage-units/cabinet/CAB-COUNT/", json=snapshot[1:]).status_code == 200
+    assert client.delete("/cabinet/CAB-COUNT/").status_code == 200
+    counted, grouped = stock_counts()
+    assert counted == grouped
+    assert all(row.cabinet_id != "CAB-COUNT" for row in counted)
+    assert client.delete("/storage-units/", params={"ids": [7301, 7302]}).status_code == 200
+    counted, grouped = stock_counts()
+    assert counted == grouped
+    assert all(row.item_id != item["id"] for row in counted)
+
+def test_export_unlock_attempts():
+    assert client.post("/user/", json={"uid": "EXPORT00001"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-EXPORT"}).status_code == 200
+    client.post("/unlock-attempts/batch/", json=[
+        {"user_id": "EXPORT00001", "cabinet_id": "CAB-EXPORT", "granted": True, "date": "2022-05-01T08:00:00+00:00"},
+        {"user_id": "EXPORT00001", "cabinet_id": "CAB-EXPORT", "granted": False, "date": "2022-06-01T08:00:00+00:00"},
+    ])
+    response = client.get("/unlock-attempts/export/", params={"cabinet_id": "CAB-EXPORT", "end": "2022-05-15T00:00:00+00:00"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [(row["user_id"], row["granted"], row["date"][:10]) for row in rows] == [("EXPORT00001", True, "2022-05-01")]
+    response = client.get("/unlock-attempts/export/", params={"cabinet_id": "CAB-EXPORT", "format": "csv"})
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["granted"] for row in rows] == ["True", "False"]
+    assert list(rows[0]) == ["id", "date", "granted", "user_id", "cabinet_id"]
+
+def test_export_order_requests():
+    response = client.get("/order-requests/export/", params={"user_id": "ORDER000001", "format": "csv"})
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["user_id"] for row in rows] == ["ORDER000001"]
+
+@pytest.mark.parametrize("path", ["/users/", "/cabinets/", "/categories/", "/categories/root/", "/items/", "/order-requests/", "/storage-units/", "/unlock-attempts/", "/unlock-attempts/cabinet/CAB-EXPORT/"])
+def test_fast_reads_match_response_models(monkeypatch, path):
+    fast = client.get(path, params={"limit": 1000})
+    monkeypatch.setattr(crud, "FAST_READS", False)
+    slow = client.get(path, params={"limit": 1000})
+    assert fast.status_code == slow.status_code == 200
+    assert fast.json()["items"]
+    assert fast.content == slow.content
+
+def test_fast_reads_same_bytes_for_floats_and_text(monkeypatch):
+    item = client.post("/item/", json={"title": "Float Item é", "price": 1e16}).json()
+    fast = client.get("/items/", params={"limit": 1000})
+    monkeypatch.setattr(crud, "FAST_READS", False)
+    slow = client.get("/items/", params={"limit": 1000})
+    assert b'"price":1e+16' in fast.content
+    assert fast.content == slow.content
+    assert client.delete(f"/item/{item['id']}/").status_code == 200
+
+def test_expand_order_requests():
+    cache.users.add("ORDER000001") # the existence check would be one more query
+    statements = []
+    def count(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(database.engine, 'before_cursor_execute', count)
+    try:
+        response = client.get("/order-requests/user/ORDER000001/", params={"expand": "item,user"})
+    finally:
+        event.remove(database.engine, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    order_request = response.json()["items"][0]
+    assert order_request["item"]["title"] == "Order Item"
+    assert order_request["user"] == {"uid": "ORDER000001", "firstname": None, "lastname": None}
+    assert len(statements) == 3 # the page, its items and its users
+    response = client.get("/storage-units/cabinet/CAB-STOCK-1/", params={"expand": "cabinet"})
+    assert response.status_code == 200
+    assert [(storage_unit["cabinet"]["id"], "item" in storage_unit) for storage_unit in response.json()["items"]] == [("CAB-STOCK-1", False)]
+    response = client.get("/unlock-attempts/cabinet/CAB-EXPORT/", params={"expand": "user,cabinet"})
+    assert {(attempt["user"]["uid"], attempt["cabinet"]["id"]) for attempt in response.json()["items"]} == {("EXPORT00001", "CAB-EXPORT")}
+    response = client.get("/order-requests/", params={"expand": "cabinet"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Cannot expand cabinet"}
+
+def test_lookup_items():
+    ids = [client.post("/item/", json={"title": f"Lookup Item {n}"}).json()["id"] for n in range(3)]
+    response = client.get("/items/lookup/", params={"ids": [ids[2], 999999, ids[0], ids[2]]})
+    assert response.status_code == 200
+    assert [item["id"] for item in response.json()["items"]] == [ids[2], ids[0]]
+    assert response.json()["items"][0]["title"] == "Lookup Item 2"
+    assert response.json()["not_found"] == [999999]
+
+def test_lookup_storage_units_by_body():
+    response = client.post("/storage-units/lookup/", json=[7203, 7201, 999999])
+    assert response.status_code == 200
+    assert [storage_unit["id"] for storage_unit in response.json()["items"]] == [7203, 7201]
+    assert response.json()["not_found"] == [999999]
+    response = client.post("/storage-units/lookup/", json=list(range(1001)))
+    assert response.status_code == 422
+
+def test_lookup_users():
+    response = client.get("/users/lookup/", params={"uids": ["ORDER000001", "MISSING0001"]})
+    assert response.status_code == 200
+    assert response.json() == {"items": [{"uid": "ORDER000001", "firstname": None, "lastname": None}], "not_found": ["MISSING0001"]}
+
+def test_import_items():
+    category = client.post("/category/", json={"title": "Import Category"}).json()
+    response = client.post("/items/import/", json=[
+        {"title": "Import Item 1", "price": 1.5, "category_id": category["id"]},
+        {"title": "Import Item 2"},
+        {"title": "Import Item 1"},
+        {"title": "Import Item 3", "category_id": 999999},
+        {"price": "free"},
+        {"title": "Order Item"},
+    ])
+    assert response.status_code == 200
+    assert [row["row"] for row in response.json()["created"]] == [1, 2]
+    assert response.json()["errors"] == [
+        {"row": 3, "detail": "Item already exists"},
+        {"row": 4, "detail": "Category not found"},
+        {"row": 5, "detail": "title: field required; price: value is not a valid float"},
+        {"row": 6, "detail": "Item already exists"},
+    ]
+    item = client.get(f"/item/{response.json()['created'][0]['id']}/").json()
+    assert (item["title"], item["price"], item["category_id"]) == ("Import Item 1", 1.5, category["id"])
+
+def test_import_storage_units_csv():
+    item = client.post("/item/", json={"title": "Import CSV Item"}).json()
+    body = f"id,item_id,cabinet_id,verified\n7301,{item['id']},CAB-STOCK-1,true\n7302,{item['id']},,\n7303,999999,CAB-STOCK-1,\n7304,{item['id']},CAB-MISSING,\n7201,{item['id']},,\n"
+    response = client.post("/storage-units/import/csv/", data=body, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 200
+    assert response.json() == {
+        "created": [{"row": 1, "id": 7301}, {"row": 2, "id": 7302}],
+        "errors": [
+            {"row": 3, "detail": "Item not found"},
+            {"row": 4, "detail": "Cabinet not found"},
+            {"row": 5, "detail": "Storage unit ID already assigned"},
+        ]
+    }
+    storage_unit = client.get("/storage-unit/7301/").json()
+    assert (storage_unit["cabinet_id"], storage_unit["verified"]) == ("CAB-STOCK-1", True)
+    assert client.get(f"/stock/item/{item['id']}/").json()["units"] == 2
+
+def test_import_csv_unreadable():
+    response = client.post("/items/import/csv/", data=b"title\nCaf\xe9\n", headers={"Content-Type": "text/csv"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Not UTF-8 at byte 9"}
+    response = client.post("/items/import/csv/", data="title\nUnread CSV Item\n" + "x" * 200000 + "\n", headers={"Content-Type": "text/csv"})
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Row 2: field larger than field limit")
+
+def test_sync_cabinet_storage_units():
+    assert client.post("/cabinet/", json={"id": "CAB-SYNC"}).status_code == 200
+    item = client.post("/item/", json={"title": "Sync Item"}).json()
+    for id in (7401, 7402, 7403):
+        assert client.post("/storage-unit/", json={"id": id, "item_id": item["id"], "cabinet_id": "CAB-SYNC"}).status_code == 200
+    response = client.put("/storage-units/cabinet/CAB-SYNC/", json=[
+        {"id": 7401, "item_id": item["id"]},
+        {"id": 7402, "item_id": item["id"], "state": 1},
+        {"id": 7301, "item_id": item["id"]},
+        {"id": 7404, "item_id": item["id"], "verified": True},
+    ])
+    assert response.status_code == 200
+    assert response.json() == {"created": [7404], "updated": [7301, 7402], "deleted": [7403], "unchanged": 1}
+    assert sorted(storage_unit["id"] for storage_unit in client.get("/storage-units/cabinet/CAB-SYNC/").json()["items"]) == [7301, 7401, 7402, 7404]
+    assert client.get("/storage-unit/7402/").json()["state"] == 1
+    assert client.get("/stock/cabinet/CAB-SYNC/").json()["items"] == [{"item_id": item["id"], "units": 4, "available": 3, "verified": 1}]
+    response = client.put("/storage-units/cabinet/CAB-SYNC/", json=[{"id": 7401, "item_id": 999999}])
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Items not found : 999999"}
+    response = client.put("/storage-units/cabinet/CAB-SYNC/", json=[{"id": 7401, "item_id": item["id"]}, {"id": 7401, "item_id": item["id"]}])
+    assert response.status_code == 400
+
+def test_transition_order_requests():
+    assert client.post("/user/", json={"uid": "STATE000001"}).status_code == 200
+    items = [client.post("/item/", json={"title": f"State Item {n}"}).json()["id"] for n in range(3)]
+    ids = [client.post("/order-request/", json={"item_id": item, "user_id": "STATE000001"}).json()["id"] for item in items]
+    response = client.patch("/order-requests/state/", json={"state": 1, "ids": ids[:2] + [999999]})
+    assert response.status_code == 200
+    assert response.json() == {"updated": ids[:2], "rejected": [], "not_found": [999999]}
+    response = client.patch("/order-requests/state/", json={"state": 2, "user_id": "STATE000001"})
+    assert response.json() == {"updated": ids[:2], "rejected": [ids[2]], "not_found": []}
+    response = client.patch("/order-requests/state/", json={"state": 0, "ids": ids})
+    assert response.json() == {"updated": [], "rejected": ids, "not_found": []}
+    assert [order_request["state"] for order_request in client.get("/order-requests/user/STATE000001/").json()["items"]] == [2, 2, 0]
+    response = client.patch("/order-requests/state/", json={"state": 1})
+    assert response.status_code == 400
+
+def test_transition_order_requests_single_statement():
+    statements = []
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(database.engine, 'before_cursor_execute', capture)
+    try:
+        response = client.patch("/order-requests/state/", json={"state": 3, "user_id": "STATE000001"})
+    finally:
+        event.remove(database.engine, 'before_cursor_execute', capture)
+    assert response.json()["updated"] != [] and response.json()["rejected"] != []
+    assert len([statement for statement in statements if "order_requests" in statement]) == 1 # rejected rows come from the same statement, not a later query
+
+def test_order_request_transitions_enforced_by_database():
+    order_request = models.OrderRequest
+    with database.SessionLocal() as db: # any statement, not only transition_order_requests
+        id, state = db.execute(select(order_request.id, order_request.state).where(order_request.user_id == "STATE000001", order_request.state == 0)).first()
+        with pytest.raises(IntegrityError):
+            db.execute(update(order_request).where(order_request.id == id).values(state=3))
+        db.rollback()
+        db.execute(update(order_request).where(order_request.id == id).values(state=4))
+        db.rollback()
+
+def test_metrics():
+    item = client.post("/item/", json={"title": "Metrics Item"}).json()
+    assert client.get(f"/item/{item['id']}/").status_code == 200
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert any(line.startswith('http_request_duration_seconds_count{route="/item/{id}/",method="GET",status="200"} ') for line in lines)
+    assert 'http_request_sql_statements_bucket{route="/item/{id}/",le="1"}' in response.text
+    assert any(line.startswith("sql_statement_duration_seconds_count ") for line in lines)
+    assert any(line.startswith("db_pool_checkout_wait_seconds_count ") for line in lines)
+
+def test_metrics_routes_sharing_a_function_name():
+    # GET /items/ and GET /categories/{category_id}/items/ are both handled by a function named read_all_items
+    category = client.post("/category/", json={"title": "Metrics Category"}).json()
+    assert client.get("/items/").status_code == 200
+    assert client.get(f"/categories/{category['id']}/items/").status_code == 200
+    lines = client.get("/metrics").text.splitlines()
+    assert any(line.startswith('http_request_duration_seconds_count{route="/items/",method="GET",status="200"} ') for line in lines)
+    assert any(line.startswith('http_request_duration_seconds_count{route="/categories/{category_id}/items/",method="GET",status="200"} ') for line in lines)
+    assert not any('route="read_all_items"' in line for line in lines)
+
+def test_metrics_histogram():
+    histogram = metrics.Histogram("test_seconds", "Test", ("route",), (0.1, 1))
+    histogram.observe(0.05, "a")
+    histogram.observe(0.5, "a")
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="a",le="0.1"} 1',
+        'test_seconds_bucket{route="a",le="1"} 2',
+        'test_seconds_bucket{route="a",le="+Inf"} 2',
+        'test_seconds_sum{route="a"} 0.55',
+        'test_seconds_count{route="a"} 2',
+    ]
+
+def test_health():
+    response = client.get("/health/")
+    assert response.status_code == 200
+    assert response.json()["database"] == "ok"
+    pool = response.json()["pools"]["sync"]
+    assert pool["size"] == database.POOL_OPTIONS["pool_size"]
+    assert 0 < pool["checked_out"] <= pool["size"] + pool["max_overflow"] # the request's own connection
+    assert pool["utilization"] == pool["checked_out"] / (pool["size"] + pool["max_overflow"])
+
+def test_warm_up():
+    assert database.warm_up(database.engine) == database.engine.pool.size()
+    assert database.engine.pool.checkedin() >= database.engine.pool.size()
+
+class RecordingBroadcaster(changes.Broadcaster):
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    async def publish(self, cabinet_id, type, data):
+        self.events.append((cabinet_id, type, data))
+
+def test_write_routes_publish(monkeypatch):
+    broadcaster = RecordingBroadcaster()
+    monkeypatch.setattr(main, "broadcaster", broadcaster)
+    assert client.post("/cabinet/", json={"id": "CAB-EVENTS"}).status_code == 200
+    assert client.post("/user/", json={"uid": "EVENTS00001"}).status_code == 200
+    item = client.post("/item/", json={"title": "Events Item"}).json()
+    assert client.post("/storage-unit/", json={"id": 7501, "item_id": item["id"], "cabinet_id": "CAB-EVENTS"}).status_code == 200
+    assert client.post("/unlock-attempt/", json={"user_id": "EVENTS00001", "cabinet_id": "CAB-EVENTS", "granted": True}).status_code == 200
+    assert client.put("/storage-units/cabinet/CAB-EVENTS/", json=[{"id": 7502, "item_id": item["id"]}]).status_code == 200
+    assert client.delete("/storage-unit/7502/").status_code == 200
+    assert [(cabinet_id, type) for cabinet_id, type, data in broadcaster.events] == [
+        ("CAB-EVENTS", "storage_unit.created"),
+        ("CAB-EVENTS", "unlock_attempt.created"),
+        ("CAB-EVENTS", "storage_units.synced"),
+        ("CAB-EVENTS", "storage_unit.deleted"),
+    ]
+    assert broadcaster.events[0][2] == {"id": 7501, "state": 0, "verified": False, "item_id": item["id"], "cabinet_id": "CAB-EVENTS"}
+    assert broadcaster.events[2][2] == {"created": [7502], "updated": [], "deleted": [7501], "unchanged": 0}
+
+def test_conditional_get():
+    response = client.get("/items/")
+    etag = response.headers["etag"]
+    assert response.headers["last-modified"].endswith(" GMT")
+    response = client.get("/items/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+    assert client.get("/items/", headers={"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+    assert client.get("/users/", headers={"If-None-Match": etag}).status_code == 200 # versions of another table
+
+def test_conditional_get_after_changes():
+    etag = client.get("/items/").headers["etag"]
+    category_etag = client.get("/categories/").headers["etag"]
+    category = client.post("/category/", json={"title": "Versioned Category"}).json()
+    assert client.get("/items/", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/categories/", headers={"If-None-Match": category_etag}).status_code == 200
+    item = client.post("/item/", json={"title": "Versioned Item", "category_id": category["id"]}).json()
+    response = client.get("/items/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert client.delete(f"/category/{category['id']}/").status_code == 200 # sets the category_id of the item to null
+    assert client.get("/items/", headers={"If-None-Match": etag}).status_code == 200
+    assert client.get(f"/item/{item['id']}/").json()["category_id"] is None
+    assert "etag" not in client.get("/item/999999/").headers
+
+def test_search_items():
+    category = client.post("/category/", json={"title": "Search Category"}).json()
+    for title, description in [("Search Multimeter", "Digital multimeter with probes"), ("Search Oscilloscope", "Two channel digital scope"), ("Search Probes", None)]:
+        assert client.post("/item/", json={"title": title, "description": description, "category_id": category["id"]}).status_code == 200
+    response = client.get("/items/search/", params={"q": "search digi"})
+    assert response.status_code == 200
+    assert {item["title"] for item in response.json()} == {"Search Multimeter", "Search Oscilloscope"}
+    assert [item["title"] for item in client.get("/items/search/", params={"q": "search probes"}).json()][0] == "Search Probes" # title and description beat description only
+    assert client.get("/items/search/", params={"q": "search probes", "limit": 1}).json()[0]["title"] == "Search Probes"
+    assert client.get("/items/search/", params={"q": "search !!"}).json() != []
+    assert client.get("/items/search/", params={"q": "!!"}).json() == []
+    assert client.get("/items/search/", params={"q": ""}).status_code == 422
+
+def test_authorize_unlock():
+    assert client.post("/user/", json={"uid": "ACCESS00001"}).status_code == 200
+    assert client.post("/cabinet/", json={"id": "CAB-ACCESS"}).status_code == 200
+    assert client.post("/cabinet/CAB-ACCESS/authorize/", json={"user_id": "ACCESS00001"}).json() == {"granted": False}
+    response = client.put("/cabinet/CAB-ACCESS/permissions/", json=["ACCESS00001"])
+    assert response.status_code == 200
+    assert client.get("/cabinet/CAB-ACCESS/permissions/").json() == ["ACCESS00001"]
+    assert client.post("/cabinet/CAB-ACCESS/authorize/", json={"user_id": "ACCESS00001"}).json() == {"granted": True}
+    assert client.post("/cabinet/CAB-ACCESS/authorize/", json={"user_id": "UNKNOWN0001"}).json() == {"granted": False}
+    assert client.delete("/cabinet/CAB-ACCESS/permissions/", params={"uids": ["ACCESS00001"]}).status_code == 200
+    assert client.post("/cabinet/CAB-ACCESS/authorize/", json={"user_id": "ACCESS00001"}).json() == {"granted": False}
+    assert client.get("/cabinet/CAB-ACCESS/permissions/").json() == []
+    # recorded after answering, the attempt of the unknown user is dropped
+    attempts = client.get("/unlock-attempts/cabinet/CAB-ACCESS/").json()["items"]
+    assert [(attempt["user_id"], attempt["granted"]) for attempt in attempts] == [("ACCESS00001", False), ("ACCESS00001", True), ("ACCESS00001", False)]
+    assert client.put("/cabinet/CAB-ACCESS/permissions/", json=["UNKNOWN0001"]).status_code == 404
+    assert client.get("/cabinet/CAB-MISSING/permissions/").status_code == 404
+
+def test_access_map_refresh():
+    access_map = access.AccessMap(database.SessionLocal)
+    access_map.load()
+    assert not access_map.allows("ACCESS00001", "CAB-ACCESS")
+    with database.SessionLocal() as db:
+        crud.set_cabinet_permissions(db, "CAB-ACCESS", ["ACCESS00001"], True) # through another worker
+    asyncio.run(access_map.refresh())
+    assert access_map.allows("ACCESS00001", "CAB-ACCESS")
+    with database.SessionLocal() as db:
+        crud.set_cabinet_permissions(db, "CAB-ACCESS", ["ACCESS00001"], False)
+    asyncio.run(access_map.refresh())
+    assert not access_map.allows("ACCESS00001", "CAB-ACCESS")
+    main.access_map.apply([("ACCESS00001", "CAB-ACCESS", True, None)])
+    assert client.delete("/user/ACCESS00001/").status_code == 200
+    assert not main.access_map.allows("ACCESS00001", "CAB-ACCESS")
+
+def test_cabinet_events_release_connection(monkeypatch):
+    checked_out = []
+    async def stream(broadcaster, request, cabinet_id):
+        checked_out.append(database.engine.pool.checkedout())
+        yield ": keepalive\n\n"
+    monkeypatch.setattr(changes, "stream", stream)
+    cache.clear() # the existence check reads the database
+    response = client.get("/cabinet/CAB-EVENTS/events/")
+    assert response.status_code == 200
+    assert checked_out == [0] # the stream runs without a pooled connection
+    assert client.get("/cabinet/CAB-MISSING/events/").status_code == 404
+
+def test_write_behind_publishes_once_committed(monkeypatch):
+    broadcaster = RecordingBroadcaster()
+    monkeypatch.setattr(main, "broadcaster", broadcaster)
+    writer = ingestion.UnlockAttemptWriter(database.SessionLocal, on_flush=main.publish_unlock_attempts)
+    monkeypatch.setattr(main, "unlock_attempt_writer", writer)
+    assert client.post("/unlock-attempt/", json={"user_id": "EVENTS00001", "cabinet_id": "CAB-EVENTS", "granted": True}).status_code == 202
+    assert client.post("/cabinet/CAB-EVENTS/authorize/", json={"user_id": "EVENTS00001"}).status_code == 200
+    assert broadcaster.events == [] # queued, not committed yet
+    assert asyncio.run(writer.flush()) == 2
+    assert [(cabinet_id, type, data["user_id"]) for cabinet_id, type, data in broadcaster.events] == [
+        ("CAB-EVENTS", "unlock_attempt.created", "EVENTS00001"),
+        ("CAB-EVENTS", "unlock_attempt.created", "EVENTS00001"),
+    ]
+
+class FailingBroadcaster(changes.Broadcaster):
+    async def publish(self, cabinet_id, type, data):
+        raise ConnectionError("connection is closed")
+
+def test_publish_failure_keeps_committed_write(monkeypatch):
+    monkeypatch.setattr(main, "broadcaster", FailingBroadcaster())
+    item = client.post("/item/", json={"title": "Unpublished Item"}).json()
+    response = client.post("/storage-unit/", json={"id": 7601, "item_id": item["id"], "cabinet_id": "CAB-EVENTS"})
+    assert response.status_code == 200
+    assert client.get("/storage-unit/7601/").status_code == 200
+
+def test_access_map_refresh_after_cascade():
+    assert client.post("/user/", json={"uid": "ACCESS00002"}).status_code == 200
+    assert client.put("/cabinet/CAB-ACCESS/permissions/", json=["ACCESS00002"]).status_code == 200
+    access_map = access.AccessMap(database.SessionLocal)
+    access_map.load()
+    assert access_map.allows("ACCESS00002", "CAB-ACCESS")
+    with database.SessionLocal() as db:
+        crud.delete_users(db, ["ACCESS00002"]) # through another worker, the permission goes with the user
+    asyncio.run(access_map.refresh())
+    assert not access_map.allows("ACCESS00002", "CAB-ACCESS")
+
+def test_grant_no_permissions():
+    response = client.put("/cabinet/CAB-ACCESS/permissions/", json=[])
+    assert response.status_code == 400
+    assert response.json() == {"detail": "No uids given"}
@@ -0,0 +1,143 @@
+import crud
+import database
+import datetime
+import models
+import pytest
+
+from sqlalchemy import event, insert, text
+from sqlalchemy.orm import Session
+
+
+pytestmark = pytest.mark.skipif(database.engine.dialect.name != 'postgresql', reason="query plans are checked on PostgreSQL")
+
+def executed(select):
+    # the select_ functions build the statements of the exports, run them the way the exports do
+    def query(db, *args):
+        return db.execute(select(*args)).all()
+    query.__name__ = select.__name__
+    return query
+
+QUERIES = [
+    (crud.get_all_users, ()),
+    (crud.get_user_by_uid, ("PLAN0000001",)),
+    (crud.get_existing_user_uids, (["PLAN0000001", "PLAN0000002"],)),
+    (crud.get_users_by_uids, (["PLAN0000002", "PLAN0000001"],)),
+    (crud.get_all_cabinets, ()),
+    (crud.get_cabinet_by_id, ("CAB-PLAN-1",)),
+    (crud.get_existing_cabinet_ids, (["CAB-PLAN-1", "CAB-PLAN-2"],)),
+    (crud.get_cabinets_by_ids, (["CAB-PLAN-2", "CAB-PLAN-1"],)),
+    (crud.get_permitted_user_uids, ("CAB-PLAN-1",)),
+    (crud.get_cabinet_permissions, (datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc),)),
+    (crud.get_all_categories, ()),
+    (crud.get_category_by_id, (100001,)),
+    (crud.get_category_by_title, ("Plan category 1",)),
+    (crud.get_root_categories, ()),
+    (crud.get_sub_categories, (100001,)),
+    (crud.get_descendant_categories, (100001,)),
+    (crud.get_ancestor_categories, (100030,)),
+    (crud.get_all_items, ()),
+    (crud.get_item_by_id, (100001,)),
+    (crud.get_item_by_title, ("Plan item 1",)),
+    (crud.get_items_by_ids, ([100002, 100001],)),
+    (crud.get_items_by_category_id, (100001,)),
+    (crud.get_items_by_category_subtree, (100001,)),
+    (crud.search_items, ("plan it",)),
+    (crud.get_all_order_requests, ()),
+    (crud.get_order_request_by_id, (100001,)),
+    (crud.get_order_requests_by_item_id, (100001,)),
+    (crud.get_order_requests_by_user_id, ("PLAN0000001",)),
+    (crud.get_order_requests_by_state, (1,)),
+    (crud.get_all_storage_units, ()),
+    (crud.get_storage_unit_by_id, (100001,)),
+    (crud.get_storage_units_by_ids, ([100002, 100001],)),
+    (crud.get_storage_units_by_cabinet_id, ("CAB-PLAN-1",)),
+    (crud.get_stock_by_items, ()),
+    (crud.get_stock_by_item_id, (100001,)),
+    (crud.get_stock_by_cabinet_id, ("CAB-PLAN-1",)),
+    (crud.get_stock_by_categories, ()),
+    (crud.get_stock_by_category_subtree, (100001,)),
+    (crud.get_all_unlock_attempts, ()),
+    (crud.get_unlock_attempts_by_cabinet_id, ("CAB-PLAN-1",)),
+    (crud.get_unlock_attempts_by_user_id, ("PLAN0000001",)),
+    (crud.get_unlock_attempts_by_cabinet_and_user_id, ("CAB-PLAN-1", "PLAN0000001")),
+    (crud.get_unlock_attempt_stats, ("day", "CAB-PLAN-1")),
+    (crud.get_unlock_attempt_stats, ("hour", None, "PLAN0000001")),
+    (crud.get_unlock_attempt_busiest_hours, ("CAB-PLAN-1",)),
+    (crud.get_table_versions, (["categories", "items"],)),
+    (crud.get_unlock_attempt_purge, (1,)),
+    (executed(crud.select_order_requests), (None, None, "PLAN0000001")),
+    (executed(crud.select_order_requests), (None, 100001, None, datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc))),
+    (executed(crud.select_unlock_attempts), ("CAB-PLAN-1", None, None, datetime.datetime(2022, 2, 1, tzinfo=datetime.timezone.utc))),
+    (executed(crud.select_unlock_attempts), (None, "PLAN0000001")),
+    (crud.delete_users, (["PLAN9999999"],)),
+    (crud.delete_cabinets, (["CAB-PLAN-0"],)),
+    (crud.delete_categories, ([999999],)),
+    (crud.delete_items, ([999999],)),
+    (crud.delete_order_requests, ([999999],)),
+    (crud.delete_storage_units, ([999999],)),
+    (crud.transition_order_requests, (2, None, 100001, None, 1)),
+    (crud.transition_order_requests, (2, [100001, 100002])),
+    (crud.delete_unlock_attempts_before, (datetime.datetime(2022, 1, 1, 5, tzinfo=datetime.timezone.utc), 2)),
+]
+
+def seed(db: Session):
+    users = [{"uid": f"PLAN{n:07}"} for n in range(1, 51)]
+    cabinets = [{"id": f"CAB-PLAN-{n}"} for n in range(1, 11)]
+    categories = [{"id": 100000 + n, "title": f"Plan category {n}", "parent_id": 100000 + n - 1 if n > 1 else None} for n in range(1, 31)]
+    items = [{"id": 100000 + n, "title": f"Plan item {n}", "category_id": 100000 + n % 30 + 1} for n in range(1, 201)]
+    db.execute(insert(models.User), users)
+    db.execute(insert(models.Cabinet), cabinets)
+    db.execute(insert(models.Category), categories)
+    db.execute(insert(models.Item), items)
+    db.execute(insert(models.OrderRequest), [
+        {"id": 100000 + n, "state": n % 3, "item_id": items[n % 200]["id"], "user_id": users[(n + n // 200) % 50]["uid"]} for n in range(1, 501)])
+    db.execute(insert(models.StorageUnit), [
+        {"id": 100000 + n, "item_id": items[n % 200]["id"], "cabinet_id": cabinets[n % 10]["id"]} for n in range(1, 201)])
+    crud.create_unlock_attempts(db, [
+        {"granted": n % 4 != 0, "user_id": users[n % 50]["uid"], "cabinet_id": cabinets[n % 10]["id"], "date": datetime.datetime(2022, 1, 1) + datetime.timedelta(hours=n)} for n in range(1, 2001)])
+
+@pytest.fixture(scope="module")
+def db():
+    # everything runs in one transaction rolled back at the end, the seeded rows never reach the other tests
+    connection = database.engine.connect()
+    transaction = connection.begin()
+    db = Session(bind=connection)
+    seed(db)
+    db.execute(text("ANALYZE"))
+    db.execute(text("SET LOCAL enable_seqscan = off")) # with few rows a seq scan is cheap, forbid it so one only shows up when no index applies
+    yield db
+    db.close()
+    transaction.rollback()
+    connection.close()
+
+def full_scans(plan: dict):
+    # seq scans, and index scans walking the whole index while filtering rows (an ordered seq scan in disguise)
+    full_scan = plan['Node Type'] == 'Seq Scan' or (plan['Node Type'] in ('Index Scan', 'Index Only Scan') and 'Filter' in plan and 'Index Cond' not in plan)
+    found = [plan['Relation Name']] if full_scan else []
+    for subplan in plan.get('Plans', []):
+        found += full_scans(subplan)
+    return found
+
+# crud reads left out of QUERIES, they read a whole table on purpose
+WHOLE_TABLE_READS = {'get_all_user_uids', 'get_all_cabinet_ids'}
+
+def test_queries_cover_crud():
+    # a crud function reading or deleting rows has to be checked here, or listed above when it reads a whole table on purpose
+    queries = {name for name in dir(crud) if name.startswith(('get_', 'select_', 'search_', 'transition_', 'delete_')) and callable(getattr(crud, name))}
+    generic = {'get_by_keys', 'delete_by_keys', 'delete_bumping'} # run through the functions above
+    assert queries - generic - WHOLE_TABLE_READS - {function.__name__ for function, args in QUERIES} == set()
+
+@pytest.mark.parametrize("function, args", QUERIES, ids=[function.__name__ for function, args in QUERIES])
+def test_query_uses_indexes(db, function, args):
+    statements = []
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(database.engine, 'before_cursor_execute', capture)
+    try:
+        function(db, *args)
+    finally:
+        event.remove(database.engine, 'before_cursor_execute', capture)
+    assert statements
+    for statement, parameters in statements:
+        plan = db.connection().exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+        assert full_scans(plan[0]['Plan']) == [], statement
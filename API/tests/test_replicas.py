@@ -0,0 +1,63 @@
+import database
+import models
+import pytest
+
+from app.main import app, PRIMARY_COOKIE
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+
+def sqlite_sessionmaker(path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False}) # sessions move between worker threads
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=database.ThreadedSession)
+
+@pytest.fixture
+def replica(tmp_path):
+    # SQLite stand-in for a replica, holding a user the primary doesn't have so responses tell where they were read
+    session_factory = sqlite_sessionmaker(tmp_path / "replica.db")
+    database.Base.metadata.create_all(session_factory.kw["bind"])
+    with session_factory() as db:
+        db.execute(insert(models.User), [{"uid": "REPLICA0001"}])
+        db.commit()
+    return session_factory
+
+@pytest.fixture
+def unreachable(tmp_path):
+    return sqlite_sessionmaker(tmp_path / "missing" / "replica.db")
+
+def test_replica_set_round_robin():
+    replicas = database.ReplicaSet(["first", "second", "third"], retry_interval=60)
+    assert replicas.candidates() == ["first", "second", "third"]
+    assert replicas.candidates() == ["second", "third", "first"]
+    replicas.down_until["third"] = float("inf")
+    assert replicas.candidates() == ["first", "second"]
+
+def test_reads_go_to_replica(monkeypatch, replica):
+    monkeypatch.setattr(database, "replicas", database.ReplicaSet([replica]))
+    client = TestClient(app)
+    assert client.get("/user/REPLICA0001/").status_code == 200
+    assert client.get("/users/").json()["items"] == [{"uid": "REPLICA0001", "firstname": None, "lastname": None}]
+    assert client.post("/users/lookup/", json=["REPLICA0001"]).json()["not_found"] == []
+    assert client.get("/user/REPLICA0001/", cookies={PRIMARY_COOKIE: "1"}).status_code == 404
+
+def test_unreachable_replica_fails_over(monkeypatch, replica, unreachable):
+    replicas = database.ReplicaSet([unreachable, replica])
+    monkeypatch.setattr(database, "replicas", replicas)
+    client = TestClient(app)
+    for _ in range(3):
+        assert client.get("/user/REPLICA0001/").status_code == 200
+    assert replicas.candidates() == [replica]
+    replicas.down_until[replica] = float("inf")
+    assert client.get("/user/REPLICA0001/").status_code == 404 # no replica left, read from the primary
+
+def test_read_your_writes(monkeypatch, replica):
+    monkeypatch.setattr(database, "replicas", database.ReplicaSet([replica]))
+    client = TestClient(app)
+    response = client.delete("/users/", params={"uids": ["NOTHERE0001"]})
+    assert response.status_code == 200
+    assert response.cookies[PRIMARY_COOKIE] == "1"
+    assert client.get("/user/REPLICA0001/").status_code == 404 # the client keeps the cookie and reads from the primary
+    response = TestClient(app).delete("/user/NOTHERE0001/")
+    assert response.status_code == 404
+    assert PRIMARY_COOKIE not in response.cookies # nothing was written
@@ -0,0 +1,57 @@
+import crud
+import csv
+import database
+import datetime
+import gzip
+import models
+import pytest
+import retention
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+@pytest.fixture
+def SessionLocal(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'smartinventory.db'}")
+    database.Base.metadata.create_all(engine)
+    SessionLocal = sessionmaker(bind=engine)
+    old = datetime.datetime(2020, 1, 1)
+    with SessionLocal() as db:
+        db.add_all([models.User(uid="PURGE000001"), models.Cabinet(id="CAB-PURGE")])
+        db.add_all([models.CabinetUnlockAttempt(user_id="PURGE000001", cabinet_id="CAB-PURGE", date=old + datetime.timedelta(hours=n)) for n in range(5)])
+        db.add(models.CabinetUnlockAttempt(user_id="PURGE000001", cabinet_id="CAB-PURGE", date=datetime.datetime.now()))
+        db.commit()
+    return SessionLocal
+
+def test_purge_in_batches_to_archive_table(SessionLocal):
+    job = retention.purge_unlock_attempts(SessionLocal, retention.new_job(SessionLocal, 30, 'table'), batch_size=2)
+    assert (job.status, job.deleted, job.batches) == ('done', 5, 3)
+    with SessionLocal() as db:
+        assert db.query(models.CabinetUnlockAttempt).count() == 1
+        assert db.query(models.CabinetUnlockAttemptArchive).count() == 5
+
+def test_purge_to_archive_file(SessionLocal, tmp_path, monkeypatch):
+    monkeypatch.setattr(retention, 'RETENTION_ARCHIVE_DIR', str(tmp_path / "archives"))
+    job = retention.purge_unlock_attempts(SessionLocal, retention.new_job(SessionLocal, 30, 'file'), batch_size=10)
+    assert (job.status, job.deleted, job.batches) == ('done', 5, 1)
+    with gzip.open(job.archive_path, 'rt') as archive:
+        assert [row['user_id'] for row in csv.DictReader(archive)] == ["PURGE000001"] * 5
+
+def test_purge_progress_saved(SessionLocal):
+    # the job row tells any worker how the purge went, ids come from the database so workers never hand out the same one
+    first, second = retention.new_job(SessionLocal, 30), retention.new_job(SessionLocal, 30)
+    assert first.id != second.id
+    retention.purge_unlock_attempts(SessionLocal, first, batch_size=2)
+    with SessionLocal() as db:
+        purge = crud.get_unlock_attempt_purge(db, first.id)
+        assert (purge.status, purge.deleted, purge.batches) == ('done', 5, 3)
+        assert purge.finished_at is not None
+        assert crud.get_unlock_attempt_purge(db, second.id).status == 'pending'
+
+def test_purge_jobs_kept(SessionLocal, monkeypatch):
+    monkeypatch.setattr(retention, 'RETENTION_MAX_JOBS', 2)
+    jobs = [retention.new_job(SessionLocal, 30) for _ in range(3)]
+    with SessionLocal() as db:
+        assert crud.get_unlock_attempt_purge(db, jobs[0].id) is None
+        assert crud.get_unlock_attempt_purge(db, jobs[2].id) is not None
@@ -0,0 +1,40 @@
+import crud
+import database
+import models
+import search
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+
+def test_tokenize():
+    assert search.tokenize("Arduino Uno-R3, 5V_USB") == ["arduino", "uno", "r3", "5v", "usb"]
+    assert search.tokenize(None) == []
+
+def test_prefix_query():
+    assert search.prefix_query(["arduino", "un"]) == "arduino:* & un:*"
+
+def test_trigrams():
+    assert search.trigrams("arduno") == ["ard", "rdu", "dun", "uno"]
+    assert search.trigrams("5v") == ["5v"]
+
+def test_score():
+    assert search.score(["ardu"], "Arduino Uno") == 1
+    assert search.score(["uno", "board"], "Arduino Uno", "Microcontroller board") == 2
+    assert 0 < search.score(["arduno"], "Arduino Uno") < 1 # misspelt
+    assert search.score(["arduino", "mega"], "Arduino Uno") == 0
+    assert search.score(["board"], "Arduino Uno") == 0
+
+def test_search_items_filters_in_sql():
+    # without PostgreSQL the items are narrowed down by a LIKE per word before search.score ranks them
+    engine = create_engine("sqlite://")
+    database.Base.metadata.create_all(engine)
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda connection, cursor, statement, parameters, context, executemany: statements.append(statement))
+    with Session(engine) as db:
+        db.add_all([models.Item(title="Arduino Uno"), models.Item(title="Raspberry Pi 4", description="Single board computer"), models.Item(title="USB cable")])
+        db.commit()
+        assert [item.title for item in crud.search_items(db, "arduno")] == ["Arduino Uno"]
+        assert [item.title for item in crud.search_items(db, "board")] == ["Raspberry Pi 4"]
+        assert crud.search_items(db, "keyboard") == []
+    assert all(" LIKE " in statement for statement in statements if statement.startswith("SELECT"))
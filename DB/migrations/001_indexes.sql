@@ -0,0 +1,29 @@
+-- 001 : primary key on storage_units and indexes on the foreign key and filter columns used by the API
+
+CREATE TABLE IF NOT EXISTS schema_migrations
+(
+    version INTEGER,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (version)
+);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'storage_units'::regclass AND contype = 'p') THEN
+        ALTER TABLE storage_units ADD PRIMARY KEY (id);
+    END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS ix_categories_parent_id ON categories (parent_id);
+CREATE INDEX IF NOT EXISTS ix_items_category_id ON items (category_id);
+CREATE INDEX IF NOT EXISTS ix_order_requests_item_id_user_id ON order_requests (item_id, user_id);
+CREATE INDEX IF NOT EXISTS ix_order_requests_user_id ON order_requests (user_id);
+CREATE INDEX IF NOT EXISTS ix_order_requests_state ON order_requests (state);
+CREATE INDEX IF NOT EXISTS ix_storage_units_cabinet_id ON storage_units (cabinet_id);
+CREATE INDEX IF NOT EXISTS ix_storage_units_item_id ON storage_units (item_id);
+CREATE INDEX IF NOT EXISTS ix_cabinets_unlock_attempts_cabinet_id_user_id_date ON cabinets_unlock_attempts (cabinet_id, user_id, date);
+CREATE INDEX IF NOT EXISTS ix_cabinets_unlock_attempts_user_id_date ON cabinets_unlock_attempts (user_id, date);
+CREATE INDEX IF NOT EXISTS ix_cabinets_unlock_attempts_date ON cabinets_unlock_attempts (date);
+
+INSERT INTO schema_migrations (version) VALUES (1) ON CONFLICT DO NOTHING;
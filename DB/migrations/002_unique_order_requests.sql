@@ -0,0 +1,12 @@
+-- 002 : a user requests an item once, so order request creation can rely on ON CONFLICT
+
+-- requests made more than once before the index existed keep their first row, rows with a NULL item_id or user_id
+-- do not conflict under the index so they are left alone
+DELETE FROM order_requests AS duplicate
+USING order_requests AS first
+WHERE duplicate.item_id = first.item_id AND duplicate.user_id = first.user_id AND duplicate.id > first.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_order_requests_item_id_user_id ON order_requests (item_id, user_id);
+DROP INDEX IF EXISTS ix_order_requests_item_id_user_id;
+
+INSERT INTO schema_migrations (version) VALUES (2) ON CONFLICT DO NOTHING;
@@ -0,0 +1,14 @@
+-- 003 : archive table for unlock attempts purged by the retention engine
+
+CREATE TABLE IF NOT EXISTS cabinets_unlock_attempts_archive
+(
+    id INTEGER,
+    date TIMESTAMP WITH TIME ZONE,
+    granted BOOLEAN,
+    user_id VARCHAR,
+    cabinet_id VARCHAR,
+
+    PRIMARY KEY (id)
+);
+
+INSERT INTO schema_migrations (version) VALUES (3) ON CONFLICT DO NOTHING;
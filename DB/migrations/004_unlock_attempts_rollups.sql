@@ -0,0 +1,55 @@
+-- 004 : hourly and daily rollups of cabinets_unlock_attempts, backfilled from the existing attempts
+-- periods are UTC hours and days, the naive dates of cabinets_unlock_attempts are UTC
+
+CREATE TABLE IF NOT EXISTS unlock_attempts_hourly
+(
+    cabinet_id VARCHAR,
+    user_id VARCHAR,
+    hour TIMESTAMP WITH TIME ZONE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    granted INTEGER NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (cabinet_id, user_id, hour),
+    FOREIGN KEY (cabinet_id)
+        REFERENCES cabinets (id)
+        ON DELETE CASCADE,
+    FOREIGN KEY (user_id)
+        REFERENCES users (uid)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS unlock_attempts_daily
+(
+    cabinet_id VARCHAR,
+    user_id VARCHAR,
+    day DATE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    granted INTEGER NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (cabinet_id, user_id, day),
+    FOREIGN KEY (cabinet_id)
+        REFERENCES cabinets (id)
+        ON DELETE CASCADE,
+    FOREIGN KEY (user_id)
+        REFERENCES users (uid)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS ix_unlock_attempts_hourly_user_id_hour ON unlock_attempts_hourly (user_id, hour);
+CREATE INDEX IF NOT EXISTS ix_unlock_attempts_daily_user_id_day ON unlock_attempts_daily (user_id, day);
+
+INSERT INTO unlock_attempts_hourly (cabinet_id, user_id, hour, attempts, granted)
+    SELECT cabinet_id, user_id, date_trunc('hour', date) AT TIME ZONE 'UTC', count(*), count(*) FILTER (WHERE granted)
+    FROM cabinets_unlock_attempts
+    WHERE cabinet_id IS NOT NULL AND user_id IS NOT NULL AND date IS NOT NULL
+    GROUP BY 1, 2, 3
+ON CONFLICT DO NOTHING;
+
+INSERT INTO unlock_attempts_daily (cabinet_id, user_id, day, attempts, granted)
+    SELECT cabinet_id, user_id, date::date, count(*), count(*) FILTER (WHERE granted)
+    FROM cabinets_unlock_attempts
+    WHERE cabinet_id IS NOT NULL AND user_id IS NOT NULL AND date IS NOT NULL
+    GROUP BY 1, 2, 3
+ON CONFLICT DO NOTHING;
+
+INSERT INTO schema_migrations (version) VALUES (4) ON CONFLICT DO NOTHING;
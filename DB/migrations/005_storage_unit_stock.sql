@@ -0,0 +1,58 @@
+-- 005 : storage units counted per item and cabinet in a table kept up to date by a trigger on storage_units,
+-- each change only adjusts the counts of the item and cabinet it touches
+
+CREATE TABLE IF NOT EXISTS storage_unit_stock
+(
+    item_id INTEGER,
+    cabinet_id VARCHAR,
+    units INTEGER NOT NULL DEFAULT 0,
+    available INTEGER NOT NULL DEFAULT 0, -- storage units in state 0
+    verified INTEGER NOT NULL DEFAULT 0
+);
+
+-- one row per item and cabinet, NULL included, expressions because PostgreSQL 14 has no NULLS NOT DISTINCT
+CREATE UNIQUE INDEX IF NOT EXISTS uq_storage_unit_stock_item_id_cabinet_id ON storage_unit_stock
+    ((coalesce(item_id, 0)), (item_id IS NULL), (coalesce(cabinet_id, '')), (cabinet_id IS NULL));
+CREATE INDEX IF NOT EXISTS ix_storage_unit_stock_item_id ON storage_unit_stock (item_id);
+CREATE INDEX IF NOT EXISTS ix_storage_unit_stock_cabinet_id ON storage_unit_stock (cabinet_id);
+
+CREATE OR REPLACE FUNCTION add_storage_unit_stock(stock_item_id INTEGER, stock_cabinet_id VARCHAR, stock_units INTEGER, stock_available INTEGER, stock_verified INTEGER)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO storage_unit_stock AS stock (item_id, cabinet_id, units, available, verified)
+    VALUES (stock_item_id, stock_cabinet_id, stock_units, stock_available, stock_verified)
+    ON CONFLICT ((coalesce(item_id, 0)), (item_id IS NULL), (coalesce(cabinet_id, '')), (cabinet_id IS NULL)) DO UPDATE
+    SET units = stock.units + excluded.units, available = stock.available + excluded.available, verified = stock.verified + excluded.verified;
+    -- one row per group of storage_units like a GROUP BY, none once the last storage unit is gone
+    DELETE FROM storage_unit_stock
+    WHERE item_id IS NOT DISTINCT FROM stock_item_id AND cabinet_id IS NOT DISTINCT FROM stock_cabinet_id AND units = 0;
+END;
+$$ LANGUAGE plpgsql;
+
+-- also fires for the SET NULL of storage_units when an item or cabinet is deleted
+CREATE OR REPLACE FUNCTION count_storage_unit_stock()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM add_storage_unit_stock(OLD.item_id, OLD.cabinet_id, -1, -coalesce((OLD.state = 0)::INTEGER, 0), -coalesce(OLD.verified::INTEGER, 0));
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM add_storage_unit_stock(NEW.item_id, NEW.cabinet_id, 1, coalesce((NEW.state = 0)::INTEGER, 0), coalesce(NEW.verified::INTEGER, 0));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS storage_unit_stock_counts ON storage_units;
+CREATE TRIGGER storage_unit_stock_counts AFTER INSERT OR UPDATE OR DELETE ON storage_units
+    FOR EACH ROW EXECUTE FUNCTION count_storage_unit_stock();
+
+-- counts of the rows already there, the trigger keeps them from now on
+LOCK TABLE storage_units IN SHARE MODE;
+TRUNCATE storage_unit_stock;
+INSERT INTO storage_unit_stock (item_id, cabinet_id, units, available, verified)
+    SELECT item_id, cabinet_id, count(*), count(*) FILTER (WHERE state = 0), count(*) FILTER (WHERE verified)
+    FROM storage_units
+    GROUP BY item_id, cabinet_id;
+
+INSERT INTO schema_migrations (version) VALUES (5) ON CONFLICT DO NOTHING;
@@ -0,0 +1,20 @@
+-- 006 : allowed order request state changes, bulk transitions only update the rows whose current state leads to the new one
+-- states : 0 requested, 1 accepted, 2 ordered, 3 received, 4 refused
+
+CREATE TABLE IF NOT EXISTS order_request_transitions
+(
+    from_state INTEGER,
+    to_state INTEGER,
+
+    PRIMARY KEY (to_state, from_state)
+);
+
+INSERT INTO order_request_transitions (from_state, to_state) VALUES
+    (0, 1),
+    (0, 4),
+    (1, 2),
+    (1, 4),
+    (2, 3)
+ON CONFLICT DO NOTHING;
+
+INSERT INTO schema_migrations (version) VALUES (6) ON CONFLICT DO NOTHING;
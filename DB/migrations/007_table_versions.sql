@@ -0,0 +1,17 @@
+-- 007 : change counter of the tables whose reads carry an ETag, bumped in the transaction that changes their rows
+
+CREATE TABLE IF NOT EXISTS table_versions
+(
+    table_name VARCHAR PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0,
+    modified_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO table_versions (table_name) VALUES
+    ('users'),
+    ('cabinets'),
+    ('categories'),
+    ('items')
+ON CONFLICT DO NOTHING;
+
+INSERT INTO schema_migrations (version) VALUES (7) ON CONFLICT DO NOTHING;
@@ -0,0 +1,14 @@
+-- 008 : full-text search over the title and description of items, and typo tolerant matching of their titles where pg_trgm is installed
+-- the indexed expression has to stay the same as crud.ITEM_DOCUMENT for GET /items/search/ to use it
+
+CREATE INDEX IF NOT EXISTS ix_items_search ON items USING GIN (to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(description, '')));
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS ix_items_title_trgm ON items USING GIN (title gin_trgm_ops);
+    END IF;
+END $$;
+
+INSERT INTO schema_migrations (version) VALUES (8) ON CONFLICT DO NOTHING;
@@ -0,0 +1,23 @@
+-- 009 : users allowed to open each cabinet, read into memory by every worker to answer POST /cabinet/{id}/authorize/
+-- revocations keep the row with granted false, workers catch up on the rows updated since their last refresh
+
+CREATE TABLE IF NOT EXISTS cabinet_permissions
+(
+    user_id VARCHAR(11),
+    cabinet_id VARCHAR,
+    granted BOOLEAN NOT NULL DEFAULT TRUE,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (user_id, cabinet_id),
+    FOREIGN KEY (user_id)
+        REFERENCES users (uid)
+        ON DELETE CASCADE,
+    FOREIGN KEY (cabinet_id)
+        REFERENCES cabinets (id)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS ix_cabinet_permissions_cabinet_id_user_id ON cabinet_permissions (cabinet_id, user_id);
+CREATE INDEX IF NOT EXISTS ix_cabinet_permissions_updated_at ON cabinet_permissions (updated_at);
+
+INSERT INTO schema_migrations (version) VALUES (9) ON CONFLICT DO NOTHING;
@@ -0,0 +1,19 @@
+-- 010 : progress of the unlock attempt purges, in the database so every worker can report on a job whichever worker runs it
+
+CREATE TABLE IF NOT EXISTS unlock_attempt_purges
+(
+    id SERIAL,
+    cutoff TIMESTAMP WITH TIME ZONE NOT NULL,
+    archive VARCHAR,
+    archive_path VARCHAR,
+    status VARCHAR NOT NULL DEFAULT 'pending',
+    deleted INTEGER NOT NULL DEFAULT 0,
+    batches INTEGER NOT NULL DEFAULT 0,
+    error VARCHAR,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+
+    PRIMARY KEY (id)
+);
+
+INSERT INTO schema_migrations (version) VALUES (10) ON CONFLICT DO NOTHING;
@@ -0,0 +1,21 @@
+-- 011 : order request state changes checked against order_request_transitions whatever statement makes them,
+-- not only the bulk transitions which already leave the rows with no transition to the new state as they are
+
+CREATE OR REPLACE FUNCTION check_order_request_transition()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM order_request_transitions WHERE from_state = OLD.state AND to_state = NEW.state) THEN
+        RAISE EXCEPTION 'order request % cannot go from state % to state %', OLD.id, OLD.state, NEW.state
+            USING ERRCODE = 'check_violation';
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS check_order_request_transition ON order_requests;
+CREATE TRIGGER check_order_request_transition
+BEFORE UPDATE OF state ON order_requests
+FOR EACH ROW WHEN (NEW.state IS DISTINCT FROM OLD.state)
+EXECUTE FUNCTION check_order_request_transition();
+
+INSERT INTO schema_migrations (version) VALUES (11) ON CONFLICT DO NOTHING;